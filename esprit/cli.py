@@ -1,7 +1,7 @@
 from esprit import tasks, raw
 
 
-def copy(source, source_type, target, target_type, limit=None, batch=1000):
+def copy(source, source_type, target, target_type, limit=None, batch=1000, writers=None, tiebreaker=None):
     source_index = source.split("/")[-1]
     source_url = "/".join(source.split("/")[:-1])
     sconn = raw.Connection(source_url, source_index)
@@ -10,7 +10,11 @@ def copy(source, source_type, target, target_type, limit=None, batch=1000):
     target_url = "/".join(target.split("/")[:-1])
     tconn = raw.Connection(target_url, target_index)
 
-    tasks.copy(sconn, source_type, tconn, target_type, limit, batch)
+    def progress(stats):
+        print("written", stats.written, "of", stats.read, "read;", round(stats.records_per_second, 1), "records/s")
+
+    tasks.copy(sconn, source_type, tconn, target_type, limit, batch, writers=writers, progress_callback=progress,
+               tiebreaker=tiebreaker)
 
 
 if __name__ == "__main__":
@@ -24,8 +28,11 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--target", help="url of target index")
     parser.add_argument("-f", "--sourcetype", help="data type to copy from")
     parser.add_argument("-t", "--targettype", help="data type to copy to")
-    parser.add_argument("-l", "--limit", help="maximum number of records to copy")
-    parser.add_argument("-b", "--batch", help="batch size in copy operation")
+    parser.add_argument("-l", "--limit", type=int, help="maximum number of records to copy")
+    parser.add_argument("-b", "--batch", type=int, help="batch size in copy operation")
+    parser.add_argument("-w", "--writers", type=int, help="number of concurrent bulk writers in copy operation")
+    parser.add_argument("-k", "--tiebreaker",
+                        help="unique, sortable field (e.g. id.exact) to page through the source in order of")
 
     args = parser.parse_args()
 
@@ -36,5 +43,8 @@ if __name__ == "__main__":
         target_type = args.targettype
         limit = args.limit if args.limit else None
         batch = args.batch if args.batch else 1000
-        print("copying with", source, source_type, target, target_type, "limit", limit, "batch size", batch)
-        copy(source, source_type, target, target_type, limit, batch)
+        writers = args.writers
+        tiebreaker = args.tiebreaker
+        print("copying with", source, source_type, target, target_type, "limit", limit, "batch size", batch,
+              "writers", writers, "tiebreaker", tiebreaker)
+        copy(source, source_type, target, target_type, limit, batch, writers, tiebreaker)
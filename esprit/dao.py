@@ -1,7 +1,9 @@
 import uuid, json
 from esprit import raw, util, tasks, versions
 from copy import deepcopy
+from collections import deque, OrderedDict
 import time
+import concurrent.futures
 
 
 class StoreException(Exception):
@@ -12,6 +14,37 @@ class StoreException(Exception):
         return repr(self.value)
 
 
+def _refresh_params(es_version):
+    """ The params which have a write make its records visible to search before it responds, if the version can """
+    if versions.refresh_wait_for(es_version):
+        return {"refresh": "wait_for"}
+    if versions.refresh_on_write(es_version):
+        return {"refresh": "true"}
+    return None
+
+
+def _check_action(action):
+    """ Unpack a store or remove action into its kind and details, making sure it has what it needs """
+    kind, obj = list(action.items())[0]
+    if kind not in ["store", "remove"]:
+        return kind, obj
+    if "index" not in obj:
+        raise StoreException("no index provided for {0} action".format(kind))
+    if kind == "store" and "record" not in obj:
+        raise StoreException("no record provided for store action")
+    if kind == "remove" and "id" not in obj and "query" not in obj:
+        raise StoreException("no id or query provided for remove action")
+    return kind, obj
+
+
+def _in_parallel(fn, items, max_workers=4):
+    """ Call fn(*item) for each item, up to max_workers at a time, returning the results in order """
+    if len(items) <= 1 or max_workers <= 1:
+        return [fn(*item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(lambda item: fn(*item), items))
+
+
 class DAO(object):
     __es_version__ = "1.7.5"
 
@@ -70,32 +103,35 @@ class DAO(object):
             raise StoreException("Unable to do blocking save on record where last_updated is not set")
 
         now = util.now()
-        if blocking:
-            # we need the new last_updated time to be later than the new one
-            if now == self.last_updated:
-                time.sleep(1)   # timestamp granularity is seconds, so just sleep for 1
-            now = util.now()    # update the new timestamp
 
         # the main body of the save
-        if makeid:
-            if "id" not in self.data:
-                self.id = self.makeid()
-        if created:
-            if 'created_date' not in self.data:
-                self.data['created_date'] = now
-        if updated:
-            self.data['last_updated'] = now
+        self._stamp(now, makeid, created, updated)
+
+        # a blocking save has the index make the record visible to search before it responds, where it can
+        params = _refresh_params(self._es_version) if blocking else None
 
-        resp = raw.store(conn, type, self.data, self.id)
+        resp = raw.store(conn, type, self.data, self.id, params=params)
         if resp.status_code < 200 or resp.status_code >= 400:
             raise raw.ESWireException(resp)
 
-        if blocking:
+        # otherwise, poll until the record shows up
+        if blocking and params is None:
             if versions.fields_query(self._es_version):
                 self._es_field_block(conn, type, now, max_wait)
             else:
                 self._es_source_block(conn, type, now, max_wait)
 
+    def _stamp(self, now, makeid=True, created=True, updated=True):
+        """ Give the record an id and timestamps, as it is about to be saved """
+        if makeid:
+            if "id" not in self.data:
+                self.id = self.makeid()
+        if created:
+            if 'created_date' not in self.data:
+                self.data['created_date'] = now
+        if updated:
+            self.data['last_updated'] = now
+
     def _es_field_block(self, conn, type, now, max_wait=False):
         q = {
             "query": {
@@ -158,42 +194,89 @@ class DAO(object):
         # in the simple case of one type, just get on and issue the delete
         if len(types) == 1:
             raw.delete(conn, types[0], self.id)
+            return
 
-        # otherwise, check all the types until we find the object, then issue the delete there
-        for t in types:
-            o = raw.get(conn, t, self.id)
-            if o is not None:
-                raw.delete(conn, t, self.id)
+        # otherwise, find which of the types hold the object in one request, and issue the delete only there
+        for t, _ in raw.locate(conn, types, self.id, source=False):
+            raw.delete(conn, t, self.id)
 
     @classmethod
     def makeid(cls):
         return uuid.uuid4().hex
     
-    def actions(self, conn, action_queue):
-        for action in action_queue:
-            if list(action.keys())[0] == "remove":
-                self._action_remove(conn, action)
-            elif list(action.keys())[0] == "store":
-                self._action_store(conn, action)
-
-    def _action_remove(self, conn, remove_action):
-        obj = remove_action.get("remove")
-        if "index" not in obj:
-            raise StoreException("no index provided for remove action")
-        if "id" not in obj and "query" not in obj:
-            raise StoreException("no id or query provided for remove action")
-        if "id" in obj:
-            raw.delete(conn, obj.get("index"), obj.get("id"))
-        elif "query" in obj:
-            raw.delete_by_query(conn, obj.get("index"), obj.get("query"))
-
-    def _action_store(self, conn, store_action):
-        obj = store_action.get("store")
-        if "index" not in obj:
-            raise StoreException("no index provided for store action")
-        if "record" not in obj:
-            raise StoreException("no record provided for store action")
-        raw.store(conn, obj.get("index"), obj.get("record"), obj.get("id"))
+    def actions(self, conn, action_queue, concurrency=4):
+        """
+        Carry out a queue of store and remove actions in as few requests as possible.
+
+        The queue is split into runs of actions by id and runs of removes by query, which are carried out in order so
+        that each action sees the effects of those before it.  A run of actions by id is sent to _bulk as one
+        request per index, and a run of removes by query is sent to delete by query, with up to concurrency
+        requests in flight at once.
+
+        :return: a report for each action, in the order of the queue: the action, index and id (or query), with the
+            status and any error, and for removes by query the number deleted
+        """
+        steps = [_check_action(action) for action in action_queue]
+        report = [{"action": kind, "index": obj.get("index"), "id": obj.get("id"), "query": obj.get("query")}
+                  for kind, obj in steps]
+
+        # positions of the actions in each run, and whether it is a run of removes by query
+        runs = []
+        for position, (kind, obj) in enumerate(steps):
+            if kind not in ["store", "remove"]:
+                report[position]["error"] = "unknown action"
+                continue
+            by_query = kind == "remove" and "id" not in obj
+            if len(runs) == 0 or runs[-1][0] != by_query:
+                runs.append((by_query, []))
+            runs[-1][1].append(position)
+
+        for i, (by_query, positions) in enumerate(runs):
+            if by_query:
+                self._remove_by_query(conn, [(p, steps[p][1]) for p in positions], report, concurrency)
+            else:
+                # a run followed by removes by query has to be visible to search before they are run
+                refresh = i + 1 < len(runs)
+                self._bulk_actions(conn, [(p, steps[p]) for p in positions], report, concurrency, refresh)
+        return report
+
+    def _bulk_actions(self, conn, steps, report, concurrency, refresh=False):
+        by_type = OrderedDict()
+        for position, (kind, obj) in steps:
+            if kind == "remove":
+                action = ("delete", obj.get("id"), None)
+            else:
+                action = ("index", obj.get("id"), obj.get("record"))
+            by_type.setdefault(obj.get("index"), []).append((position, action))
+
+        params = _refresh_params(self._es_version) if refresh else None
+
+        def send(type, actions):
+            result = raw.bulk_actions(conn, [a for _, a in actions], type_=type, params=params, keep_successes=True)
+            if refresh and params is None:
+                raw.refresh(conn, type)
+            return result
+
+        results = _in_parallel(send, list(by_type.items()), max_workers=concurrency)
+        for (type, actions), result in zip(by_type.items(), results):
+            for outcome in result.successes + result.failures:
+                entry = report[actions[outcome["position"]][0]]
+                entry["status"] = outcome.get("status")
+                entry["id"] = outcome.get("_id", entry["id"])
+                if "error" in outcome:
+                    entry["error"] = outcome["error"]
+
+    def _remove_by_query(self, conn, steps, report, concurrency):
+        def send(position, obj):
+            return raw.delete_by_query(conn, obj.get("index"), obj.get("query"), es_version=self._es_version)
+
+        for (position, _), resp in zip(steps, _in_parallel(send, steps, max_workers=concurrency)):
+            entry = report[position]
+            entry["status"] = resp.status_code
+            if resp.status_code >= 400:
+                entry["error"] = resp.text
+            else:
+                entry["deleted"] = resp.json().get("deleted")
 
     ##################################################
     # if you are subclassing, you need to implement these
@@ -208,6 +291,163 @@ class DAO(object):
         raise NotImplementedError()
 
 
+class UnitOfWork(object):
+    """
+    A write-behind buffer of saves and deletes against a connection.
+
+    Writes are held until commit(), or until max_ops of them (or max_age seconds' worth) have built up, and then
+    sent as one _bulk request per type.  Repeated writes to the same id are merged, so only the last is sent, and
+    DomainObject.pull(..., uow=) sees the pending writes, so that the caller reads back what it wrote.  There is no
+    timer behind max_age: it is checked as each write is queued and each pending read is made, so a unit of work
+    which is left idle holds its writes until it is next used or committed.
+
+    Used as a context manager, it commits on leaving the block, or discards the pending writes if there was an
+    error.
+    """
+    def __init__(self, conn, max_ops=1000, max_age=None, es_version=None):
+        """
+        :param es_version: the version of the cluster, which decides how removals by query are sent.  By default it
+            is taken from the first object saved or deleted (see also DomainObject.unit_of_work)
+        """
+        self.conn = conn
+        self.max_ops = max_ops
+        self.max_age = max_age
+        self.es_version = es_version
+        self.result = raw.BulkResult()
+        # (type, id) -> (bulk_type, record), in the order they were first written
+        self._pending = OrderedDict()
+        # removals by query, which always precede the pending writes
+        self._queries = []
+        self._since = None
+
+    def __len__(self):
+        return len(self._pending) + len(self._queries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def save(self, obj, type=None, makeid=True, created=True, updated=True):
+        """ Save the object as DAO.save would, when the unit of work is next flushed """
+        self._version_of(obj)
+        type = obj._get_write_type(type)
+        obj._stamp(util.now(), makeid, created, updated)
+        self.store(type, obj.data, obj.id)
+
+    def delete(self, obj, type=None):
+        """ Delete the object from whichever of its read types it is in, when the unit of work is next flushed """
+        self._version_of(obj)
+        for t in obj._get_read_types(type):
+            self.remove(t, id=obj.id)
+
+    def actions(self, action_queue):
+        """ Queue up DAO.actions style store and remove actions """
+        for action in action_queue:
+            kind, obj = _check_action(action)
+            if kind == "store":
+                self.store(obj.get("index"), obj.get("record"), obj.get("id"))
+            elif kind == "remove":
+                self.remove(obj.get("index"), id=obj.get("id"), query=obj.get("query"))
+
+    def store(self, type, record, id=None):
+        id = id if id is not None else record.get("id")
+        if id is None:
+            raise StoreException("unable to store a record without an id in a unit of work")
+        # take a copy, so the record is saved as it is now and not as it is by the time of the flush
+        self._write(type, id, ("index", deepcopy(record)))
+
+    def remove(self, type, id=None, query=None):
+        if id is not None:
+            self._write(type, id, ("delete", None))
+            return
+        # writes queued before a removal by query have to reach the index, and be visible to search, before it runs
+        if len(self._pending) > 0:
+            self.flush(refresh=True)
+        self._queries.append((type, query))
+        self._written()
+
+    def _write(self, type, id, op):
+        # move the id to the end, so writes are sent in the order of their last change
+        self._pending.pop((type, id), None)
+        self._pending[(type, id)] = op
+        self._written()
+
+    def _version_of(self, obj):
+        if self.es_version is None:
+            self.es_version = obj._es_version
+
+    def _written(self):
+        if self._since is None:
+            self._since = time.time()
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        too_old = self.max_age is not None and self._since is not None and time.time() - self._since >= self.max_age
+        if len(self) >= self.max_ops or too_old:
+            self.flush()
+
+    def get(self, type, id):
+        """
+        The pending state of the record, as (True, record) if it is to be stored, (True, None) if it is to be
+        deleted, or (False, None) if it has no pending writes
+        """
+        if len(self._queries) > 0:
+            # we can't tell what a query will remove, so let it do so now
+            self.flush()
+        else:
+            self._flush_if_due()
+        op = self._pending.get((type, id))
+        if op is None:
+            return False, None
+        return True, deepcopy(op[1])
+
+    def flush(self, refresh=False):
+        """
+        Send the pending writes, grouped into one _bulk request per type
+
+        :param refresh: have the writes made visible to search before this returns, e.g. for a query to see them
+        :return: the raw.BulkResult of the requests sent
+        """
+        queries, pending = self._queries, self._pending
+        self._queries, self._pending, self._since = [], OrderedDict(), None
+
+        es_version = self.es_version if self.es_version is not None else DAO.__es_version__
+        for type, query in queries:
+            resp = raw.delete_by_query(self.conn, type, query, es_version=es_version)
+            if resp.status_code >= 400:
+                raise raw.ESWireException(resp)
+
+        by_type = OrderedDict()
+        for (type, id), (bulk_type, record) in pending.items():
+            by_type.setdefault(type, []).append((bulk_type, id, record))
+
+        params = _refresh_params(es_version) if refresh else None
+        result = raw.BulkResult()
+        offset = 0
+        for type, actions in by_type.items():
+            result.merge(raw.bulk_actions(self.conn, actions, type_=type, params=params), offset=offset)
+            offset += len(actions)
+            if refresh and params is None:
+                raw.refresh(self.conn, type)
+        self.result.merge(result, offset=self.result.total)
+        if not result.ok:
+            raise StoreException(result.summary())
+        return result
+
+    def commit(self):
+        return self.flush()
+
+    def rollback(self):
+        """ Discard the pending writes """
+        self._queries, self._pending, self._since = [], OrderedDict(), None
+
+
 class DomainObject(DAO):
     __type__ = None
     __conn__ = None
@@ -261,6 +501,58 @@ class DomainObject(DAO):
     # End of type system
     ################################################
 
+    @classmethod
+    def unit_of_work(cls, conn=None, max_ops=1000, max_age=None):
+        """ A UnitOfWork against the class's connection and cluster version """
+        if conn is None:
+            conn = cls.__conn__
+        return UnitOfWork(conn, max_ops=max_ops, max_age=max_age, es_version=cls.__es_version__)
+
+    @classmethod
+    def save_all(cls, objects, conn=None, type=None, makeid=True, created=True, updated=True, blocking=False,
+                 batcher=None, max_retries=3):
+        """
+        Save many objects through the _bulk endpoint, in batches, rather than one request per object.  Each object
+        is given an id and timestamps as by save().  The objects may be a generator, which is read one batch at a
+        time.
+
+        :param blocking: have each batch become visible to search before the next is sent
+        :param batcher: a raw.Batcher to size the batches; by default, at most 1000 objects or 10MB
+        :return: a raw.BulkResult, in which each failure carries the object it was for, under "object"
+        """
+        if conn is None:
+            conn = cls.__conn__
+        type = cls.get_write_type(type)
+        if batcher is None:
+            batcher = raw.Batcher(max_records=1000, max_bytes=10000000)
+
+        params = _refresh_params(cls.__es_version__) if blocking else None
+        # with no way to refresh on write, refresh after each batch instead
+        refresh_after = blocking and params is None
+
+        pending = deque()
+
+        def records():
+            for obj in objects:
+                obj._stamp(util.now(), makeid, created, updated)
+                pending.append(obj)
+                yield obj.data
+
+        result = raw.BulkResult()
+        offset = 0
+        for batch in batcher.batches(records()):
+            objs = [pending.popleft() for _ in batch]
+            start = time.time()
+            batch_result = raw.bulk(conn, batch, type_=type, max_retries=max_retries, params=params)
+            batcher.observe_result(time.time() - start, batch_result)
+            for failure in batch_result.failures:
+                failure["object"] = objs[failure["position"]]
+            result.merge(batch_result, offset=offset)
+            offset += len(batch)
+            if refresh_after:
+                raw.refresh(conn, type)
+        return result
+
     @classmethod
     def refresh(cls, conn=None, type=None):
         if conn is None:
@@ -270,8 +562,12 @@ class DomainObject(DAO):
         raw.refresh(conn, type)
     
     @classmethod
-    def pull(cls, id_, conn=None, wrap=True, types=None):
-        """Retrieve object by id."""
+    def pull(cls, id_, conn=None, wrap=True, types=None, uow=None):
+        """
+        Retrieve object by id.
+
+        :param uow: a UnitOfWork whose pending writes should be seen, as if they had already been made
+        """
         if conn is None:
             conn = cls.__conn__
 
@@ -280,16 +576,25 @@ class DomainObject(DAO):
         if id_ is None:
             return None
         try:
+            # a pending write in the unit of work stands in for the record in that type, and the first type with
+            # a record wins, so there is no need to look in the types after a pending save
+            candidates = []
             for t in types:
-                resp = raw.get(conn, t, id_)
-                if resp.status_code == 404:
+                pending, record = uow.get(t, id_) if uow is not None else (False, None)
+                candidates.append((t, pending, record))
+                if pending and record is not None:
+                    break
+
+            # look in all the remaining types at once, rather than one at a time
+            lookup = [t for t, pending, _ in candidates if not pending]
+            found = dict(raw.locate(conn, lookup, id_)) if lookup else {}
+
+            for t, pending, record in candidates:
+                if not pending:
+                    record = found.get(t)
+                if record is None:
                     continue
-                else:
-                    j = raw.unpack_get(resp)
-                    if wrap:
-                        return cls(j)
-                    else:
-                        return j
+                return cls(record) if wrap else record
             return None
         except Exception as e:
             print(e)
@@ -310,13 +615,43 @@ class DomainObject(DAO):
             n_from += size
             for hit in res.get('hits', {}).get('hits', []):
                 if return_as_object:
-                    obj_id = hit.get('_source', {}).get('id', None)
-                    if obj_id:
-                        ans.append(cls.pull(obj_id))
+                    # the search has already given us the whole record, so there's no need to go and get it again
+                    source = hit.get('_source', {})
+                    if source.get('id', None):
+                        ans.append(cls(source))
                 else:
                     ans.append(hit.get('_source', {}))
         return ans
 
+    @classmethod
+    def pull_many(cls, ids, conn=None, wrap=True, types=None, chunk_size=1000):
+        """
+        Retrieve several objects by id, with one _mget request per chunk_size ids, looking in all the read types.
+
+        :return: a list with the object for each id, in the same order as the ids, and None for any not found
+        """
+        if conn is None:
+            conn = cls.__conn__
+        types = cls.get_read_types(types)
+        ids = list(ids)
+
+        records = [None] * len(ids)
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            # each id is looked for in every type, and is taken from the first type it is found in, as pull does
+            docs = [raw.doc_location(conn, t, id_) for id_ in chunk for t in types]
+            resp = raw.mget_docs(conn, docs)
+            if resp.status_code != 200:
+                raise raw.ESWireException(resp)
+            for n, doc in enumerate(resp.json().get("docs", [])):
+                position = start + n // len(types)
+                if records[position] is None and doc.get("found"):
+                    records[position] = doc.get("_source")
+
+        if not wrap:
+            return records
+        return [cls(r) if r is not None else None for r in records]
+
     @classmethod
     def pull_all_by_key(cls,key,value, return_as_object=True):
         size = 1000
@@ -439,7 +774,13 @@ class DomainObject(DAO):
             conn = cls.__conn__
 
         types = cls.get_read_types(types)
-        
+        query = cls.make_query(q=q, terms=terms, should_terms=should_terms, facets=facets, **kwargs)
+        r = raw.search(conn, types, query)
+        return r.json()
+
+    @classmethod
+    def make_query(cls, q='', terms=None, should_terms=None, facets=None, **kwargs):
+        """ Build the query which query() would run, from the same arguments """
         if isinstance(q, dict):
             query = q
             if 'bool' not in query['query']:
@@ -502,8 +843,7 @@ class DomainObject(DAO):
                     should_terms[s] = [should_terms[s]]
                 query["query"]["bool"]["must"].append({"terms": {s: should_terms[s]}})
 
-        r = raw.search(conn, types, query)
-        return r.json()
+        return query
 
     @classmethod
     def object_query(cls, q='', terms=None, should_terms=None, facets=None, conn=None, types=None, wrap=True, **kwargs):
@@ -533,12 +873,43 @@ class DomainObject(DAO):
         raw.delete_index_by_prefix(conn, index_prefix)
 
     @classmethod
-    def iterate(cls, q, page_size=1000, limit=None, wrap=True, **kwargs):
+    def iterate(cls, q, page_size=1000, limit=None, wrap=True, paging=tasks.PAGING_SEARCH_AFTER, cursor=None,
+                tiebreaker=None, **kwargs):
+        """
+        Iterate over all the objects matching the query.  By default this pages with search_after, and returns a
+        tasks.SearchAfterIterator whose cursor can be used to resume the iteration later.
+
+        :param tiebreaker: a unique, sortable field (e.g. a keyword copy of the id) to break ties in the sort on.
+            Without one, classes on ES 7.12 or later read from a point in time sorted on _shard_doc (and its
+            cursor can't be resumed from once it is closed); earlier versions sort on the id (_uid before 7.0, _id
+            after)
+        """
+        if paging == tasks.PAGING_FROM:
+            return cls._iterate_from(q, page_size=page_size, limit=limit, wrap=wrap, tiebreaker=tiebreaker, **kwargs)
+
+        if tiebreaker is None:
+            if cursor is None and versions.shard_doc_sort(cls.__es_version__):
+                conn = kwargs.pop("conn", None)
+                conn = conn if conn is not None else cls.__conn__
+                types = cls.get_read_types(kwargs.pop("types", None))
+                query = cls.make_query(q=deepcopy(q), **kwargs)
+                return tasks.iterate_point_in_time(conn, types, query, page_size=page_size, limit=limit,
+                                                   transform=cls if wrap else None)
+            tiebreaker = versions.id_sort_field(cls.__es_version__)
+
+        def fetch(query):
+            return cls.query(q=query, **kwargs)
+
+        return tasks.SearchAfterIterator(fetch, q, page_size=page_size, limit=limit, cursor=cursor,
+                                         tiebreaker=tiebreaker, transform=cls if wrap else None)
+
+    @classmethod
+    def _iterate_from(cls, q, page_size=1000, limit=None, wrap=True, tiebreaker=None, **kwargs):
         q = q.copy()
         q["size"] = page_size
         q["from"] = 0
-        if "sort" not in q:
-            q["sort"] = [{"_uid": {"order": "asc"}}]
+        if "sort" not in q and tiebreaker is not None:
+            q["sort"] = [{tiebreaker: {"order": "asc"}}]
         counter = 0
         while True:
             # apply the limit
@@ -574,7 +945,13 @@ class DomainObject(DAO):
         return res.get("hits", {}).get("total", {}).get("value", 0)
 
     @classmethod
-    def scroll(cls, q=None, page_size=1000, limit=None, keepalive="10m", conn=None, raise_on_scroll_error=True, types=None, wrap=True):
+    def scroll(cls, q=None, page_size=1000, limit=None, keepalive="10m", conn=None, raise_on_scroll_error=True, types=None, wrap=True,
+               slices=None, prefetch=0):
+        """
+        Scroll through all the objects matching the query.  With slices, the results are divided into that many
+        slices which are scrolled in parallel, and the objects are yielded in no particular order.  Otherwise,
+        prefetch pages may be fetched ahead in the background.
+        """
         if conn is None:
             conn = cls.__conn__
         types = cls.get_read_types(types)
@@ -585,7 +962,10 @@ class DomainObject(DAO):
         if cls.count(q, types=types) < 1:
             return
 
-        gen = tasks.scroll(conn, types, q, page_size=page_size, limit=limit, keepalive=keepalive)
+        if slices is not None and slices > 1:
+            gen = tasks.parallel_scroll(conn, types, q, slices=slices, page_size=page_size, limit=limit, keepalive=keepalive)
+        else:
+            gen = tasks.scroll(conn, types, q, page_size=page_size, limit=limit, keepalive=keepalive, prefetch=prefetch)
 
         try:
             for o in gen:
@@ -598,6 +978,8 @@ class DomainObject(DAO):
                 raise e
             else:
                 return
+        finally:
+            gen.close()
 
 ########################################################################
 # Some useful ES queries
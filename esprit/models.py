@@ -67,6 +67,8 @@ class QueryBuilder(object):
     _term_filter = {"query": {"filtered": {"filter": {"term": {}}}}} # terms : {"<key>" : "<value>"}
     
     _fields_constraint = {"fields": []}
+
+    _ids = {"query": {"ids": {"values": []}}}
     
     _special_chars = ["+", "-", "&&", "||", "!", "(", ")", "{", "}", "[", "]", "^", '"', "~", "*", "?", ":", "/"]
     _escape_char = "\\" # which is a special special character too!
@@ -101,6 +103,12 @@ class QueryBuilder(object):
         q["query"]["filtered"]["filter"]["terms"][key] = values
         return q
     
+    @classmethod
+    def ids(cls, ids):
+        q = deepcopy(cls._ids)
+        q["query"]["ids"]["values"] = list(ids)
+        return q
+
     @classmethod
     def fields(cls, query, fields=None):
         fields = [] if fields is None else fields if isinstance(fields, list) else [fields]
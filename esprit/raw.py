@@ -1,6 +1,7 @@
 # The Raw ElasticSearch functions, no frills, just wrappers around the HTTP calls
 
-import requests, json, urllib.request, urllib.parse, urllib.error, logging
+import requests, urllib3, json, urllib.request, urllib.parse, urllib.error, logging, os, threading, time, gzip, zlib
+from requests.adapters import HTTPAdapter
 from .models import QueryBuilder
 from . import versions
 
@@ -41,24 +42,279 @@ def configure_logging(loglevel: int = logging.WARNING):
 ##################################################################
 # Connection to the index
 
+def _normalise_host(host, port):
+    """ Split a host string which may carry a scheme and port into ("scheme://host", port) """
+    # make sure that host starts with "http://" or equivalent
+    if not host.startswith("http"):
+        host = "http://" + host
+    if host.endswith("/"):
+        host = host[:-1]
+
+    # some people might tack the port onto the host
+    if len(host.split(":")) > 2:
+        port = host[host.rindex(":") + 1:]
+        host = host[:host.rindex(":")]
+    return host, port
+
+
+class Node(object):
+    """ A single ES node in a connection's pool, with its liveness and load bookkeeping """
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.failures = 0
+        self.dead_until = 0.0
+
+    @property
+    def alive(self):
+        return self.dead_until <= time.time()
+
+    def __repr__(self):
+        return "Node({0})".format(self.url)
+
+
+class NodePool(object):
+    """
+    The set of nodes a Connection spreads its requests across.
+
+    Nodes which fail to respond are marked dead and are not selected again until their backoff period (doubling with
+    each consecutive failure, up to max_dead_timeout) has passed.  If every node is dead the one due back soonest is
+    used anyway, so that a recovered cluster is picked up without waiting.
+    """
+    ROUND_ROBIN = "round_robin"
+    LEAST_IN_FLIGHT = "least_in_flight"
+
+    def __init__(self, urls, selector=ROUND_ROBIN, dead_timeout=1.0, max_dead_timeout=60.0):
+        if selector not in [self.ROUND_ROBIN, self.LEAST_IN_FLIGHT]:
+            raise ValueError("unknown node selector '{0}'".format(selector))
+        self.selector = selector
+        self.dead_timeout = dead_timeout
+        self.max_dead_timeout = max_dead_timeout
+        self.nodes = [Node(u) for u in urls]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def urls(self):
+        return [n.url for n in self.nodes]
+
+    def set_nodes(self, urls):
+        """ Replace the pool's nodes, keeping the state of any we already know about """
+        with self._lock:
+            known = {n.url: n for n in self.nodes}
+            self.nodes = [known.get(u, Node(u)) for u in urls]
+            self._next = 0
+
+    def select(self):
+        with self._lock:
+            live = [n for n in self.nodes if n.alive]
+            if len(live) == 0:
+                return min(self.nodes, key=lambda n: n.dead_until)
+            self._next = (self._next + 1) % len(live)
+            if self.selector == self.LEAST_IN_FLIGHT:
+                # rotate before taking the minimum, so ties are spread round-robin
+                rotated = live[self._next:] + live[:self._next]
+                return min(rotated, key=lambda n: n.in_flight)
+            return live[self._next]
+
+    def node_for_url(self, url):
+        for n in self.nodes:
+            if url == n.url or url.startswith(n.url + "/"):
+                return n
+        return None
+
+    def acquire(self, node):
+        with self._lock:
+            node.in_flight += 1
+
+    def release(self, node):
+        with self._lock:
+            node.in_flight -= 1
+
+    def mark_dead(self, node):
+        with self._lock:
+            node.failures += 1
+            backoff = min(self.dead_timeout * 2 ** (node.failures - 1), self.max_dead_timeout)
+            node.dead_until = time.time() + backoff
+        logger.warning("marking node {0} dead for {1}s".format(node.url, backoff))
+
+    def mark_live(self, node):
+        if node.failures == 0:
+            return
+        with self._lock:
+            node.failures = 0
+            node.dead_until = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
 class Connection(object):
-    def __init__(self, host, index, port=9200, auth=None, verify_ssl=True, index_per_type=False):
-        """ Initialise a connection to an ES index. """
-        self.host = host
+    def __init__(self, host, index, port=9200, auth=None, verify_ssl=True, index_per_type=False,
+                 pool_connections=10, pool_maxsize=10, timeout=None, timeouts=None,
+                 selector=NodePool.ROUND_ROBIN, max_retries=3, dead_timeout=1.0, max_dead_timeout=60.0,
+                 sniff_on_start=False, sniff_interval=None, compress_requests=False, es_version=None):
+        """
+        Initialise a connection to an ES index.
+
+        The connection owns a pooled, keep-alive HTTP session which is shared by all requests made through it.  The
+        session is created lazily and re-created if the process forks, so a Connection may be made before handing
+        off to worker processes.
+
+        :param host: the host to connect to, or a list of hosts to spread requests across.  Each may carry its own
+            scheme and port
+        :param pool_connections: number of host pools to cache in the session
+        :param pool_maxsize: maximum number of connections to keep alive per host
+        :param timeout: default timeout (seconds, or a (connect, read) tuple) for all requests
+        :param timeouts: dict of per-operation timeouts, keyed by operation name (e.g. "search", "bulk", "scroll")
+            or HTTP method (e.g. "get", "post"), which take precedence over the default
+        :param selector: how to choose a node for each request, NodePool.ROUND_ROBIN or NodePool.LEAST_IN_FLIGHT
+        :param max_retries: number of other nodes to try when a node can't be reached
+        :param dead_timeout: initial time (seconds) before a failed node is tried again
+        :param max_dead_timeout: upper bound on the backoff for a repeatedly failing node
+        :param sniff_on_start: discover the cluster's nodes via _nodes/http when the connection is made
+        :param sniff_interval: re-discover the cluster's nodes every this many seconds
+        :param compress_requests: gzip request bodies (bar short ones), sent with Content-Encoding: gzip
+        :param es_version: the version of the cluster, e.g. "7.17.0", if known; otherwise it is asked for the first
+            time it is needed (see tasks.cluster_version), and kept
+        """
         self.index = index
-        self.port = port
         self.auth = auth
         self.verify_ssl = verify_ssl
         self.index_per_type = index_per_type
-
-        # make sure that host starts with "http://" or equivalent
-        if not self.host.startswith("http"):
-            self.host = "http://" + self.host
-
-        # some people might tack the port onto the host
-        if len(self.host.split(":")) > 2:
-            self.port = self.host[self.host.rindex(":") + 1:]
-            self.host = self.host[:self.host.rindex(":")]
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.timeouts = timeouts if timeouts is not None else {}
+        self.max_retries = max_retries
+        self.sniff_interval = sniff_interval
+        self.compress_requests = compress_requests
+        self.es_version = es_version
+
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+        # the number of scroll contexts opened through this connection which have not yet been cleared
+        self.open_scrolls = 0
+        self._scroll_lock = threading.Lock()
+
+        hosts = host if isinstance(host, list) else [host]
+        urls = []
+        for h in hosts:
+            h, p = _normalise_host(h, port)
+            urls.append(h + ":" + str(p) if p is not None else h)
+
+        # the first host is retained as the connection's nominal host and port
+        self.host, self.port = _normalise_host(hosts[0], port)
+
+        self.nodes = NodePool(urls, selector=selector, dead_timeout=dead_timeout, max_dead_timeout=max_dead_timeout)
+        self._last_sniff = 0.0
+        self._sniffing = False
+        if sniff_on_start:
+            self.sniff()
+
+    @property
+    def hosts(self):
+        return self.nodes.urls
+
+    def node_url(self):
+        """ Choose a live node for the next request, and return its base url """
+        if self.sniff_interval is not None and time.time() - self._last_sniff > self.sniff_interval:
+            self.sniff()
+        return self.nodes.select().url
+
+    def sniff(self):
+        """ Discover the HTTP addresses of the cluster's nodes, and use those as this connection's node pool """
+        if self._sniffing:
+            return
+        self._sniffing = True
+        try:
+            url = self.nodes.select().url + "/_nodes/http"
+            resp = _do_get(url, self, op="sniff")
+            if resp.status_code != 200:
+                logger.warning("unable to sniff nodes: {0} - {1}".format(resp.status_code, resp.text))
+                return
+            scheme = url.split("://")[0]
+            urls = []
+            for node in resp.json().get("nodes", {}).values():
+                address = node.get("http", {}).get("publish_address")
+                if address is None:
+                    continue
+                # publish addresses may be given as "hostname/ip:port"
+                if "/" in address:
+                    address = address.split("/")[-1]
+                urls.append(scheme + "://" + address)
+            if len(urls) > 0:
+                self.nodes.set_nodes(urls)
+        except requests.ConnectionError as e:
+            logger.warning("unable to sniff nodes: {0}".format(e))
+        finally:
+            self._last_sniff = time.time()
+            self._sniffing = False
+
+    @property
+    def session(self):
+        """ The pooled HTTP session for this connection, re-created if we are now in a different process """
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._session_lock:
+                if self._session is None or self._session_pid != pid:
+                    # don't close a session inherited across a fork, its sockets still belong to the parent
+                    self._session = self._make_session()
+                    self._session_pid = pid
+        return self._session
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if self.auth is not None:
+            session.auth = self.auth
+        session.verify = self.verify_ssl
+        return session
+
+    def timeout_for(self, op=None, method=None):
+        """ Get the timeout for the named operation, falling back to the HTTP method and then the default """
+        if op is not None and op in self.timeouts:
+            return self.timeouts[op]
+        if method is not None and method in self.timeouts:
+            return self.timeouts[method]
+        return self.timeout
+
+    def count_scrolls(self, n):
+        """ Record that n scroll contexts have been opened (or, if negative, cleared) """
+        with self._scroll_lock:
+            self.open_scrolls = max(self.open_scrolls + n, 0)
+
+    def close(self):
+        """ Release the pooled connections held by this connection's session """
+        with self._session_lock:
+            if self._session is not None and self._session_pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self._session_pid = None
+
+    def __getstate__(self):
+        # sessions and locks can't be pickled; they are re-created on the other side
+        state = self.__dict__.copy()
+        state["_session"] = None
+        state["_session_pid"] = None
+        del state["_session_lock"]
+        del state["_scroll_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._session_lock = threading.Lock()
+        self._scroll_lock = threading.Lock()
 
 
 def make_connection(connection, host, port, index, auth=None, index_per_type=False):
@@ -72,8 +328,6 @@ def make_connection(connection, host, port, index, auth=None, index_per_type=Fal
 
 def elasticsearch_url(connection, type=None, endpoint=None, params=None, omit_index=False):
     index = connection.index
-    host = connection.host
-    port = connection.port
 
     # Re-create the connection if we are using index-per-type
     if type is not None and connection.index_per_type:
@@ -101,15 +355,8 @@ def elasticsearch_url(connection, type=None, endpoint=None, params=None, omit_in
     if isinstance(type, list):
         type = ",".join(type)
 
-    # normalise the host
-    if not host.startswith("http"):
-        host = "http://" + host
-    if host.endswith("/"):
-        host = host[:-1]
-
-    if port is not None:
-        host += ":" + str(port)
-    host += "/"
+    # pick a live node to send this request to
+    host = connection.node_url() + "/"
 
     url = host + index
     if type is not None and type != "":
@@ -136,54 +383,112 @@ def elasticsearch_url(connection, type=None, endpoint=None, params=None, omit_in
 ###############################################################
 # HTTP Requests
 
-def _do_head(url, conn, **kwargs):
+# HTTP methods whose requests can be sent again without changing their effect
+IDEMPOTENT_METHODS = ["get", "head", "put", "delete"]
+
+
+def _do_request(method, url, conn, op=None, idempotent=None, **kwargs):
+    """
+    Issue an HTTP request through the connection's pooled session.
+
+    If the node the url points at can't be reached it is marked dead, and the request is re-issued against another
+    live node in the connection's pool, up to the connection's max_retries.  A request which may already have
+    reached the node is only re-issued if it is idempotent, as otherwise it could be applied twice.
+
+    :param op: the name of the operation, used to look up a per-operation timeout on the connection
+    :param idempotent: whether the request can safely be applied twice; by default, if its method is one of
+        IDEMPOTENT_METHODS.  Read-only POSTs such as searches pass True
+    """
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    if "timeout" not in kwargs:
+        kwargs["timeout"] = conn.timeout_for(op, method)
     if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
         kwargs["auth"] = conn.auth
     kwargs["verify"] = conn.verify_ssl
     kwargs["headers"] = {'Content-Type': 'application/json'}
-    return requests.head(url, **kwargs)
+
+    data = kwargs.get("data")
+    replayable = _replayable(data)
+    position = data.tell() if hasattr(data, "seek") else None
+    if conn.compress_requests and data is not None:
+        if isinstance(data, (str, bytes)):
+            if len(data) >= GZIP_MIN_LENGTH:
+                kwargs["headers"]["Content-Encoding"] = "gzip"
+                kwargs["data"] = gzip.compress(data.encode("utf-8") if isinstance(data, str) else data, GZIP_LEVEL)
+        else:
+            kwargs["headers"]["Content-Encoding"] = "gzip"
+            kwargs["data"] = GzipBody(data)
+
+    node = conn.nodes.node_for_url(url)
+    attempt = 0
+    while True:
+        if node is None:
+            return conn.session.request(method, url, **kwargs)
+
+        conn.nodes.acquire(node)
+        try:
+            resp = conn.session.request(method, url, **kwargs)
+        except requests.ConnectionError as e:
+            conn.nodes.mark_dead(node)
+            attempt += 1
+            if not replayable or not (idempotent or _never_sent(e)):
+                raise
+            if attempt > conn.max_retries or len(conn.nodes.nodes) < 2:
+                raise
+            resp = None
+        finally:
+            conn.nodes.release(node)
+
+        if resp is not None:
+            conn.nodes.mark_live(node)
+            return resp
+
+        # try the request again on another node
+        if position is not None:
+            data.seek(position)
+        retry_node = conn.nodes.select()
+        url = retry_node.url + url[len(node.url):]
+        node = retry_node
+
+
+def _never_sent(error):
+    """ Whether a connection error happened before any of the request could have reached the node """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if len(error.args) > 0 else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _replayable(data):
+    """
+    Whether a request body can be sent again, e.g. to another node: a str or bytes, a file we can seek back in, or
+    a body which says it can be read again (as a BulkBody over a list does).  Anything else may be a one-shot
+    iterator, which would be sent again as an empty body.
+    """
+    if data is None or isinstance(data, (str, bytes)) or hasattr(data, "seek"):
+        return True
+    return getattr(data, "replayable", False)
+
+
+def _do_head(url, conn, **kwargs):
+    return _do_request("head", url, conn, **kwargs)
 
 
 def _do_get(url, conn, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    kwargs["headers"] = {'Content-Type': 'application/json'}
-    return requests.get(url, **kwargs)
+    return _do_request("get", url, conn, **kwargs)
 
 
 def _do_post(url, conn, data=None, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    kwargs["headers"] = {'Content-Type': 'application/json'}
-    return requests.post(url, data, **kwargs)
+    return _do_request("post", url, conn, data=data, **kwargs)
 
 
 def _do_put(url, conn, data=None, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    kwargs["headers"] = {'Content-Type': 'application/json'}
-    return requests.put(url, data, **kwargs)
+    return _do_request("put", url, conn, data=data, **kwargs)
 
 
 def _do_delete(url, conn, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    kwargs["headers"] = {'Content-Type': 'application/json'}
-    return requests.delete(url, **kwargs)
+    return _do_request("delete", url, conn, **kwargs)
 
 
 # 2016-11-09 TD : A new search interface returning different output formats, e.g. csv
@@ -211,7 +516,7 @@ def data(connection, type=None, query=None, fmt="csv", method="POST", url_params
     resp = None
     if method == "POST":
         headers = {"content-type" : "application/json"}
-        resp = _do_post(url, connection, data=json.dumps(query), headers=headers)
+        resp = _do_post(url, connection, data=json.dumps(query), headers=headers, idempotent=True)
     elif method == "GET":
         resp = _do_get(url + "&source=" + urllib.parse.quote(json.dumps(query)), connection)
     return resp
@@ -231,12 +536,21 @@ def search(connection, type=None, query=None, method="POST", url_params=None):
     resp = None
     if method == "POST":
         headers = {"content-type": "application/json"}
-        resp = _do_post(url, connection, data=json.dumps(query), headers=headers)
+        resp = _do_post(url, connection, data=json.dumps(query), headers=headers, op="search", idempotent=True)
     elif method == "GET":
-        resp = _do_get(url + "?source=" + urllib.parse.quote_plus(json.dumps(query)), connection)
+        resp = _do_get(url + "?source=" + urllib.parse.quote_plus(json.dumps(query)), connection, op="search")
     return resp
 
 
+def count(connection, type=None, query=None):
+    """ Count the records matching the query with the _count endpoint, which takes only the query part """
+    body = {"query": query["query"]} if query is not None and "query" in query else None
+    url = elasticsearch_url(connection, type, "_count")
+    if body is None:
+        return _do_get(url, connection, op="search")
+    return _do_post(url, connection, data=json.dumps(body), op="search", idempotent=True)
+
+
 def unpack_result(requests_response):
     j = requests_response.json()
     return unpack_json_result(j)
@@ -258,13 +572,32 @@ def initialise_scroll(connection, type=None, query=None, keepalive="10m", scan=F
     url_params = {"scroll": keepalive}
     if scan:
         url_params["search_type"] = "scan"
-    return search(connection, type, query, url_params=url_params)
+    resp = search(connection, type, query, url_params=url_params)
+    if resp.status_code == 200:
+        connection.count_scrolls(1)
+    return resp
 
 
 def scroll_next(connection, scroll_id, keepalive="10m"):
     url = elasticsearch_url(connection, endpoint="_search/scroll", params={"scroll_id": scroll_id, "scroll": keepalive},
                             omit_index=True)
-    resp = _do_get(url, connection)
+    # each request moves the scroll on, so one which may have been answered can't be sent again without losing a page
+    resp = _do_get(url, connection, op="scroll", idempotent=False)
+    return resp
+
+
+def clear_scroll(connection, scroll_ids):
+    """
+    Release one or more scroll contexts on the cluster, rather than waiting for their keepalive to run out
+
+    :param scroll_ids: a scroll id, or a list of them to clear in one request
+    """
+    if not isinstance(scroll_ids, list):
+        scroll_ids = [scroll_ids]
+    url = elasticsearch_url(connection, endpoint="_search/scroll", omit_index=True)
+    resp = _do_delete(url, connection, data=json.dumps({"scroll_id": scroll_ids}), op="scroll")
+    # whether or not the cluster still knew about them, these contexts are gone now
+    connection.count_scrolls(-len(scroll_ids))
     return resp
 
 
@@ -280,6 +613,39 @@ def unpack_scroll(requests_response):
     return objects, sid
 
 
+#################################################################
+# Point in time search
+
+def open_point_in_time(connection, type=None, keep_alive="1m"):
+    """ Open a point in time against the index (or, for index-per-type connections, the type's index) """
+    # a point in time covers whole indexes, so we only pass the type on when it picks out an index
+    type = type if connection.index_per_type else None
+    url = elasticsearch_url(connection, type, endpoint="_pit", params={"keep_alive": keep_alive})
+    resp = _do_post(url, connection, op="pit")
+    return resp
+
+
+def unpack_point_in_time(requests_response):
+    return requests_response.json().get("id")
+
+
+def search_point_in_time(connection, pit_id, query=None, keep_alive="1m"):
+    """ Search within a point in time, extending its keep_alive.  The index is taken from the point in time """
+    if query is None:
+        query = QueryBuilder.match_all()
+    query = query.copy()
+    query["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+    url = elasticsearch_url(connection, endpoint="_search", omit_index=True)
+    resp = _do_post(url, connection, data=json.dumps(query), op="search", idempotent=True)
+    return resp
+
+
+def close_point_in_time(connection, pit_id):
+    url = elasticsearch_url(connection, endpoint="_pit", omit_index=True)
+    resp = _do_delete(url, connection, data=json.dumps({"id": pit_id}), op="pit")
+    return resp
+
+
 #################################################################
 # Record retrieval
 
@@ -305,10 +671,45 @@ def mget(connection, type, ids, fields=None):
         for id in ids:
             docs["docs"].append({"_id": id, "fields": fields})
     url = elasticsearch_url(connection, type, endpoint="_mget")
-    resp = _do_post(url, connection, data=json.dumps(docs))
+    resp = _do_post(url, connection, data=json.dumps(docs), idempotent=True)
     return resp
 
 
+def doc_location(connection, type, id):
+    """ The _mget doc entry which locates the record with the id among the type's records """
+    if connection.index_per_type:
+        return {"_index": type_to_index(connection, type)[0], "_id": id}
+    return {"_index": connection.index, "_type": type, "_id": id}
+
+
+def mget_docs(connection, docs, source=True):
+    """
+    Get several records at once, each from wherever its doc entry (e.g. from doc_location) says, which may be a
+    different index or type for each.  The response lists the docs in the same order.
+
+    :param source: whether to fetch the records themselves, or only find out which exist
+    """
+    if not source:
+        docs = [dict(d, _source=False) for d in docs]
+    url = elasticsearch_url(connection, endpoint="_mget", omit_index=True)
+    resp = _do_post(url, connection, data=json.dumps({"docs": docs}), op="mget", idempotent=True)
+    return resp
+
+
+def locate(connection, types, id, source=True):
+    """
+    Look for the record with the id in each of the types, all in a single _mget request.
+
+    :param source: whether to fetch the record, or only find out which types have it (the record is then None)
+    :return: a list of (type, record) for each type which has the record, in the order of the types
+    """
+    resp = mget_docs(connection, [doc_location(connection, t, id) for t in types], source=source)
+    if resp.status_code != 200:
+        raise ESWireException(resp)
+    docs = resp.json().get("docs", [])
+    return [(t, doc.get("_source")) for t, doc in zip(types, docs) if doc.get("found")]
+
+
 def unpack_mget(requests_response):
     j = requests_response.json()
     objects = [i.get("_source") if "_source" in i else i.get("fields") for i in j.get("docs")]
@@ -413,7 +814,10 @@ def delete_index_by_prefix(conn, index_prefix):
     indexes = [i for i in list_indexes(connection=conn) if i.startswith(index_prefix)]
 
     # Create a new Connection instance for the delete with all of the matching indexes
-    del_conn = Connection(conn.host, index_prefix, conn.port, conn.auth, conn.verify_ssl)
+    del_conn = Connection(conn.hosts, index_prefix, conn.port, conn.auth, conn.verify_ssl,
+                          pool_connections=conn.pool_connections, pool_maxsize=conn.pool_maxsize,
+                          timeout=conn.timeout, timeouts=conn.timeouts, compress_requests=conn.compress_requests,
+                          es_version=conn.es_version)
     url = elasticsearch_url(del_conn)
     resp = _do_delete(url, del_conn)
     return resp
@@ -436,47 +840,517 @@ def store(connection, type, record, id=None, params=None):
     return resp
 
 
-def to_bulk(records, idkey="id", index='', type_='', bulk_type="index", **kwargs):
-    data = ''
-    for r in records:
-        data += to_bulk_single_rec(r, idkey=idkey, index=index, type_=type_, bulk_type=bulk_type, **kwargs)
-    return data
+# Size of the byte chunks a streamed bulk body is sent in
+BULK_CHUNK_SIZE = 65536
 
 
-def to_bulk_single_rec(record, idkey="id", index='', type_='', bulk_type="index", **kwargs):
-    data = ''
-
+def _id_getter(idkey):
+    """ Compile the dotted idkey path once, returning a function which pulls the _id out of a record """
     idpath = idkey.split(".")
-    context = record
-    for pathseg in idpath:
-        if pathseg in context:
-            context = context[pathseg]
-        else:
-            raise BulkException("'{0}' not available in record to generate bulk _id: {1}".format(idkey, json.dumps(record)))
 
-    datadict = {bulk_type: {'_id': context}}
+    def get_id(record):
+        context = record
+        for pathseg in idpath:
+            if pathseg in context:
+                context = context[pathseg]
+            else:
+                raise BulkException("'{0}' not available in record to generate bulk _id: {1}".format(idkey, json.dumps(record)))
+        return context
+
+    return get_id
+
+
+def _bulk_lines(records, idkey="id", index='', type_='', bulk_type="index", sources=None, **kwargs):
+    """ Yield the action and source lines for each record in turn, using the already serialised sources if given """
+    get_id = _id_getter(idkey)
+    meta = {}
     if index:
-        datadict[bulk_type]['_index'] = index
+        meta['_index'] = index
     if type_:
-        datadict[bulk_type]['_type'] = type_
+        meta['_type'] = type_
+    meta.update(kwargs)
 
-    datadict[bulk_type].update(kwargs)
+    if sources is None:
+        sources = (json.dumps(record) for record in records)
+    for record, source in zip(records, sources):
+        action = {'_id': get_id(record)}
+        action.update(meta)
+        yield json.dumps({bulk_type: action}) + '\n' + source + '\n'
 
-    data += json.dumps(datadict) + '\n'
-    data += json.dumps(record) + '\n'
-    return data
 
+def _bulk_del_lines(ids):
+    for i in ids:
+        yield json.dumps({'delete': {'_id': i}}) + '\n'
+
+
+def _bulk_action_lines(actions):
+    for bulk_type, id, record in actions:
+        # without an id, the index will make one up
+        line = json.dumps({bulk_type: {'_id': id} if id is not None else {}}) + '\n'
+        if bulk_type != "delete":
+            line += json.dumps(record) + '\n'
+        yield line
+
+
+def _chunked(lines, chunk_size=BULK_CHUNK_SIZE):
+    """ Encode a stream of lines, joining them into byte chunks of at least chunk_size (except the last) """
+    parts = []
+    size = 0
+    for line in lines:
+        encoded = line.encode("utf-8")
+        parts.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield b''.join(parts)
+            parts.clear()
+            size = 0
+    if len(parts) > 0:
+        yield b''.join(parts)
+
+
+class BulkBody(object):
+    """
+    A streamed NDJSON body for the _bulk endpoint.
 
-def bulk(connection, records, idkey='id', type_='', bulk_type="index", **kwargs):
-    data = to_bulk(records, idkey=idkey, bulk_type=bulk_type, **kwargs)
-    url = elasticsearch_url(connection, type_, endpoint="_bulk")
-    resp = _do_post(url, connection, data=data)
-    return resp
+    Iterating it yields the encoded body in byte chunks, so the request is sent with chunked transfer encoding
+    without the whole payload being built in memory.  Each iteration starts a fresh stream over the records, so
+    the body may be re-sent (e.g. to another node) if the records are a list or tuple; over any other iterable it
+    is not replayable, as the records may have been used up by the first attempt.  A batch from a Batcher is sent
+    as the JSON it was measured by, rather than being serialised again.
+    """
+    def __init__(self, records, idkey="id", index='', type_='', bulk_type="index", chunk_size=BULK_CHUNK_SIZE, **kwargs):
+        self.records = records
+        self.idkey = idkey
+        self.index = index
+        self.type_ = type_
+        self.bulk_type = bulk_type
+        self.chunk_size = chunk_size
+        self.kwargs = kwargs
+
+    @property
+    def replayable(self):
+        return isinstance(self.records, (list, tuple))
+
+    def lines(self):
+        return _bulk_lines(self.records, idkey=self.idkey, index=self.index, type_=self.type_,
+                           bulk_type=self.bulk_type, sources=getattr(self.records, "sources", None), **self.kwargs)
+
+    def __iter__(self):
+        return _chunked(self.lines(), self.chunk_size)
+
+
+class BulkDeleteBody(BulkBody):
+    """ A streamed NDJSON body of delete actions for the _bulk endpoint """
+    def __init__(self, ids, chunk_size=BULK_CHUNK_SIZE):
+        super(BulkDeleteBody, self).__init__(ids, chunk_size=chunk_size)
+
+    def lines(self):
+        return _bulk_del_lines(self.records)
+
+
+class BulkActionsBody(BulkBody):
+    """ A streamed NDJSON body of mixed actions, each a (bulk_type, id, record) tuple with record None for a delete """
+    def __init__(self, actions, chunk_size=BULK_CHUNK_SIZE):
+        super(BulkActionsBody, self).__init__(actions, chunk_size=chunk_size)
+
+    def lines(self):
+        return _bulk_action_lines(self.records)
+
+
+# zlib's default, which is much quicker than gzip's own default of 9 for little extra compression
+GZIP_LEVEL = 6
+
+# bodies shorter than this (e.g. most queries) aren't worth compressing
+GZIP_MIN_LENGTH = 1024
+
+
+class GzipBody(object):
+    """
+    A request body which gzips another as it is sent: a file (read from its current position), or an iterable of
+    str or bytes chunks such as a BulkBody.  It can be iterated again as long as the body it wraps can be.
+    """
+    def __init__(self, data, level=GZIP_LEVEL, chunk_size=BULK_CHUNK_SIZE):
+        self.data = data
+        self.level = level
+        self.chunk_size = chunk_size
+
+    @property
+    def replayable(self):
+        return _replayable(self.data)
+
+    def blocks(self):
+        if hasattr(self.data, "read"):
+            return iter(lambda: self.data.read(self.chunk_size), self.data.read(0))
+        return iter(self.data)
+
+    def __iter__(self):
+        # wbits of 31 selects the gzip container, rather than raw zlib
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        for block in self.blocks():
+            if isinstance(block, str):
+                block = block.encode("utf-8")
+            out = compressor.compress(block)
+            if out:
+                yield out
+        yield compressor.flush()
+
+
+# Bulk actions which, given an id, can be applied twice to the same effect
+IDEMPOTENT_BULK_TYPES = ["index", "delete"]
+
+# Item statuses (and whole-request statuses) on which a bulk action is worth sending again
+RETRYABLE_BULK_STATUSES = [429, 502, 503, 504]
+
+
+class BulkResult(object):
+    """
+    The per-item outcome of a bulk operation, which may have taken several _bulk requests to complete.
+
+    Failures are recorded against the position of the item in the records (or ids) originally passed in, while
+    successes are only counted, so that a result covering millions of records stays small.  With keep_successes,
+    each success is recorded by position too.  For compatibility with callers which expect a response,
+    status_code, text and json() give those of the last _bulk request made.
+    """
+    def __init__(self, response=None, keep_successes=False):
+        self.response = response
+        self.keep_successes = keep_successes
+        self.succeeded = 0
+        self.successes = []
+        self.failures = []
+        self.requests = 0
+        self.retries = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_response(cls, resp, keep_successes=False):
+        """ Make a result from a single _bulk response, whatever the number of items it covered """
+        result = cls(resp, keep_successes=keep_successes)
+        result.requests = 1
+        if resp.status_code >= 400:
+            result.failures.append({"position": 0, "status": resp.status_code, "_id": None, "error": resp.text})
+            return result
+        outcomes = _bulk_outcomes(resp, len(resp.json().get("items", [])))
+        for position, outcome in enumerate(outcomes):
+            outcome["position"] = position
+            if outcome["status"] in RETRYABLE_BULK_STATUSES:
+                result.rejected += 1
+            if "error" in outcome:
+                result.failures.append(outcome)
+            else:
+                result.add_success(outcome)
+        return result
+
+    @property
+    def status_code(self):
+        return self.response.status_code if self.response is not None else None
+
+    @property
+    def text(self):
+        return self.response.text if self.response is not None else ""
+
+    def json(self):
+        return self.response.json()
+
+    @property
+    def ok(self):
+        return len(self.failures) == 0
+
+    @property
+    def total(self):
+        """ The number of items the result covers """
+        return self.succeeded + len(self.failures)
+
+    @property
+    def failed_positions(self):
+        return [f["position"] for f in self.failures]
+
+    def add_success(self, outcome):
+        self.succeeded += 1
+        if self.keep_successes:
+            self.successes.append(outcome)
+
+    def merge(self, other, offset=0):
+        """ Fold another result into this one, shifting its positions by offset """
+        self.succeeded += other.succeeded
+        if self.keep_successes:
+            for item in other.successes:
+                self.successes.append(dict(item, position=item["position"] + offset))
+        for item in other.failures:
+            self.failures.append(dict(item, position=item["position"] + offset))
+        self.requests += other.requests
+        self.retries += other.retries
+        self.rejected += other.rejected
+        if other.response is not None:
+            self.response = other.response
+        return self
+
+    def summary(self):
+        """ Counts of what happened, with the permanent failures grouped by error type """
+        errors = {}
+        for f in self.failures:
+            error = f.get("error")
+            reason = error.get("type", str(error)) if isinstance(error, dict) else str(error)
+            errors[reason] = errors.get(reason, 0) + 1
+        return {
+            "succeeded": self.succeeded,
+            "failed": len(self.failures),
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": errors
+        }
+
+    def __repr__(self):
+        return "BulkResult({0})".format(self.summary())
+
+
+def _bulk_outcomes(resp, count):
+    """ Turn a _bulk response into a list of count item outcomes: dicts with the status, the _id and any error """
+    if resp.status_code >= 400:
+        # the whole request was refused, so every item shares its fate
+        return [{"status": resp.status_code, "_id": None, "error": resp.text} for _ in range(count)]
+
+    items = resp.json().get("items", [])
+    outcomes = []
+    for item in items:
+        action, detail = list(item.items())[0]
+        outcome = {"action": action, "status": detail.get("status"), "_id": detail.get("_id")}
+        if "error" in detail:
+            outcome["error"] = detail["error"]
+        outcomes.append(outcome)
+    if len(outcomes) != count:
+        raise BulkException("expected {0} items in bulk response, got {1}".format(count, len(outcomes)))
+    return outcomes
+
+
+def _send_bulk(connection, url, items, make_body, max_retries=3, backoff=1.0, max_backoff=30.0,
+               keep_successes=False, idempotent=False):
+    """
+    Send items to the _bulk endpoint, re-sending only the ones rejected with a retryable status, with exponential
+    backoff between attempts.
+
+    :param items: the records or ids to send; their positions are what the BulkResult reports against
+    :param make_body: function which produces the request body for a list of items
+    :param keep_successes: record the outcome of each successful item in the result, not just count them
+    :param idempotent: whether the items can safely be applied twice, so may be sent to another node if one fails
+        while they are being sent
+    :return: a BulkResult
+    """
+    result = BulkResult(keep_successes=keep_successes)
+    pending = list(range(len(items)))
+    attempt = 0
+    while len(pending) > 0:
+        if isinstance(items, _Batch):
+            batch = items.select(pending)
+        else:
+            batch = [items[p] for p in pending]
+        resp = _do_post(url, connection, data=make_body(batch), op="bulk", idempotent=idempotent)
+        result.response = resp
+        result.requests += 1
+
+        retry = []
+        for position, outcome in zip(pending, _bulk_outcomes(resp, len(pending))):
+            outcome["position"] = position
+            if outcome["status"] in RETRYABLE_BULK_STATUSES:
+                result.rejected += 1
+            if "error" not in outcome:
+                result.add_success(outcome)
+            elif outcome["status"] in RETRYABLE_BULK_STATUSES and attempt < max_retries:
+                retry.append(position)
+            else:
+                result.failures.append(outcome)
+
+        if len(retry) > 0:
+            delay = min(backoff * 2 ** attempt, max_backoff)
+            logger.info("retrying {0} of {1} bulk items in {2}s".format(len(retry), len(pending), delay))
+            time.sleep(delay)
+            result.retries += 1
+            attempt += 1
+        pending = retry
+
+    if len(result.failures) > 0:
+        logger.warning("bulk request had permanent failures: {0}".format(result.summary()))
+    return result
+
+
+class _Batch(list):
+    """ A batch of records from a Batcher, which keeps the JSON each was measured by so it isn't serialised again """
+    def __init__(self, records=None, sources=None):
+        super(_Batch, self).__init__(records if records is not None else [])
+        self.sources = sources if sources is not None else []
+
+    def append_serialised(self, record, source):
+        self.append(record)
+        self.sources.append(source)
+
+    def select(self, positions):
+        """ The batch of just the records at the given positions """
+        return _Batch([self[p] for p in positions], [self.sources[p] for p in positions])
+
+
+class Batcher(object):
+    """
+    Split a stream of records into bulk batches capped by both record count and (estimated) body size.
+
+    The plain Batcher keeps fixed caps; see AdaptiveBatcher for one which tunes its size to the cluster.
+    """
+    # allowance for the action line which accompanies each record in a bulk body
+    ACTION_OVERHEAD = 64
+
+    def __init__(self, max_records=1000, max_bytes=None):
+        self.max_records = max_records
+        self.target_bytes = max_bytes
+        self.last_bytes = 0
+
+    def batches(self, records):
+        """
+        Yield lists of records.  The size of each batch is recorded in last_bytes as it is yielded, and each record
+        is only serialised once: bulk() sends the JSON it was measured by.
+        """
+        batch = _Batch()
+        size = 0
+        for r in records:
+            source = json.dumps(r)
+            n = len(source) + self.ACTION_OVERHEAD
+            full = len(batch) >= self.max_records
+            if self.target_bytes is not None and size + n > self.target_bytes:
+                full = True
+            if full and len(batch) > 0:
+                self.last_bytes = size
+                yield batch
+                batch = _Batch()
+                size = 0
+            batch.append_serialised(r, source)
+            size += n
+        if len(batch) > 0:
+            self.last_bytes = size
+            yield batch
+
+    def chunk_size(self, max_content_length):
+        """ The number of bytes to read for the next chunk of a pre-formatted bulk file """
+        if self.target_bytes is None:
+            return max_content_length
+        return min(self.target_bytes, max_content_length)
+
+    def observe(self, latency, rejected=0, total=0, nbytes=None):
+        """ Record how the cluster handled the last batch; the fixed Batcher ignores this """
+        pass
+
+    def observe_result(self, latency, result, nbytes=None):
+        """ Record the outcome of a batch sent via bulk() or bulk_delete(), of nbytes if not the last batch yielded """
+        self.observe(latency, result.rejected, result.total, nbytes=nbytes)
+
+
+class AdaptiveBatcher(Batcher):
+    """
+    A Batcher which adjusts its byte target from the observed latency and rejection rate of each _bulk request,
+    in the manner of TCP congestion control.
+
+    While requests are fast and nothing is rejected, the target doubles until it first meets congestion and grows
+    additively thereafter.  A request slower than target_latency, or with more than max_rejection_rate of its items
+    rejected, halves the target.  The target always stays between min_bytes and max_bytes, and max_bytes should be
+    kept below the cluster's http.max_content_length.  Several threads may report their batches at once.
+    """
+    def __init__(self, max_records=10000, initial_bytes=5000000, min_bytes=500000, max_bytes=50000000,
+                 target_latency=2.0, max_rejection_rate=0.0, increase_bytes=1000000, decrease_factor=0.5):
+        super(AdaptiveBatcher, self).__init__(max_records=max_records, max_bytes=initial_bytes)
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.max_rejection_rate = max_rejection_rate
+        self.increase_bytes = increase_bytes
+        self.decrease_factor = decrease_factor
+        self.threshold = max_bytes
+        self._lock = threading.Lock()
+
+    def observe(self, latency, rejected=0, total=0, nbytes=None):
+        nbytes = self.last_bytes if nbytes is None else nbytes
+        rejection_rate = float(rejected) / total if total > 0 else 0.0
+        with self._lock:
+            self._adjust(latency, rejection_rate, nbytes)
+        logger.debug("bulk batch of {0} bytes took {1}s, {2}/{3} rejected; target now {4} bytes".format(
+            nbytes, latency, rejected, total, self.target_bytes))
+
+    def _adjust(self, latency, rejection_rate, nbytes):
+        if latency > self.target_latency or rejection_rate > self.max_rejection_rate:
+            self.threshold = max(int(self.target_bytes * self.decrease_factor), self.min_bytes)
+            self.target_bytes = self.threshold
+        elif nbytes >= self.target_bytes * self.decrease_factor:
+            # only grow if the batch actually made use of the current target, rather than being cut short by the
+            # record count or the end of the input
+            if self.target_bytes < self.threshold:
+                self.target_bytes = min(self.target_bytes * 2, self.threshold)
+            else:
+                self.target_bytes += self.increase_bytes
+        self.target_bytes = min(self.target_bytes, self.max_bytes)
+
+
+def to_bulk(records, idkey="id", index='', type_='', bulk_type="index", **kwargs):
+    return ''.join(_bulk_lines(records, idkey=idkey, index=index, type_=type_, bulk_type=bulk_type, **kwargs))
+
+
+def to_bulk_single_rec(record, idkey="id", index='', type_='', bulk_type="index", **kwargs):
+    return to_bulk([record], idkey=idkey, index=index, type_=type_, bulk_type=bulk_type, **kwargs)
+
+
+def bulk(connection, records, idkey='id', type_='', bulk_type="index", max_retries=3, backoff=1.0, batcher=None,
+         params=None, keep_successes=False, **kwargs):
+    """
+    Send records to the _bulk endpoint.  Items rejected with a retryable status (e.g. 429 when the cluster's write
+    queue is full) are re-sent on their own, up to max_retries times with exponential backoff.
 
+    :param batcher: a Batcher to split the records into several _bulk requests; otherwise they are sent in one
+    :param params: url parameters for each _bulk request, e.g. {"refresh": "wait_for"}
+    :param keep_successes: record each successful record in the result by position, rather than only counting them
+    :return: a BulkResult, recording the failures by their position in records
+    """
+    url = elasticsearch_url(connection, type_, endpoint="_bulk", params=params)
+    # every record has an id, so indexing it again just overwrites it with the same thing
+    idempotent = bulk_type in IDEMPOTENT_BULK_TYPES
+
+    def make_body(items):
+        return BulkBody(items, idkey=idkey, bulk_type=bulk_type, **kwargs)
+
+    if batcher is None:
+        records = records if isinstance(records, list) else list(records)
+        return _send_bulk(connection, url, records, make_body, max_retries=max_retries, backoff=backoff,
+                          keep_successes=keep_successes, idempotent=idempotent)
+
+    result = BulkResult(keep_successes=keep_successes)
+    offset = 0
+    for batch in batcher.batches(records):
+        start = time.time()
+        batch_result = _send_bulk(connection, url, batch, make_body, max_retries=max_retries, backoff=backoff,
+                                  keep_successes=keep_successes, idempotent=idempotent)
+        batcher.observe_result(time.time() - start, batch_result)
+        result.merge(batch_result, offset=offset)
+        offset += len(batch)
+    return result
+
+
+def bulk_actions(connection, actions, type_='', max_retries=3, backoff=1.0, params=None, keep_successes=False):
+    """
+    Send a mixture of actions to the _bulk endpoint in one request, retrying rejected items as bulk() does.
 
-def raw_bulk(connection, data, type=""):
+    :param actions: a list of (bulk_type, id, record) tuples, e.g. ("index", "abc", {...}) or ("delete", "abc", None)
+    :param keep_successes: record each successful action in the result by position, rather than only counting them
+    :return: a BulkResult, recording the failures by their position in actions
+    """
+    url = elasticsearch_url(connection, type_, endpoint="_bulk", params=params)
+    actions = actions if isinstance(actions, list) else list(actions)
+    idempotent = all([a[0] in IDEMPOTENT_BULK_TYPES and a[1] is not None for a in actions])
+    return _send_bulk(connection, url, actions, BulkActionsBody, max_retries=max_retries, backoff=backoff,
+                      keep_successes=keep_successes, idempotent=idempotent)
+
+
+def raw_bulk(connection, data, type="", idempotent=False):
+    """
+    Send pre-formatted bulk data to the _bulk endpoint
+
+    :param idempotent: whether the data can safely be applied twice (e.g. it only indexes and deletes by id), so may
+        be sent to another node if one fails while it is being sent
+    """
     url = elasticsearch_url(connection, type, endpoint="_bulk")
-    resp = _do_post(url, connection, data=data)
+    resp = _do_post(url, connection, data=data, op="bulk", idempotent=idempotent)
     return resp
 
 
@@ -490,25 +1364,71 @@ def delete(connection, type=None, id=None):
 
 
 def delete_by_query(connection, type, query, es_version=DEFAULT_VERSION):
+    if versions.delete_by_query_api(es_version):
+        url = elasticsearch_url(connection, type, endpoint="_delete_by_query")
+        return _do_post(url, connection, data=json.dumps(query), op="delete_by_query")
+
     url = elasticsearch_url(connection, type, endpoint="_query")
     if "query" in query and es_version.startswith("0.9"):
         # we have to unpack the query, as the endpoint covers that
         query = query["query"]
-    resp = _do_delete(url, connection, data=json.dumps(query))
+    resp = _do_delete(url, connection, data=json.dumps(query), op="delete_by_query")
     return resp
 
 
 def to_bulk_del(ids):
-    data = ''
-    for i in ids:
-        data += json.dumps({'delete': {'_id': i}}) + '\n'
-    return data
+    return ''.join(_bulk_del_lines(ids))
 
 
-def bulk_delete(connection, type, ids):
-    data = to_bulk_del(ids)
+def bulk_delete(connection, type, ids, max_retries=3, backoff=1.0):
+    """
+    Delete records by id via the _bulk endpoint, retrying rejected items as per bulk()
+
+    :return: a BulkResult, recording the outcome of each delete by its position in ids
+    """
+    ids = ids if isinstance(ids, list) else list(ids)
     url = elasticsearch_url(connection, type, endpoint="_bulk")
-    resp = _do_post(url, connection, data=data)
+    return _send_bulk(connection, url, ids, BulkDeleteBody, max_retries=max_retries, backoff=backoff,
+                      idempotent=True)
+
+
+##############################################################
+# Cluster information
+
+def cluster_info(connection):
+    """ Get the basic information about the cluster: its name, cluster_uuid and version """
+    url = elasticsearch_url(connection, omit_index=True)
+    resp = _do_get(url, connection)
+    return resp
+
+
+##############################################################
+# Reindex and tasks
+
+def reindex(connection, body, params=None):
+    """
+    Ask the cluster to copy documents from one index to another itself.  By default the work is sliced automatically
+    and the request returns straight away with a task id, whose progress can be followed with get_task
+    """
+    url_params = {"slices": "auto", "wait_for_completion": "false"}
+    if params is not None:
+        url_params.update(params)
+    url = elasticsearch_url(connection, endpoint="_reindex", params=url_params, omit_index=True)
+    resp = _do_post(url, connection, data=json.dumps(body), op="reindex")
+    return resp
+
+
+def get_task(connection, task_id):
+    url = elasticsearch_url(connection, endpoint="_tasks/" + task_id, omit_index=True)
+    resp = _do_get(url, connection, op="tasks")
+    return resp
+
+
+def cluster_health(connection, type=None, params=None):
+    """ Get the health of the connection's index (or the type's index), e.g. with params {"wait_for_status": "yellow"} """
+    url = elasticsearch_url(connection, endpoint="_cluster/health/" + ",".join(index_names(connection, type)),
+                            params=params, omit_index=True)
+    resp = _do_get(url, connection, op="health")
     return resp
 
 
@@ -517,7 +1437,7 @@ def bulk_delete(connection, type, ids):
 
 def refresh(connection, type):
     url = elasticsearch_url(connection, type=type, endpoint="_refresh")
-    resp = _do_post(url, connection)
+    resp = _do_post(url, connection, idempotent=True)
     return resp
 
 
@@ -561,6 +1481,14 @@ def list_types(connection):
 ###############################################################
 # Support for index-per-type
 
+def index_names(connection, type=None):
+    """ The names of the indexes that requests for the type go to on this connection """
+    if type is not None and connection.index_per_type:
+        return type_to_index(connection, type)
+    index = connection.index
+    return index if isinstance(index, list) else [index]
+
+
 def type_to_index(connection, typ):
     if typ is not None:
         if type(typ) != list:
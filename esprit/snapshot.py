@@ -1,7 +1,6 @@
-from esprit.raw import elasticsearch_url
+from esprit.raw import elasticsearch_url, _do_get, _do_put, _do_delete
 
 from datetime import datetime, timedelta
-import requests
 
 
 class BadSnapshotMetaException(Exception):
@@ -48,6 +47,7 @@ class ESSnapshotsClient(object):
         :param snapshot_repository: the S3 repo identifier defined in the snapshot settings
         """
         self.snapshots = []
+        self.connection = connection
         # Replace the existing connection's index with the snapshot one
         connection.index = '_snapshot'
         self.snapshots_url = elasticsearch_url(connection, type=snapshot_repository)
@@ -59,7 +59,7 @@ class ESSnapshotsClient(object):
         :return: The status code of the response
         """
         name = snapshot_name if snapshot_name is not None else datetime.strftime(datetime.utcnow(), "%Y-%m-%d_%H%Mz")
-        resp = requests.put(self.snapshots_url + '/' + name, timeout=600)
+        resp = _do_put(self.snapshots_url + '/' + name, self.connection, timeout=600)
         return resp
 
     def list_snapshots(self):
@@ -70,7 +70,7 @@ class ESSnapshotsClient(object):
 
         # If the client doesn't have the snapshots, ask ES for them
         if not self.snapshots:
-            resp = requests.get(self.snapshots_url + '/_all', timeout=600)
+            resp = _do_get(self.snapshots_url + '/_all', self.connection, timeout=600)
 
             if 'snapshots' in resp.json():
                 try:
@@ -97,7 +97,7 @@ class ESSnapshotsClient(object):
         :param snapshot: An ESSnapshot object
         :return: The status code of the response to our delete request
         """
-        resp = requests.delete(self.snapshots_url + '/' + snapshot.name, timeout=600)
+        resp = _do_delete(self.snapshots_url + '/' + snapshot.name, self.connection, timeout=600)
         return resp
 
     def prune_snapshots(self, ttl_days, delete_callback=None):
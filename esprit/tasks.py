@@ -1,6 +1,7 @@
-from esprit import raw, models
-import json, sys, time, os
-from functools import reduce
+from esprit import raw, models, util, versions
+import json, sys, time, os, base64, collections, hashlib, queue, threading, multiprocessing
+import concurrent.futures
+import array, bisect, copy as copy_, io, itertools, mmap, shutil
 
 
 class ScrollException(Exception):
@@ -15,187 +16,1434 @@ class ScrollTimeoutException(ScrollException):
     pass
 
 
-def bulk_load(conn, type, source_file, limit=None, max_content_length=100000000):
-    source_size = os.path.getsize(source_file)
-    with open(source_file, "r") as f:
-        if limit is None and source_size < max_content_length:
-            # if we aren't selecting a portion of the file, and the file is below the max content length, then
-            # we can just serve it directly
-            raw.raw_bulk(conn, f, type)
-            return -1
-        else:
-            count = 0
-            while True:
-                chunk = _make_next_chunk(f, max_content_length)
-                if chunk == "":
-                    break
+class PointInTimeException(Exception):
+    pass
 
-                finished = False
-                if limit is not None:
-                    newlines = chunk.count("\n")
-                    records = newlines // 2
-                    if count + records > limit:
-                        max = (limit - count) * 2
-                        lines = chunk.split("\n")
-                        allowed = lines[:max]
-                        chunk = "\n".join(allowed) + "\n"
-                        count += max
-                        finished = True
-                    else:
-                        count += records
-
-                resp = raw.raw_bulk(conn, chunk, type)
-                if resp.status_code != 200:
-                    raise Exception("did not get expected response: " + str(resp.status_code) + " - " + resp.text)
-                if finished:
-                    break
-            if limit is not None:
-                return count
-            else:
-                return -1
 
+class SearchException(Exception):
+    """ A search failed, even after retrying, so its results can't be relied on to be complete """
+    pass
 
-def make_bulk_chunk_files(source_file, out_file_prefix, max_content_length=100000000):
+
+class ReindexException(Exception):
+    pass
+
+
+class ReindexRemoteException(ReindexException):
+    """ The cluster was unable to reindex from a remote source, e.g. because it can't reach it """
+    pass
+
+
+def bulk_load(conn, type, source_file, limit=None, max_content_length=100000000, batcher=None, concurrency=1,
+              start=0, save_index=False):
+    """
+    Load a file of pre-formatted bulk data into the index.
+
+    The file may be gzip or zstd compressed (going by its extension), in which case it is decompressed as it is read
+    rather than indexed and memory-mapped.  The file is sent in chunks which each end on a record boundary, by up to
+    concurrency requests at a time.  The outcome of every chunk is combined, and if any chunk or record failed a
+    single BulkLoadException is raised once the whole file has been sent.
+
+    :param limit: the maximum number of records to load, from start
+    :param max_content_length: the largest request body to send, which must be within the cluster's
+        http.max_content_length
+    :param batcher: a raw.Batcher (e.g. raw.AdaptiveBatcher) to size each chunk, within max_content_length
+    :param concurrency: the number of chunks to send at once
+    :param start: the number of records at the start of the file to skip, e.g. to resume a failed load
+    :param save_index: keep the file's BulkFileIndex beside it, so later loads of the same file don't re-scan it
+    :return: the number of records loaded if a limit was given, otherwise -1
+    """
+    if batcher is None:
+        batcher = raw.Batcher()
     source_size = os.path.getsize(source_file)
-    with open(source_file, "r") as f:
-        if source_size < max_content_length:
-            return [source_file]
-        else:
-            filenames = []
-            count = 0
-            while True:
-                count += 1
-                chunk = _make_next_chunk(f, max_content_length)
-                if chunk == "":
-                    break
+    compressed = util.compression_for(source_file) is not None
+    if not compressed and limit is None and start == 0 and source_size < batcher.chunk_size(max_content_length):
+        # if we aren't selecting a portion of the file, and the file is below the max content length, then
+        # we can just serve it directly
+        with open(source_file, "rb") as f:
+            resp = raw.raw_bulk(conn, f, type)
+        _raise_for_bulk_load(*_combine_chunk_results([(0, 0) + _chunk_result(resp)]))
+        return -1
+
+    if compressed:
+        with util.open_file(source_file, "rb") as f:
+            chunks = _stream_chunks(f, batcher, max_content_length, start, limit)
+            outcomes = _send_chunks(conn, type, chunks, batcher, concurrency)
+    else:
+        index = BulkFileIndex.for_file(source_file, save=save_index)
+        with index.mapped() as mm:
+            chunks = _bulk_load_chunks(index, mm, batcher, max_content_length, start, limit)
+            outcomes = _send_chunks(conn, type, chunks, batcher, concurrency)
+    result, chunk_failures = _combine_chunk_results(outcomes)
+    _raise_for_bulk_load(result, chunk_failures)
+
+    if limit is not None:
+        return result.succeeded
+    else:
+        return -1
 
-                filename = out_file_prefix + "." + str(count)
-                with open(filename, "w") as g:
-                    g.write(chunk)
-                filenames.append(filename)
 
-            return filenames
+class BulkLoadException(Exception):
+    """
+    Raised when some part of a bulk load failed.  result is the raw.BulkResult over all the records sent, with
+    positions counted from the start of the file, and chunk_failures lists the chunks which were refused outright.
+    """
+    def __init__(self, message, result, chunk_failures):
+        super(BulkLoadException, self).__init__(message)
+        self.result = result
+        self.chunk_failures = chunk_failures
 
 
-def _make_next_chunk(f, max_content_length):
+def _blank_line(mm, start, end):
+    # only a line which starts with whitespace has to be looked at in full to see if it is blank
+    return start == end or (mm[start] in b" \t\r\x0b\x0c" and mm[start:end].strip() == b"")
 
-    def is_command(line):
+
+class BulkFileIndex(object):
+    """
+    The byte offset at which each record (an action line, and its source line if it has one) starts in a file of
+    bulk data.  The file is scanned once, forwards, and only the action lines are parsed; after that any run of
+    records can be sliced out of the file by its byte range.
+    """
+    SUFFIX = ".idx"
+
+    def __init__(self, path, offsets, size, mtime):
+        self.path = path
+        self.offsets = offsets
+        self.size = size
+        self.mtime = mtime
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def scan(cls, path):
+        if util.compression_for(path) is not None:
+            raise ValueError("can't index the compressed file {0}; it has to be read as a stream".format(path))
+        offsets = array.array("Q")
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    cls._scan(mm, stat.st_size, offsets)
+        return cls(path, offsets, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def _scan(mm, size, offsets):
+        pos = 0
+        action = True
+        while pos < size:
+            end = mm.find(b"\n", pos)
+            if end == -1:
+                end = size
+            if not _blank_line(mm, pos, end):
+                if action:
+                    offsets.append(pos)
+                    # a delete is the only action without a source line following it
+                    action = _bulk_action(mm[pos:end], "byte {0}".format(pos)) == "delete"
+                else:
+                    # source lines are stepped over without being copied out of the map
+                    action = True
+            pos = end + 1
+
+    @classmethod
+    def load(cls, path, index_path=None):
+        """ Read the saved index for the file, or return None if there isn't one or the file has changed since """
+        index_path = index_path if index_path is not None else path + cls.SUFFIX
+        if not os.path.exists(index_path):
+            return None
+        stat = os.stat(path)
+        with open(index_path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("size") != stat.st_size or header.get("mtime") != stat.st_mtime_ns:
+                return None
+            offsets = array.array("Q")
+            offsets.frombytes(f.read())
+        return cls(path, offsets, header["size"], header["mtime"])
+
+    @classmethod
+    def for_file(cls, path, save=False):
+        """ Use the saved index for the file if it is up to date, otherwise scan it (and save the result if asked) """
+        index = cls.load(path)
+        if index is None:
+            index = cls.scan(path)
+            if save:
+                index.save()
+        return index
+
+    def save(self, index_path=None):
+        index_path = index_path if index_path is not None else self.path + self.SUFFIX
+        tmp = index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps({"size": self.size, "mtime": self.mtime, "records": len(self)}).encode("utf-8") + b"\n")
+            f.write(self.offsets.tobytes())
+        os.replace(tmp, index_path)
+        return index_path
+
+    def mapped(self):
+        """ Memory-map the file for reading, for use as a context manager """
+        f = open(self.path, "rb")
         try:
-            command = json.loads(line)
-        except (json.JSONDecodeError, TypeError):
-            return False
-        keys = list(command.keys())
-        if len(keys) > 1:
-            return False
-        if "index" not in keys:
-            return False
-        subkeys = list(command["index"].keys())
-        for sk in subkeys:
-            if sk not in ["_id"]:
-                return False
+            if self.size == 0:
+                return _EmptyMap(f)
+            return _ClosingMap(f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except Exception:
+            f.close()
+            raise
+
+    def byte_range(self, first, last):
+        """ The (start, end) bytes of records first up to (but not including) last """
+        start = self.offsets[first]
+        end = self.offsets[last] if last < len(self.offsets) else self.size
+        return start, end
+
+    def chunk_end(self, first, max_bytes, last=None):
+        """
+        The record after the largest run starting at first which fits in max_bytes, and no further than last.  A
+        single record which is larger than max_bytes on its own is given a chunk to itself.
+        """
+        last = len(self.offsets) if last is None else min(last, len(self.offsets))
+        ceiling = self.offsets[first] + max_bytes
+        if self.byte_range(first, last)[1] <= ceiling:
+            return last
+        # the records which start within the ceiling are the ones which end within it, bar the last of them
+        end = bisect.bisect_right(self.offsets, ceiling, first + 1, last) - 1
+        return max(end, first + 1)
+
+    def chunks(self, max_bytes, start=0, limit=None):
+        """ Yield the (first, last) records of each chunk in turn, from start and up to limit records """
+        last = len(self.offsets) if limit is None else min(len(self.offsets), start + limit)
+        first = start
+        while first < last:
+            end = self.chunk_end(first, max_bytes, last)
+            yield first, end
+            first = end
+
+
+def _bulk_action(line, where):
+    try:
+        action = json.loads(line)
+    except ValueError:
+        action = None
+    if not isinstance(action, dict) or len(action) != 1:
+        raise ValueError("expected a bulk action at {0}, got {1!r}".format(where, line[:100]))
+    return list(action.keys())[0]
+
+
+class _ClosingMap(object):
+    def __init__(self, f, mm):
+        self.f = f
+        self.mm = mm
+
+    def __enter__(self):
+        return self.mm
+
+    def __exit__(self, *args):
+        self.mm.close()
+        self.f.close()
 
-        return True
 
-    offset = f.tell()
-    chunk = f.read(max_content_length)
-    while True:
-        last_newline = chunk.rfind("\n")
-        tail = chunk[last_newline + 1:]
-        chunk = chunk[:last_newline]
-
-        if is_command(tail):
-            f.seek(offset + last_newline)
-            if chunk.startswith("\n"):
-                chunk = chunk[1:]
-            return chunk
+class _EmptyMap(_ClosingMap):
+    def __init__(self, f):
+        super(_EmptyMap, self).__init__(f, None)
+
+    def __enter__(self):
+        return b""
+
+    def __exit__(self, *args):
+        self.f.close()
+
+
+class _MappedRange(object):
+    """
+    A read-only file over a byte range of a memory-mapped file, so that a chunk can be sent as a request body a block
+    at a time rather than copied out whole.  A newline is added at the end if the range doesn't have one, as _bulk
+    requires.
+    """
+    def __init__(self, mm, start, end):
+        self.mm = mm
+        self.start = start
+        self.end = end
+        self.suffix = b"" if end > start and mm[end - 1:end] == b"\n" else b"\n"
+        self.pos = 0
+
+    def __len__(self):
+        return self.end - self.start + len(self.suffix)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self)
+        self.pos = max(0, min(offset, len(self)))
+        return self.pos
+
+    def read(self, size=-1):
+        remaining = len(self) - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        body_len = self.end - self.start
+        data = b""
+        if self.pos < body_len:
+            take = min(size, body_len - self.pos)
+            data = self.mm[self.start + self.pos:self.start + self.pos + take]
+        if len(data) < size:
+            suffix_pos = max(0, self.pos + len(data) - body_len)
+            data += self.suffix[suffix_pos:suffix_pos + size - len(data)]
+        self.pos += len(data)
+        return data
+
+
+def _bulk_load_chunks(index, mm, batcher, max_content_length, start=0, limit=None):
+    """ Yield (offset, chunk) for each record-aligned chunk of the file, where offset is the number of records before
+    the chunk """
+    last = len(index) if limit is None else min(len(index), start + limit)
+    first = start
+    while first < last:
+        # ask the batcher each time, as it may resize the chunks as it goes
+        end = index.chunk_end(first, batcher.chunk_size(max_content_length), last)
+        yield first, _MappedRange(mm, *index.byte_range(first, end))
+        first = end
+
+
+def _read_bulk_records(f):
+    """ Yield each record (its action line, and its source line if it has one) from a stream of bulk data """
+    action = None
+    for n, line in enumerate(f):
+        if line.strip() == b"":
+            continue
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        if action is not None:
+            yield action + line
+            action = None
+        elif _bulk_action(line, "line {0}".format(n + 1)) == "delete":
+            yield line
         else:
+            action = line
+    if action is not None:
+        yield action
+
+
+def _stream_chunks(f, batcher, max_content_length, start=0, limit=None):
+    """ Yield (offset, chunk) for each record-aligned chunk read from a stream of bulk data, as _bulk_load_chunks """
+    records = itertools.islice(_read_bulk_records(f), start, start + limit if limit is not None else None)
+    ceiling = batcher.chunk_size(max_content_length)
+    chunk = []
+    size = 0
+    first = start
+    for n, record in enumerate(records, start):
+        if len(chunk) > 0 and size + len(record) > ceiling:
+            yield first, b"".join(chunk)
+            first, chunk, size = n, [], 0
+            ceiling = batcher.chunk_size(max_content_length)
+        chunk.append(record)
+        size += len(record)
+    if len(chunk) > 0:
+        yield first, b"".join(chunk)
+
+
+def _chunk_result(resp):
+    """
+    Reduce a chunk's _bulk response to (BulkResult, None), or (None, failure) if the whole chunk was refused.  The
+    result holds only the counts and failures, and not the response with its item for every record
+    """
+    if resp.status_code != 200:
+        return None, {"status": resp.status_code, "error": resp.text}
+    result = raw.BulkResult.from_response(resp)
+    result.response = None
+    return result, None
+
+
+def _send_chunk(conn, type, chunk, batcher):
+    start = time.time()
+    resp = raw.raw_bulk(conn, chunk, type)
+    result, failure = _chunk_result(resp)
+    if result is not None:
+        batcher.observe(time.time() - start, result.rejected, result.total, nbytes=len(chunk))
+    return result, failure
+
+
+def _send_chunks(conn, type, chunks, batcher, concurrency=1):
+    """
+    Send the chunks with up to concurrency in flight at once, returning (chunk number, offset, result, failure) for
+    each, as from _chunk_result
+    """
+    outcomes = []
+    if concurrency <= 1:
+        for n, (offset, chunk) in enumerate(chunks):
+            outcomes.append((n, offset) + _send_chunk(conn, type, chunk, batcher))
+        return outcomes
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+        for n, (offset, chunk) in enumerate(chunks):
+            # don't read further ahead in the file than we can send
+            if len(in_flight) >= concurrency:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    outcomes.append(in_flight.pop(future) + future.result())
+            in_flight[executor.submit(_send_chunk, conn, type, chunk, batcher)] = (n, offset)
+        for future in concurrent.futures.as_completed(in_flight):
+            outcomes.append(in_flight[future] + future.result())
+    return sorted(outcomes, key=lambda o: o[0])
+
+
+def _combine_chunk_results(outcomes):
+    result = raw.BulkResult()
+    chunk_failures = []
+    for n, offset, chunk_result, failure in outcomes:
+        if failure is not None:
+            chunk_failures.append(dict(failure, chunk=n, offset=offset))
             continue
+        result.merge(chunk_result, offset=offset)
+    return result, chunk_failures
+
+
+def _raise_for_bulk_load(result, chunk_failures):
+    if len(chunk_failures) == 0 and result.ok:
+        return
+    raise BulkLoadException("Bulk load failed; {0} chunks refused, {1} records failed: {2}".format(
+        len(chunk_failures), len(result.failures), result.summary()), result, chunk_failures)
+
+
+def make_bulk_chunk_files(source_file, out_file_prefix, max_content_length=100000000, save_index=False,
+                          compression=None):
+    """
+    Split a file of bulk data into files of no more than max_content_length (uncompressed) bytes, each ending on a
+    record boundary.
+
+    :param compression: util.GZIP or util.ZSTD to compress the chunk files with; by default they are compressed the
+        same way as the source file
+    :return: the list of file names, which is just the source file if it is small enough already
+    """
+    source_compression = util.compression_for(source_file)
+    compression = compression if compression is not None else source_compression
+    source_size = os.path.getsize(source_file)
+    if source_compression is None and compression is None and source_size < max_content_length:
+        return [source_file]
 
+    filenames = []
+
+    def write(count, data):
+        filename = util.compressed_name(out_file_prefix + "." + str(count), compression)
+        with util.open_file(filename, "wb", compression) as g:
+            shutil.copyfileobj(data, g)
+        filenames.append(filename)
+
+    if source_compression is not None:
+        with util.open_file(source_file, "rb") as f:
+            for count, (_, chunk) in enumerate(_stream_chunks(f, raw.Batcher(), max_content_length), 1):
+                write(count, io.BytesIO(chunk))
+    else:
+        index = BulkFileIndex.for_file(source_file, save=save_index)
+        with index.mapped() as mm:
+            for count, (first, last) in enumerate(index.chunks(max_content_length), 1):
+                write(count, _MappedRange(mm, *index.byte_range(first, last)))
+    return filenames
 
-def copy(source_conn, source_type, target_conn, target_type, limit=None, batch_size=1000, method="POST", q=None):
+
+def copy(source_conn, source_type, target_conn, target_type, limit=None, batch_size=1000, method="POST", q=None,
+         batcher=None, pit=None, writers=None, transform=None, progress_callback=None, checkpoint=None,
+         tiebreaker=None):
+    """
+    Copy records from one index/type to another via the _bulk endpoint.
+
+    :param batch_size: the number of records to read per page, and to write per batch if no batcher is given
+    :param batcher: a raw.Batcher (e.g. raw.AdaptiveBatcher) to decide the size of each batch written
+    :param pit: a PointInTime on the source to copy from, or True to open one for the copy
+    :param writers: if given, run the copy as a CopyPipeline with this many concurrent bulk writers, so that reading
+        from the source overlaps with writing to the target
+    :param transform: function to apply to each record before it is written; it may return None to skip the record
+    :param progress_callback: function called with the CopyStats after each batch is written
+    :param checkpoint: a Checkpoint (or the path of one) to record the position of the last record written in.  If it
+        holds the state of an earlier run of the same copy, the copy carries on from there.  This can't be used
+        with a point in time, and needs a tiebreaker
+    :param tiebreaker: a unique, sortable field of the source records to page through them in order of, such as a
+        keyword copy of the id.  Without one (or a pit), the source is read from a point in time if it is on ES 7.12
+        or later (see iterate)
+    :return: a raw.BulkResult covering every record copied, with positions counted from the start of the copy (or
+        of this run of it, if resumed from a checkpoint)
+    """
     if q is None:
         q = models.QueryBuilder.match_all()
-    batch = []
-    for r in iterate(source_conn, source_type, q, page_size=batch_size, limit=limit, method=method):
-        batch.append(r)
-        if len(batch) >= batch_size:
-            print("writing batch of", len(batch))
-            raw.bulk(target_conn, batch, type_=target_type)
-            batch = []
-    if len(batch) > 0:
-        print("writing batch of", len(batch))
-        raw.bulk(target_conn, batch, type_=target_type)
-
-
-def scroll(conn, type, q=None, page_size=1000, limit=None, keepalive="10m", scan=False):
+    if batcher is None:
+        batcher = raw.Batcher(max_records=batch_size)
+    if checkpoint is not None:
+        if pit not in (None, False) or tiebreaker is None:
+            raise ValueError("a checkpointed copy needs a tiebreaker field for its position to make sense to a later "
+                             "run, and so can't read from a point in time")
+        checkpoint = Checkpoint.of(checkpoint)
+
+    if writers is not None:
+        pipeline = CopyPipeline(source_conn, source_type, target_conn, target_type, q=q, limit=limit,
+                                batch_size=batch_size, method=method, batcher=batcher, pit=pit, writers=writers,
+                                transform=transform, progress_callback=progress_callback, checkpoint=checkpoint,
+                                tiebreaker=tiebreaker)
+        result = pipeline.run()
+        raw.logger.info("copy finished: {0}".format(pipeline.stats.summary()))
+        if not result.ok:
+            raw.logger.warning("copy finished with failures: {0}".format(result.summary()))
+        if checkpoint is not None:
+            checkpoint.clear()
+        return result
+
+    stats = CopyStats()
+    result = raw.BulkResult()
+    copied = 0
+    if checkpoint is not None:
+        records = _Cursors(source_conn, source_type, q, batch_size, limit, method, tiebreaker, checkpoint.state,
+                           transform)
+    else:
+        records = _read(source_conn, source_type, q, page_size=batch_size, limit=limit, method=method, pit=pit,
+                        tiebreaker=tiebreaker)
+        if transform is not None:
+            records = _transformed(records, transform)
+    for batch in batcher.batches(records):
+        stats.add_read(len(batch))
+        start = time.time()
+        batch_result = raw.bulk(target_conn, batch, type_=target_type)
+        batcher.observe_result(time.time() - start, batch_result)
+        stats.add_written(batch_result, batcher.last_bytes)
+        result.merge(batch_result, offset=copied)
+        copied += len(batch)
+        if checkpoint is not None:
+            checkpoint.save(records.take(len(batch)))
+        if progress_callback is not None:
+            progress_callback(stats)
+
+    raw.logger.info("copy finished: {0}".format(stats.summary()))
+    if not result.ok:
+        raw.logger.warning("copy finished with failures: {0}".format(result.summary()))
+    if checkpoint is not None:
+        checkpoint.clear()
+    return result
+
+
+class _Cursors(object):
+    """
+    Iterate the records of a query with search_after, from the position in a checkpoint state, keeping the cursor
+    after each record handed on.  Whoever consumes the records may read ahead of what they have finished with
+    (as Batcher.batches does), so take(n) gives the checkpoint state as of the next n records finished with.
+    """
+    def __init__(self, conn, type, q, page_size, limit, method, tiebreaker, state=None, transform=None):
+        state = state if state is not None else {}
+        self.read = state.get("read", 0)
+        if limit is not None:
+            limit = max(int(limit) - self.read, 0)
+        self.records = iterate(conn, type, q, page_size=page_size, limit=limit, method=method,
+                               cursor=state.get("cursor"), tiebreaker=tiebreaker)
+        self.transform = transform
+        self.cursor = state.get("cursor")
+        self._pending = collections.deque()
+
+    def __iter__(self):
+        try:
+            for record in self.records:
+                self.read += 1
+                if self.transform is not None:
+                    record = self.transform(record)
+                    if record is None:
+                        continue
+                self._pending.append((self.records.cursor, self.read))
+                yield record
+        finally:
+            self.records.close()
+
+    def take(self, n):
+        for _ in range(n):
+            self.cursor, read = self._pending.popleft()
+        return {"cursor": self.cursor, "read": read}
+
+    def close(self):
+        self.records.close()
+
+
+class _Watermark(object):
+    """ The state after the last of a sequence of batches which have all completed, when they complete out of order """
+    def __init__(self):
+        self.state = None
+        self._next = 0
+        self._completed = {}
+        self._lock = threading.Lock()
+
+    def complete(self, seq, state):
+        """ Mark batch seq as complete, and return the state as of the furthest batch before which all are complete """
+        with self._lock:
+            self._completed[seq] = state
+            while self._next in self._completed:
+                self.state = self._completed.pop(self._next)
+                self._next += 1
+            return self.state
+
+
+def _transformed(records, transform):
+    for r in records:
+        r = transform(r)
+        if r is not None:
+            yield r
+
+
+class CopyStats(object):
+    """ Running throughput figures for a copy """
+    def __init__(self):
+        self.started = time.time()
+        self.read = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add_read(self, n):
+        with self._lock:
+            self.read += n
+
+    def add_written(self, result, nbytes=0):
+        with self._lock:
+            self.written += result.succeeded
+            self.failed += len(result.failures)
+            self.batches += 1
+            self.bytes += nbytes
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def records_per_second(self):
+        elapsed = self.elapsed
+        return self.written / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_second(self):
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return {
+            "read": self.read,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "bytes": self.bytes,
+            "elapsed": round(self.elapsed, 3),
+            "records_per_second": round(self.records_per_second, 1),
+            "bytes_per_second": round(self.bytes_per_second, 1)
+        }
+
+    def __str__(self):
+        return str(self.summary())
+
+
+class CopyPipeline(object):
+    """
+    A copy from one index/type to another, in stages connected by bounded queues:
+
+    * a reader, which pages through the source and groups the records into batches
+    * an optional transform, applied to each record (returning None drops the record)
+    * several writers, each sending batches to the target's _bulk endpoint concurrently
+
+    The queues hold at most queue_batches batches each, so a slow target holds back the reader rather than letting
+    records pile up in memory.  If any stage fails, the others stop and the error is raised from run().
+    """
+    def __init__(self, source_conn, source_type, target_conn, target_type, q=None, limit=None, batch_size=1000,
+                 method="POST", batcher=None, pit=None, writers=4, transform=None, queue_batches=None,
+                 progress_callback=None, prefetch=1, checkpoint=None, tiebreaker=None):
+        self.source_conn = source_conn
+        self.source_type = source_type
+        self.target_conn = target_conn
+        self.target_type = target_type
+        self.q = q if q is not None else models.QueryBuilder.match_all()
+        self.limit = limit
+        self.batch_size = batch_size
+        self.method = method
+        self.batcher = batcher if batcher is not None else raw.Batcher(max_records=batch_size)
+        self.pit = pit
+        self.writers = writers
+        self.transform = transform
+        self.queue_batches = queue_batches if queue_batches is not None else writers * 2
+        self.progress_callback = progress_callback
+        self.prefetch = prefetch
+        self.checkpoint = checkpoint
+        self.tiebreaker = tiebreaker
+
+        self.stats = CopyStats()
+        self.result = raw.BulkResult()
+        self._result_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._errors = []
+        self._watermark = _Watermark()
+
+    def run(self):
+        read_queue = queue.Queue(maxsize=self.queue_batches)
+        write_queue = queue.Queue(maxsize=self.queue_batches) if self.transform is not None else read_queue
+
+        stages = [threading.Thread(target=self._stage, args=(self._read, read_queue), daemon=True)]
+        if self.transform is not None:
+            stages.append(threading.Thread(target=self._stage, args=(self._transform, read_queue, write_queue),
+                                           daemon=True))
+        stages += [threading.Thread(target=self._stage, args=(self._write, write_queue), daemon=True)
+                   for _ in range(self.writers)]
+
+        for t in stages:
+            t.start()
+        for t in stages:
+            t.join()
+
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        return self.result
+
+    def _stage(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _put(self, out, item):
+        if not _put_unless_stopped(out, item, self._stop):
+            raise _PipelineStopped()
+
+    def _get(self, inq):
+        while not self._stop.is_set():
+            try:
+                return inq.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        raise _PipelineStopped()
+
+    def _read(self, out):
+        if self.checkpoint is not None:
+            records = _Cursors(self.source_conn, self.source_type, self.q, self.batch_size, self.limit, self.method,
+                               self.tiebreaker, self.checkpoint.state)
+        else:
+            records = _read(self.source_conn, self.source_type, self.q, page_size=self.batch_size, limit=self.limit,
+                            method=self.method, prefetch=self.prefetch, pit=self.pit, tiebreaker=self.tiebreaker)
+        try:
+            offset = 0
+            for seq, batch in enumerate(self.batcher.batches(records)):
+                self.stats.add_read(len(batch))
+                # each batch carries the checkpoint state to save once it, and all the batches before it, are written
+                mark = (seq, records.take(len(batch))) if self.checkpoint is not None else None
+                self._put(out, (offset, batch, self.batcher.last_bytes, mark))
+                offset += len(batch)
+        except _PipelineStopped:
+            return
+        finally:
+            records.close()
+
+        # one end marker for each stage which reads from this queue
+        consumers = 1 if self.transform is not None else self.writers
+        for _ in range(consumers):
+            self._put(out, None)
+
+    def _transform(self, inq, out):
+        try:
+            offset = 0
+            while True:
+                item = self._get(inq)
+                if item is None:
+                    break
+                batch = [t for t in (self.transform(r) for r in item[1]) if t is not None]
+                if len(batch) == 0:
+                    self._completed(item[3])
+                    continue
+                self._put(out, (offset, batch, item[2], item[3]))
+                offset += len(batch)
+            for _ in range(self.writers):
+                self._put(out, None)
+        except _PipelineStopped:
+            return
+
+    def _write(self, inq):
+        try:
+            while True:
+                item = self._get(inq)
+                if item is None:
+                    break
+                offset, batch, nbytes, mark = item
+                start = time.time()
+                batch_result = raw.bulk(self.target_conn, batch, type_=self.target_type)
+                self.batcher.observe_result(time.time() - start, batch_result, nbytes=nbytes)
+                self.stats.add_written(batch_result, nbytes)
+                with self._result_lock:
+                    self.result.merge(batch_result, offset=offset)
+                self._completed(mark)
+                if self.progress_callback is not None:
+                    self.progress_callback(self.stats)
+        except _PipelineStopped:
+            return
+
+    def _completed(self, mark):
+        if mark is None:
+            return
+        state = self._watermark.complete(*mark)
+        if state is not None:
+            self.checkpoint.save(state)
+
+
+class _PipelineStopped(Exception):
+    """ Raised within a pipeline stage when another stage has failed """
+    pass
+
+
+def scroll_pages(conn, type, q=None, page_size=1000, keepalive="10m", scan=False, slice_id=None, slices=None):
+    """
+    Scroll through the results of a query, yielding each page of records as a list
+
+    :param slice_id: with slices, the slice of the results to scroll through
+    :param slices: the number of slices the results are divided into
+    """
     if q is not None:
         q = q.copy()
     if q is None:
         q = {"query": {"match_all": {}}}
     if "size" not in q:
         q["size"] = page_size
+    if slices is not None and slices > 1:
+        q["slice"] = {"id": slice_id, "max": slices}
 
     resp = raw.initialise_scroll(conn, type, q, keepalive, scan)
     if resp.status_code != 200:
         # something went wrong initialising the scroll
         raise ScrollInitialiseException("Unable to initialise scroll - could be your mappings are broken")
 
-    # otherwise, carry on
+    # otherwise, carry on.  From here on we hold a scroll context, which we release however we finish
     results, scroll_id = raw.unpack_scroll(resp)
     total_results = raw.total_results(resp)
 
-    counter = 0
-    for r in results:
-        # apply the limit
-        if limit is not None and counter >= int(limit):
-            break
-        counter += 1
-        yield r
+    try:
+        received = len(results)
+        if len(results) > 0:
+            yield results
 
-    while True:
-        # apply the limit
-        if limit is not None and counter >= int(limit):
-            break
+        while True:
+            # if we received all the results we were expecting, we can just stop here
+            if received >= total_results:
+                break
 
-        # if we consumed all the results we were expecting, we can just stop here
-        if counter >= total_results:
-            break
+            # get the next page and check that we haven't timed out
+            sresp = raw.scroll_next(conn, scroll_id, keepalive=keepalive)
+            if raw.scroll_timedout(sresp):
+                status = sresp.status_code
+                message = sresp.text
+                raise ScrollTimeoutException("Scroll timed out; {status} - {message}".format(status=status, message=message))
+
+            # if we didn't get any results back, this also means we're at the end
+            results, next_scroll_id = raw.unpack_scroll(sresp)
+            if next_scroll_id is not None:
+                scroll_id = next_scroll_id
+            if len(results) == 0:
+                break
 
-        # get the next page and check that we haven't timed out
-        sresp = raw.scroll_next(conn, scroll_id, keepalive=keepalive)
-        if raw.scroll_timedout(sresp):
-            status = sresp.status_code
-            message = sresp.text
-            raise ScrollTimeoutException("Scroll timed out; {status} - {message}".format(status=status, message=message))
+            received += len(results)
+            yield results
+    finally:
+        if scroll_id is not None:
+            _clear_scroll_quietly(conn, scroll_id)
 
-        # if we didn't get any results back, this also means we're at the end
-        results = raw.unpack_result(sresp)
-        if len(results) == 0:
-            break
 
-        for r in results:
-            # apply the limit (again)
+def _clear_scroll_quietly(conn, scroll_id):
+    # failing to clear only means the context lives until its keepalive expires, so this mustn't mask anything else
+    try:
+        raw.clear_scroll(conn, scroll_id)
+    except Exception as e:
+        raw.logger.warning("unable to clear scroll context: {0}".format(e))
+
+
+class Scroll(object):
+    """
+    An iterator over the records of a scroll.
+
+    The scroll context on the cluster is released as soon as the records are exhausted, or when the scroll is
+    closed, either directly, by leaving a with block, or by the iterator being garbage collected after the caller
+    stops early.
+    """
+    def __init__(self, records):
+        self._records = records
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._records)
+
+    def close(self):
+        self._records.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def scroll(conn, type, q=None, page_size=1000, limit=None, keepalive="10m", scan=False, slice_id=None, slices=None,
+           prefetch=0):
+    """
+    Scroll through the results of a query, yielding each record
+
+    :param prefetch: the number of pages to fetch ahead in a background thread while the caller works through the
+        current one.  Errors in fetching (such as the scroll timing out) are raised when the caller reaches them
+    :return: a Scroll over the records, which may be used as a context manager to make sure its scroll context is
+        released
+    """
+    return Scroll(_scroll_records(conn, type, q, page_size, limit, keepalive, scan, slice_id, slices, prefetch))
+
+
+def _scroll_records(conn, type, q, page_size, limit, keepalive, scan, slice_id, slices, prefetch):
+    counter = 0
+    pages = _prefetched(lambda: scroll_pages(conn, type, q, page_size=page_size, keepalive=keepalive, scan=scan,
+                                             slice_id=slice_id, slices=slices), prefetch)
+    try:
+        for results in pages:
+            for r in results:
+                # apply the limit
+                if limit is not None and counter >= int(limit):
+                    return
+                counter += 1
+                yield r
+
+            # apply the limit (again) before we go to the trouble of getting the next page
             if limit is not None and counter >= int(limit):
-                break
-            counter += 1
+                return
+    finally:
+        pages.close()
+
+
+def _prefetched(pages, prefetch):
+    """ Get a generator over the pages, fetched up to prefetch pages ahead in the background if prefetch > 0 """
+    if prefetch is None or prefetch < 1:
+        return (p for p in pages())
+    return _merge_in_background([pages], prefetch)
+
+
+class _Budget(object):
+    """ A record limit shared between several workers """
+    def __init__(self, limit, counter, lock):
+        self.limit = int(limit) if limit is not None else None
+        self.counter = counter
+        self.lock = lock
+
+    def take(self, n):
+        """ Claim up to n records from the budget, returning how many were granted """
+        if self.limit is None:
+            return n
+        with self.lock:
+            granted = max(min(n, self.limit - self.counter.value), 0)
+            self.counter.value += granted
+        return granted
+
+
+class _Counter(object):
+    def __init__(self):
+        self.value = 0
+
+
+def _budgeted_scroll(conn, type, q, page_size, keepalive, slice_id, slices, budget):
+    pages = scroll_pages(conn, type, q, page_size=page_size, keepalive=keepalive, slice_id=slice_id, slices=slices)
+    try:
+        yield from _budgeted_pages(pages, budget)
+    finally:
+        pages.close()
+
+
+def _budgeted_pages(pages, budget):
+    """ Yield the records from each page for as long as the budget grants them """
+    for results in pages:
+        granted = budget.take(len(results))
+        for r in results[:granted]:
             yield r
+        if granted < len(results):
+            return
+
+
+def _scroll_slice_worker(conn, type, q, page_size, keepalive, slice_id, slices, budget, callback):
+    records = _budgeted_scroll(conn, type, q, page_size, keepalive, slice_id, slices, budget)
+    try:
+        return callback(slice_id, records)
+    finally:
+        records.close()
+
+
+def _put_unless_stopped(out, item, stop):
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _merge_in_background(sources, maxsize):
+    """
+    Run each of the sources (functions which return an iterable) in its own thread, and yield the items they
+    produce as they arrive, through a queue of at most maxsize items.  An exception in any source is re-raised
+    to the consumer, and closing this generator stops the sources at their next item, waiting for them to tidy up.
+    """
+    out = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def run(source):
+        items = None
+        try:
+            items = source()
+            for item in items:
+                if not _put_unless_stopped(out, item, stop):
+                    return
+        except Exception as e:
+            _put_unless_stopped(out, e, stop)
+        finally:
+            # let the source tidy up (e.g. clear its scroll) now, rather than whenever it is collected
+            if hasattr(items, "close"):
+                items.close()
+            _put_unless_stopped(out, done, stop)
+
+    threads = [threading.Thread(target=run, args=(source,), daemon=True) for source in sources]
+    for t in threads:
+        t.start()
+
+    try:
+        finished = 0
+        while finished < len(threads):
+            item = out.get()
+            if item is done:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+
+def parallel_scroll(conn, type, q=None, slices=2, page_size=1000, limit=None, keepalive="10m", callback=None,
+                    processes=False, queue_pages=None):
+    """
+    Scroll through the results of a query using several sliced scrolls at once.
+
+    Without a callback this returns a generator over the records of all the slices, in no particular order, each
+    slice being scrolled by its own thread.  With a callback, each slice's records are handed to
+    callback(slice_id, records) in its own thread (or process, if processes is True, in which case the callback and
+    its return value must be picklable), and the list of the callbacks' return values is returned, in slice order.
+
+    :param limit: the maximum number of records across all slices
+    :param queue_pages: the number of pages to buffer between the slices and the consumer of the merged generator
+    """
+    if callback is None:
+        if processes:
+            raise ValueError("parallel_scroll can only use processes with a callback")
+        return Scroll(_merged_scroll(conn, type, q, slices, page_size, limit, keepalive, queue_pages))
+
+    if processes:
+        manager = multiprocessing.Manager()
+        budget = _Budget(limit, manager.Value("i", 0), manager.Lock()) if limit is not None else _Budget(None, None, None)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=slices)
+    else:
+        manager = None
+        budget = _Budget(limit, _Counter(), threading.Lock())
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=slices)
+
+    try:
+        with executor:
+            futures = [executor.submit(_scroll_slice_worker, conn, type, q, page_size, keepalive, i, slices, budget,
+                                       callback)
+                       for i in range(slices)]
+            return [f.result() for f in futures]
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+
+def _merged_scroll(conn, type, q, slices, page_size, limit, keepalive, queue_pages):
+    def slice_source(slice_id):
+        return lambda: scroll_pages(conn, type, q, page_size=page_size, keepalive=keepalive,
+                                    slice_id=slice_id, slices=slices)
+
+    queue_pages = queue_pages if queue_pages is not None else slices * 2
+    pages = _merge_in_background([slice_source(i) for i in range(slices)], queue_pages)
+    counter = 0
+    try:
+        for results in pages:
+            for r in results:
+                # apply the limit
+                if limit is not None and counter >= int(limit):
+                    return
+                counter += 1
+                yield r
+    finally:
+        pages.close()
+
+
+PAGING_SEARCH_AFTER = "search_after"
+PAGING_FROM = "from"
+
 
+def encode_cursor(sort_values):
+    """ Make a resumable cursor token from the sort values of the last record read """
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+
+
+def stable_sort(sort, tiebreaker):
+    """ Normalise a query's sort into a list, and append the tiebreaker if it isn't already sorted on """
+    if sort is None:
+        sort = []
+    elif not isinstance(sort, list):
+        sort = [sort]
+    else:
+        sort = list(sort)
+
+    fields = []
+    for s in sort:
+        if isinstance(s, dict):
+            fields += list(s.keys())
+        else:
+            fields.append(s)
+    if tiebreaker not in fields:
+        sort.append({tiebreaker: {"order": "asc"}})
+    return sort
+
+
+class SearchAfterIterator(object):
+    """
+    Iterate over all the results of a query, a page at a time, using search_after on a stable sort.
+
+    Each page costs the same to fetch however deep into the results it is, and there is no limit on how far the
+    iteration can go.  The cursor property gives a token for the position after the last record yielded, which can
+    be passed back in as cursor to resume from that point.
+    """
+    def __init__(self, fetch, q, page_size=1000, limit=None, cursor=None, tiebreaker=None,
+                 transform=None, prefetch=0, on_close=None):
+        """
+        :param fetch: function which takes a query and returns the search response as json.  It should raise if the
+            search fails; a response holding an error raises a SearchException
+        :param tiebreaker: a field to add to the sort which gives every record a unique position, such as a keyword
+            copy of the id, or _shard_doc within a point in time.  _id needs fielddata, which ES 8 refuses by
+            default, so it makes a poor tiebreaker
+        :param transform: function to apply to each record before it is yielded
+        :param prefetch: the number of pages to fetch ahead in a background thread
+        :param on_close: function to call once the iteration is finished with, e.g. to close its point in time
+        """
+        if tiebreaker is None:
+            raise ValueError("search_after paging needs a tiebreaker: a unique, sortable field such as a keyword "
+                             "copy of the id, or (from ES 7.12) a point in time to sort on _shard_doc")
+        self.fetch = fetch
+        self.q = q.copy()
+        self.q["size"] = page_size
+        self.q.pop("from", None)
+        self.q["sort"] = stable_sort(self.q.get("sort"), tiebreaker)
+        self.page_size = page_size
+        self.limit = int(limit) if limit is not None else None
+        self.transform = transform
+        self.prefetch = prefetch
+        self.search_after = decode_cursor(cursor) if cursor is not None else None
+        self.count = 0
+        self._records = None
+        self._on_close = on_close
+
+    @property
+    def cursor(self):
+        if self.search_after is None:
+            return None
+        return encode_cursor(self.search_after)
+
+    def pages(self):
+        """ Yield the hits of each page in turn, from the current cursor, ignoring the limit """
+        # pages may be fetched ahead of the records being consumed, so track our own position
+        q = self.q.copy()
+        after = self.search_after
+        while True:
+            if after is not None:
+                q["search_after"] = after
+            j = self.fetch(q)
+            if "error" in j:
+                # an error is not the end of the results, and mustn't be taken for it
+                raise SearchException("Search failed; {0}".format(j["error"]))
+            hits = j.get("hits", {}).get("hits", [])
+            if len(hits) == 0:
+                break
+            yield hits
+            if len(hits) < self.page_size:
+                break
+            after = hits[-1].get("sort")
+
+    def _iterate(self):
+        pages = _prefetched(self.pages, self.prefetch)
+        try:
+            for hits in pages:
+                for hit in hits:
+                    # apply the limit
+                    if self.limit is not None and self.count >= self.limit:
+                        return
+                    self.count += 1
+                    self.search_after = hit.get("sort")
+                    record = hit.get("_source") if "_source" in hit else hit.get("fields")
+                    yield self.transform(record) if self.transform is not None else record
+        finally:
+            pages.close()
+            self._closed()
+
+    def _closed(self):
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.limit is not None and self.count >= self.limit:
+            raise StopIteration()
+        if self._records is None:
+            self._records = self._iterate()
+        return next(self._records)
+
+    def close(self):
+        """ Stop iterating, and stop any pages being fetched in the background """
+        if self._records is not None:
+            self._records.close()
+        self._closed()
 
-def iterate(conn, type, q, page_size=1000, limit=None, method="POST"):
+
+class PointInTime(object):
+    """
+    A point in time view of an index, which reads consistently for as long as it is kept open without holding any
+    scroll contexts.
+
+    Use it as a context manager, or call open() and close(), and read from it with iterate() or search().  Every
+    search extends its keep_alive, so it only expires if it goes unused for that long.
+    """
+    # sorting on _shard_doc gives every record a unique position within a point in time
+    TIEBREAKER = "_shard_doc"
+
+    def __init__(self, conn, type=None, keep_alive="1m"):
+        self.conn = conn
+        self.type = type
+        self.keep_alive = keep_alive
+        self.id = None
+
+    def open(self):
+        resp = raw.open_point_in_time(self.conn, self.type, keep_alive=self.keep_alive)
+        if resp.status_code != 200:
+            raise PointInTimeException("Unable to open point in time; {0} - {1}".format(resp.status_code, resp.text))
+        self.id = raw.unpack_point_in_time(resp)
+        return self
+
+    def close(self):
+        if self.id is None:
+            return
+        try:
+            raw.close_point_in_time(self.conn, self.id)
+        except Exception as e:
+            raw.logger.warning("unable to close point in time: {0}".format(e))
+        self.id = None
+
+    def __enter__(self):
+        if self.id is None:
+            self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def search(self, q):
+        """ Run a query against the point in time, returning the json response """
+        if self.id is None:
+            raise PointInTimeException("Point in time is not open")
+        resp = raw.search_point_in_time(self.conn, self.id, q, keep_alive=self.keep_alive)
+        if resp.status_code != 200:
+            raise PointInTimeException("Point in time search failed; {0} - {1}".format(resp.status_code, resp.text))
+        j = resp.json()
+        # the id may change from one search to the next, and we should always use the latest
+        self.id = j.get("pit_id", self.id)
+        return j
+
+    def count(self, q=None):
+        q = q.copy() if q is not None else {"query": {"match_all": {}}}
+        q["size"] = 0
+        q["track_total_hits"] = True
+        q.pop("sort", None)
+        return self.search(q).get("hits", {}).get("total", {}).get("value", 0)
+
+    def iterate(self, q=None, page_size=1000, limit=None, cursor=None, slice_id=None, slices=None, prefetch=0,
+                tiebreaker=TIEBREAKER):
+        """
+        Iterate over the records matching the query with search_after, optionally over one slice of them
+
+        :return: a SearchAfterIterator
+        """
+        q = q.copy() if q is not None else {"query": {"match_all": {}}}
+        if slices is not None and slices > 1:
+            q["slice"] = {"id": slice_id, "max": slices}
+        return SearchAfterIterator(self.search, q, page_size=page_size, limit=limit, cursor=cursor,
+                                   tiebreaker=tiebreaker, prefetch=prefetch)
+
+    def parallel_iterate(self, q=None, slices=2, page_size=1000, limit=None, queue_pages=None):
+        """ Iterate over the records matching the query, reading its slices in parallel threads, in no particular order """
+        def slice_source(slice_id):
+            return lambda: self.iterate(q, page_size=page_size, slice_id=slice_id, slices=slices).pages()
+
+        queue_pages = queue_pages if queue_pages is not None else slices * 2
+        pages = _merge_in_background([slice_source(i) for i in range(slices)], queue_pages)
+        counter = 0
+        try:
+            for hits in pages:
+                for hit in hits:
+                    # apply the limit
+                    if limit is not None and counter >= int(limit):
+                        return
+                    counter += 1
+                    yield hit.get("_source") if "_source" in hit else hit.get("fields")
+        finally:
+            pages.close()
+
+
+def _read(conn, type, q, page_size=1000, limit=None, method="POST", prefetch=0, pit=None, tiebreaker=None):
+    """
+    Iterate the records matching the query, either directly or from a point in time.
+
+    :param pit: a PointInTime to read from, or True to open one for the duration of the read
+    :param tiebreaker: without a point in time, the field to break ties in the sort on (see iterate)
+    """
+    if pit is None or pit is False:
+        records = iterate(conn, type, q, page_size=page_size, limit=limit, method=method, prefetch=prefetch,
+                          tiebreaker=tiebreaker)
+        try:
+            yield from records
+        finally:
+            if hasattr(records, "close"):
+                records.close()
+        return
+
+    own = not isinstance(pit, PointInTime)
+    if own:
+        pit = PointInTime(conn, type).open()
+    records = pit.iterate(q, page_size=page_size, limit=limit, prefetch=prefetch)
+    try:
+        yield from records
+    finally:
+        records.close()
+        if own:
+            pit.close()
+
+
+# How many times to retry a search which the cluster turned away with a retryable status, e.g. 429 or 503, and the
+# delay (seconds) before the first retry, doubling with each one after
+SEARCH_RETRIES = 3
+SEARCH_BACKOFF = 1.0
+
+
+def _search_json(conn, type, query, method="POST"):
+    """
+    Run a search and return its json response, retrying it if the cluster is temporarily unable to answer.  A
+    failed search raises a SearchException, rather than looking like a page with no results.
+    """
+    attempt = 0
+    while True:
+        resp = raw.search(conn, type=type, query=query, method=method)
+        if resp.status_code == 200:
+            j = resp.json()
+            if "error" not in j:
+                return j
+        elif resp.status_code in raw.RETRYABLE_BULK_STATUSES and attempt < SEARCH_RETRIES:
+            time.sleep(SEARCH_BACKOFF * 2 ** attempt)
+            attempt += 1
+            continue
+        raise SearchException("Search failed; {0} - {1}".format(resp.status_code, resp.text))
+
+
+def iterate(conn, type, q, page_size=1000, limit=None, method="POST", paging=PAGING_SEARCH_AFTER, cursor=None,
+            tiebreaker=None, prefetch=0, es_version=None):
+    """
+    Iterate over all the records matching the query
+
+    :param paging: PAGING_SEARCH_AFTER (the default) to page through the results with search_after, or PAGING_FROM
+        to use from/size, which gets slower with each page and stops at the index's max_result_window
+    :param cursor: for search_after paging, a cursor token from a previous iterator to resume from
+    :param tiebreaker: field to add to the sort to give every record a unique position, such as a keyword copy of
+        the id.  Without one, search_after paging reads from a point in time sorted on _shard_doc if the cluster
+        is on 7.12 or later, and otherwise sorts on the id (_uid before 7.0, _id after).  Only a tiebreaker field
+        gives a cursor which can be resumed from after the iteration is closed
+    :param prefetch: for search_after paging, the number of pages to fetch ahead in a background thread
+    :param es_version: the version of the cluster, if not the connection's (see cluster_version)
+    :return: an iterator over the records; for search_after paging this is a SearchAfterIterator
+    """
+    if paging == PAGING_FROM:
+        return _iterate_from(conn, type, q, page_size=page_size, limit=limit, method=method, tiebreaker=tiebreaker)
+
+    if tiebreaker is None:
+        es_version = es_version if es_version is not None else cluster_version(conn)
+        if cursor is None and versions.shard_doc_sort(es_version):
+            return iterate_point_in_time(conn, type, q, page_size=page_size, limit=limit, prefetch=prefetch)
+        tiebreaker = versions.id_sort_field(es_version)
+
+    def fetch(query):
+        return _search_json(conn, type, query, method)
+
+    return SearchAfterIterator(fetch, q, page_size=page_size, limit=limit, cursor=cursor, tiebreaker=tiebreaker,
+                               prefetch=prefetch)
+
+
+def iterate_point_in_time(conn, type, q, page_size=1000, limit=None, prefetch=0, transform=None):
+    """
+    Iterate over all the records matching the query from a point in time opened for the purpose, which is closed
+    as soon as the iteration is finished with.  Ties are broken on _shard_doc, so this needs ES 7.12 or later.
+
+    The point in time is only opened when the first page is fetched, so an iterator which is never read from holds
+    nothing open.
+
+    :return: a SearchAfterIterator
+    """
+    pit = PointInTime(conn, type)
+
+    def search(query):
+        if pit.id is None:
+            pit.open()
+        return pit.search(query)
+
+    q = q.copy() if q is not None else {"query": {"match_all": {}}}
+    return SearchAfterIterator(search, q, page_size=page_size, limit=limit, tiebreaker=PointInTime.TIEBREAKER,
+                               transform=transform, prefetch=prefetch, on_close=pit.close)
+
+
+def cluster_version(conn):
+    """ The version number of the cluster the connection is to, e.g. "7.17.0", asked for once and kept on it """
+    if conn.es_version is None:
+        resp = raw.cluster_info(conn)
+        if resp.status_code != 200:
+            raise raw.ESWireException(resp)
+        conn.es_version = resp.json().get("version", {}).get("number")
+    return conn.es_version
+
+
+def _iterate_from(conn, type, q, page_size=1000, limit=None, method="POST", tiebreaker=None):
     q = q.copy()
     q["size"] = page_size
     q["from"] = 0
-    if "sort" not in q:
-        q["sort"] = [{"_uid": {"order": "asc"}}]
+    if "sort" not in q and tiebreaker is not None:
+        q["sort"] = [{tiebreaker: {"order": "asc"}}]
     counter = 0
     while True:
         # apply the limit
         if limit is not None and counter >= int(limit):
             break
-        
-        res = raw.search(conn, type=type, query=q, method=method)
-        rs = raw.unpack_result(res)
-        
+
+        rs = raw.unpack_json_result(_search_json(conn, type, q, method))
         if len(rs) == 0:
             break
         for r in rs:
@@ -210,61 +1458,321 @@ def iterate(conn, type, q, page_size=1000, limit=None, method="POST"):
 def dump(conn, type, q=None, page_size=1000, limit=None, method="POST",
          out=None, out_template=None, out_batch_sizes=100000, out_rollover_callback=None,
          transform=None,
-         es_bulk_format=True, idkey='id', es_bulk_fields=None):
-
+         es_bulk_format=True, idkey='id', es_bulk_fields=None, prefetch=0, pit=None, compression=None,
+         slices=None, keepalive="10m", manifest=None, checkpoint=None, tiebreaker=None):
+    """
+    Dump the records matching the query to a file (or stdout), optionally in bulk format and rolled over between
+    several files.
+
+    With slices, the query is read by that many sliced scrolls (or slices of the point in time, if pit is given) in
+    parallel threads, and each slice writes its own series of files, out_template.s<slice>.1, out_template.s<slice>.2,
+    and so on.  out_rollover_callback is called with the name of each file as soon as it is complete, from the thread
+    which wrote it.
+
+    :param out_batch_sizes: the number of records to write to each file before rolling over to the next
+    :param prefetch: the number of pages to fetch ahead in the background, so that reading the next page overlaps
+        with transforming and writing the current one
+    :param pit: a PointInTime to dump from, or True to open one for the dump
+    :param compression: util.GZIP or util.ZSTD to compress the out_template files with
+    :param slices: the number of slices to read and write in parallel, which requires out_template
+    :param keepalive: how long to keep each slice's scroll context alive between pages
+    :param manifest: a file to list the dumped files in, with their record counts and sizes; with slices this
+        defaults to out_template.manifest.json
+    :param checkpoint: a Checkpoint (or the path of one) to record progress in.  If it holds the state of an earlier
+        run of the same dump, the dump carries on from where that left off, truncating the file it was writing to
+        the last checkpoint so that no record is written twice.  Sliced dumps checkpoint each slice as it finishes,
+        and re-run any slices which didn't.  This needs out_template, and can't be used with a point in time; an
+        unsliced one also needs a tiebreaker
+    :param tiebreaker: a unique, sortable field to page through an unsliced dump in order of (see iterate)
+    :return: the list of files written
+    """
     q = q if q is not None else {"query": {"match_all": {}}}
-
-    filenames = []
-    n = 1
-    current_file = None
-    if out_template is not None:
-        current_file = out_template + "." + str(n)
-        filenames.append(current_file)
-    if out is None and current_file is not None:
-        out = open(current_file, "w")
+    if checkpoint is not None:
+        if out_template is None or pit not in (None, False):
+            raise ValueError("a checkpointed dump needs an out_template, and can't read from a point in time")
+        if (slices is None or slices <= 1) and tiebreaker is None:
+            raise ValueError("a checkpointed dump needs a tiebreaker field for its position to make sense to a "
+                             "later run")
+        checkpoint = Checkpoint.of(checkpoint)
+
+    def line(record):
+        return _dump_line(record, conn, type, transform, es_bulk_format, idkey, es_bulk_fields)
+
+    if slices is not None and slices > 1:
+        if out_template is None:
+            raise ValueError("a sliced dump needs an out_template to write each slice's files to")
+        manifest = manifest if manifest is not None else out_template + ".manifest.json"
+        writers = [_RollingWriter(out_template + ".s" + str(i), out_batch_sizes, compression, out_rollover_callback)
+                   for i in range(slices)]
+        _sliced_dump(conn, type, q, page_size, limit, keepalive, pit, slices, writers, line, checkpoint)
+    elif checkpoint is not None:
+        writers = [_RollingWriter(out_template, out_batch_sizes, compression, out_rollover_callback)]
+        _checkpointed_dump(conn, type, q, page_size, limit, method, prefetch, tiebreaker, writers[0], line,
+                           checkpoint)
     else:
-        out = sys.stdout
+        writers = []
+        if out_template is not None:
+            writers.append(_RollingWriter(out_template, out_batch_sizes, compression, out_rollover_callback))
+            out = writers[0]
+        elif out is None:
+            out = sys.stdout
 
-    count = 0
-    for record in iterate(conn, type, q, page_size=page_size, limit=limit, method=method):
-        if transform is not None:
-            record = transform(record)
-
-        if es_bulk_format:
-            kwargs = {}
-            if es_bulk_fields is None:
-                es_bulk_fields = ["_id", "_index", "_type"]
-            for key in es_bulk_fields:
-                if key == "_id":
-                    kwargs["idkey"] = idkey
-                if key == "_index":
-                    kwargs["index"] = conn.index
-                if key == "_type":
-                    kwargs["type_"] = type
-            data = raw.to_bulk_single_rec(record, **kwargs)
-        else:
-            data = json.dumps(record) + "\n"
+        records = _read(conn, type, q, page_size=page_size, limit=limit, method=method, prefetch=prefetch, pit=pit,
+                        tiebreaker=tiebreaker)
+        try:
+            for record in records:
+                out.write(line(record))
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+        finally:
+            records.close()
+        for writer in writers:
+            writer.close()
+
+    if manifest is not None:
+        _write_manifest(manifest, writers)
+    if checkpoint is not None:
+        checkpoint.clear()
+    return [f["file"] for writer in writers for f in writer.files]
+
+
+def _dump_line(record, conn, type, transform=None, es_bulk_format=True, idkey="id", es_bulk_fields=None):
+    if transform is not None:
+        record = transform(record)
+
+    if not es_bulk_format:
+        return json.dumps(record) + "\n"
+
+    kwargs = {}
+    if es_bulk_fields is None:
+        es_bulk_fields = ["_id", "_index", "_type"]
+    for key in es_bulk_fields:
+        if key == "_id":
+            kwargs["idkey"] = idkey
+        if key == "_index":
+            kwargs["index"] = conn.index
+        if key == "_type":
+            kwargs["type_"] = type
+    return raw.to_bulk_single_rec(record, **kwargs)
+
+
+class _RollingWriter(object):
+    """
+    Writes records to a series of files, template.1, template.2, ..., moving on to the next file after batch_size
+    records, and keeping count of what went into each.  callback is called with the name of each file once it is
+    complete.
+    """
+    def __init__(self, template, batch_size, compression=None, callback=None):
+        self.template = template
+        self.batch_size = batch_size
+        self.compression = compression
+        self.callback = callback
+        self.files = []
+        self._out = None
+
+    def _open(self):
+        filename = util.compressed_name(self.template + "." + str(len(self.files) + 1), self.compression)
+        self.files.append({"file": filename, "records": 0, "bytes": 0, "complete": False})
+        self._out = util.open_file(filename, "wt", self.compression)
+
+    def _finish(self):
+        self._out.close()
+        self._out = None
+        current = self.files[-1]
+        current["bytes"] = os.path.getsize(current["file"])
+        current["complete"] = True
+        if self.callback is not None:
+            self.callback(current["file"])
+
+    def checkpoint(self):
+        """
+        Make sure everything written so far is on disk, and return the state of the files to resume() from.  A
+        compressed file is closed and re-opened for appending, which starts a new gzip member (or zstd frame), so
+        that it can later be truncated back to this point and still be read.
+        """
+        if self._out is not None:
+            current = self.files[-1]
+            if self.compression is not None:
+                self._out.close()
+                self._out = util.open_file(current["file"], "at", self.compression)
+            else:
+                self._out.flush()
+                os.fsync(self._out.fileno())
+            current["bytes"] = os.path.getsize(current["file"])
+        return copy_.deepcopy(self.files)
+
+    def resume(self, files):
+        """ Carry on from the state returned by checkpoint(), discarding anything written to the files since """
+        self.files = copy_.deepcopy(files)
+        if len(self.files) > 0 and not self.files[-1]["complete"]:
+            current = self.files[-1]
+            with open(current["file"], "r+b") as f:
+                f.truncate(current["bytes"])
+            self._out = util.open_file(current["file"], "at", self.compression)
+
+    def write(self, data):
+        if self._out is None:
+            self._open()
+        self._out.write(data)
+        self.files[-1]["records"] += 1
+        if self.files[-1]["records"] >= self.batch_size:
+            self._finish()
 
-        out.write(data)
-        if out_template is not None:
+    def close(self):
+        # always leave at least one file, even if there was nothing to write
+        if len(self.files) == 0:
+            self._open()
+        if self._out is not None:
+            self._finish()
+
+    def abort(self):
+        """ Close the current file without completing it, e.g. because the dump failed """
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+
+def _write_manifest(path, writers):
+    files = []
+    for slice_id, writer in enumerate(writers):
+        for f in writer.files:
+            files.append(dict(f, slice=slice_id))
+    manifest = {
+        "slices": len(writers),
+        "records": sum([f["records"] for f in files]),
+        "bytes": sum([f["bytes"] for f in files]),
+        "files": files
+    }
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _sliced_dump(conn, type, q, page_size, limit, keepalive, pit, slices, writers, line, checkpoint=None):
+    # the slices which finished in an earlier run keep their files, and the rest start again
+    done = {}
+    if checkpoint is not None and checkpoint.state is not None:
+        done = checkpoint.state.get("slices", {})
+    for slice_id, files in done.items():
+        writers[int(slice_id)].files = files
+    if limit is not None:
+        limit = max(int(limit) - sum([f["records"] for files in done.values() for f in files]), 0)
+    lock = threading.Lock()
+
+    def finished(slice_id):
+        if checkpoint is None:
+            return
+        with lock:
+            done[str(slice_id)] = writers[slice_id].files
+            checkpoint.save({"slices": done}, force=True)
+
+    own = pit is True
+    if own:
+        pit = PointInTime(conn, type).open()
+    budget = _Budget(limit, _Counter(), threading.Lock())
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=slices) as executor:
+            futures = [executor.submit(_dump_slice, conn, type, q, page_size, keepalive, pit, i, slices, budget,
+                                       writers[i], line, finished)
+                       for i in range(slices) if str(i) not in done]
+            for f in futures:
+                f.result()
+    finally:
+        if own:
+            pit.close()
+
+
+def _dump_slice(conn, type, q, page_size, keepalive, pit, slice_id, slices, budget, writer, line, finished):
+    if isinstance(pit, PointInTime):
+        hits = pit.iterate(q, page_size=page_size, slice_id=slice_id, slices=slices).pages()
+        pages = ([h.get("_source") if "_source" in h else h.get("fields") for h in page] for page in hits)
+    else:
+        hits = scroll_pages(conn, type, q, page_size=page_size, keepalive=keepalive, slice_id=slice_id, slices=slices)
+        pages = hits
+    records = _budgeted_pages(pages, budget)
+    try:
+        for record in records:
+            writer.write(line(record))
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        records.close()
+        hits.close()
+    writer.close()
+    finished(slice_id)
+
+
+def _checkpointed_dump(conn, type, q, page_size, limit, method, prefetch, tiebreaker, writer, line, checkpoint):
+    state = checkpoint.state if checkpoint.state is not None else {}
+    count = state.get("count", 0)
+    writer.resume(state.get("files", []))
+    if limit is not None:
+        limit = max(int(limit) - count, 0)
+
+    records = iterate(conn, type, q, page_size=page_size, limit=limit, method=method, cursor=state.get("cursor"),
+                      prefetch=prefetch, tiebreaker=tiebreaker)
+    try:
+        for record in records:
+            writer.write(line(record))
             count += 1
-            if count > out_batch_sizes:
-                out.close()
-                if out_rollover_callback is not None:
-                    out_rollover_callback(current_file)
-
-                count = 0
-                n += 1
-                current_file = out_template + "." + str(n)
-                filenames.append(current_file)
-                out = open(current_file, "w")
-
-    if out_template is not None:
-        out.close()
-    if out_rollover_callback is not None:
-        out_rollover_callback(current_file)
+            if checkpoint.due():
+                checkpoint.save({"cursor": records.cursor, "count": count, "files": writer.checkpoint()})
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        records.close()
+    writer.close()
 
-    return filenames
+
+class Checkpoint(object):
+    """
+    A small local state file recording how far a dump or copy has got, so that if it fails it can be started again
+    from that point rather than from the beginning.
+
+    The state is saved at most every interval seconds (unless forced), and is written to a temporary file which is
+    then renamed over the old one, so a crash part way through a save leaves the previous state intact.  It is
+    removed once the job completes.
+    """
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.state = None
+        self._saved = time.time()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.state = json.load(f)
+
+    @classmethod
+    def of(cls, checkpoint):
+        """ A Checkpoint as given, or one for the given path """
+        return checkpoint if isinstance(checkpoint, Checkpoint) else cls(checkpoint)
+
+    def due(self):
+        return time.time() - self._saved >= self.interval
+
+    def save(self, state, force=False):
+        with self._lock:
+            if not force and not self.due():
+                return False
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.state = state
+            self._saved = time.time()
+            return True
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.state = None
 
 
 def create_alias(conn, alias):
@@ -291,7 +1799,91 @@ def repoint_alias_index_type(old_conn, new_conn, alias, t):
                                    remove=[{"alias": alias, "index": old_index}])
     print("Alias re-point reply: ", raw.post_alias(new_conn, actions).json())
 
-def reindex(old_conn, new_conn, alias, types, new_mappings=None, new_version="0.90.13"):
+
+def _same_cluster(a, b):
+    """ Whether two connections are to the same cluster, however its nodes are addressed """
+    uuids = []
+    for conn in [a, b]:
+        resp = raw.cluster_info(conn)
+        if resp.status_code != 200:
+            raise ReindexException("Unable to identify cluster; {0} - {1}".format(resp.status_code, resp.text))
+        uuids.append(resp.json().get("cluster_uuid"))
+    return uuids[0] is not None and uuids[0] == uuids[1]
+
+
+def _wait_for_index(conn, type=None, status="yellow", timeout="30s"):
+    """ Wait until the index is ready to use, rather than sleeping for some fixed time """
+    resp = raw.cluster_health(conn, type, params={"wait_for_status": status, "timeout": timeout})
+    if resp.status_code != 200 or resp.json().get("timed_out", False):
+        raw.logger.warning("index {0} not {1} after {2}".format(raw.index_names(conn, type), status, timeout))
+
+
+def server_reindex(source_conn, source_type, target_conn, target_type, q=None, slices="auto", poll_interval=5,
+                   progress_callback=None):
+    """
+    Copy a type from one index to another with the cluster's own _reindex, following its progress through the
+    _tasks API.  If the source is on another cluster, the target cluster reindexes from it remotely, which requires
+    the source to be in the target's reindex.remote.whitelist.
+
+    :param progress_callback: function called with the task's status each time it is polled
+    :return: the task's final response, with the counts of documents created, updated etc.
+    """
+    remote = not _same_cluster(source_conn, target_conn)
+
+    source = {"index": raw.index_names(source_conn, source_type)}
+    if not source_conn.index_per_type and source_type:
+        source["type"] = source_type
+    if q is not None and "query" in q:
+        source["query"] = q["query"]
+    if remote:
+        source["remote"] = {"host": source_conn.node_url()}
+        if source_conn.auth is not None:
+            # the cluster can only pass on basic auth credentials to the remote
+            if not isinstance(source_conn.auth, tuple) or len(source_conn.auth) != 2:
+                raise ReindexRemoteException("Unable to reindex from a remote cluster with {0} auth; only a "
+                                             "(username, password) tuple can be passed on".format(
+                                                 type(source_conn.auth).__name__))
+            source["remote"]["username"], source["remote"]["password"] = source_conn.auth
+
+    dest = {"index": raw.index_names(target_conn, target_type)[0]}
+    if not target_conn.index_per_type and target_type:
+        dest["type"] = target_type
+
+    # slicing is not supported when reindexing from a remote cluster
+    params = {"slices": str(slices)} if not remote else {"slices": "1"}
+    resp = raw.reindex(target_conn, {"source": source, "dest": dest}, params=params)
+    if resp.status_code != 200:
+        message = "Unable to start reindex; {0} - {1}".format(resp.status_code, resp.text)
+        raise ReindexRemoteException(message) if remote else ReindexException(message)
+    task_id = resp.json().get("task")
+
+    while True:
+        tresp = raw.get_task(target_conn, task_id)
+        if tresp.status_code != 200:
+            raise ReindexException("Unable to get reindex task {0}; {1} - {2}".format(task_id, tresp.status_code,
+                                                                                      tresp.text))
+        task = tresp.json()
+        status = task.get("task", {}).get("status", {})
+        if progress_callback is not None:
+            progress_callback(status)
+        if task.get("completed", False):
+            break
+        time.sleep(poll_interval)
+
+    response = task.get("response", {})
+    error = task.get("error")
+    failures = response.get("failures", [])
+    if error is not None or len(failures) > 0:
+        message = "Reindex task {0} failed; {1}".format(task_id, error if error is not None else failures)
+        processed = status.get("created", 0) + status.get("updated", 0)
+        if remote and processed == 0:
+            raise ReindexRemoteException(message)
+        raise ReindexException(message)
+    return response
+
+
+def reindex(old_conn, new_conn, alias, types, new_mappings=None, new_version="0.90.13", batcher=None, writers=None,
+            server_side=False, poll_interval=5, tiebreaker=None):
     """
     Re-index without search downtime by aliasing and duplicating the specified types from the existing index
     :param old_conn: Connection to the existing index
@@ -300,6 +1892,13 @@ def reindex(old_conn, new_conn, alias, types, new_mappings=None, new_version="0.
     :param types: List of types to copy across to the new index
     :param new_mappings: New mappings to use, as a dictionary of {<type>: mapping}
     :param new_version: The version of the new index (fixme: used for the mapping function)
+    :param batcher: a raw.Batcher (e.g. raw.AdaptiveBatcher) to size the bulk batches written to the new index
+    :param writers: the number of concurrent bulk writers to copy each type with (see CopyPipeline)
+    :param server_side: have the cluster copy the data with _reindex (see server_reindex), falling back to copying it
+        through this client only if the old index is on a remote cluster which the new one can't reindex from
+    :param poll_interval: seconds between checks on the progress of a server side reindex
+    :param tiebreaker: a unique, sortable field of the records to page through them in order of when copying through
+        the client (see copy)
     """
 
     # Ensure the old index is available via alias, and the new one is not
@@ -324,16 +1923,28 @@ def reindex(old_conn, new_conn, alias, types, new_mappings=None, new_version="0.
         r = raw.put_mapping(new_conn, type=t, mapping=new_mappings[t], make_index=True, es_version=new_version)
         print("Creating ES Type+Mapping for {t}; status: {status_code}".format(t=t, status_code=r.status_code))
     print("Mapping OK")
-    time.sleep(1)
+    for t in types:
+        _wait_for_index(new_conn, t)
 
     # Copy the data from old index to new index. The index should be unchanging (and may not have .exact) so don't use
     # keyword_subfield.
     for t in types:
         print("Copying type {t}".format(t=t))
-        copy(old_conn, t, new_conn, t)
+        if server_side:
+            try:
+                response = server_reindex(old_conn, t, new_conn, t, poll_interval=poll_interval,
+                                          progress_callback=_print_reindex_progress)
+                print("Reindexed type {t}; created: {c}, updated: {u}".format(t=t, c=response.get("created"),
+                                                                               u=response.get("updated")))
+                continue
+            except ReindexRemoteException as e:
+                print("Server side reindex from remote cluster failed, copying through the client instead: {0}".format(e))
+        copy(old_conn, t, new_conn, t, batcher=batcher, writers=writers, tiebreaker=tiebreaker)
     print("Copy OK")
 
-    time.sleep(1)
+    # make sure everything copied is searchable before the alias moves over to it
+    for t in types:
+        raw.refresh(new_conn, t if new_conn.index_per_type else None)
 
     if not old_conn.index_per_type:
         # Switch alias to point to second index
@@ -344,32 +1955,238 @@ def reindex(old_conn, new_conn, alias, types, new_mappings=None, new_version="0.
     print("Reindex complete.")
 
 
-def compare_index_counts(conns, types, q=None):
-    """ Compare two or more indexes by doc counts of given types. Returns True if all counts equal, False otherwise """
-    if q is not None:
-        q = q.copy()
-        if "size" not in q or q['size'] != 0:
-            q["size"] = 0
-    if q is None:
-        q = {"query": {"match_all": {}}, "size": 0}
+def _print_reindex_progress(status):
+    print("reindex progress: {done} of {total}".format(done=status.get("created", 0) + status.get("updated", 0),
+                                                       total=status.get("total", 0)))
 
-    equal_counts = []
 
-    for t in types:
-        print("\ntype: {t}".format(t=t))
-        counts = []
-        for c in conns:
-            resp = raw.search(connection=c, type=t, query=q)
+def compare_index_counts(conns, types, q=None, pit=False, breakdown=None, concurrency=None):
+    """
+    Compare two or more indexes by doc counts of given types.  All the counts are requested at once, with the
+    _count endpoint.
+
+    :param q: a query to count the matching records of
+    :param pit: count within a point in time opened on each index, so that each count is taken from a consistent view
+    :param breakdown: a bucket aggregation, e.g. {"date_histogram": {"field": "created_date",
+        "calendar_interval": "month"}}, to count each bucket of as well, to narrow down where the indexes differ
+    :param concurrency: the most requests to have in flight at once; by default, all of them
+    :return: an IndexCounts, which is truthy if all the counts for every type are equal
+    """
+    result = IndexCounts(conns, types)
+    jobs = [(t, i, c) for t in types for i, c in enumerate(conns)]
+    workers = concurrency if concurrency is not None else len(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(_count_with_breakdown, c, t, q, pit, breakdown): (t, i) for t, i, c in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            t, i = futures[future]
             try:
-                count = resp.json()["hits"]["total"]["value"]
-                counts.append(count)
-                print("index {index}: {count}".format(index=c.index, count=count))
-            except KeyError:
-                print(resp.json())
+                count, buckets = future.result()
+            except Exception as e:
+                result.errors[(t, i)] = str(e)
+                continue
+            result.counts[t][i] = count
+            for key, doc_count in buckets.items():
+                result.buckets[t].setdefault(key, [0] * len(conns))[i] = doc_count
+    return result
+
+
+def _count_with_breakdown(conn, type, q, pit, breakdown):
+    """ Count the records of the type matching the query, and in each bucket of the breakdown aggregation if given """
+    query = {"query": q["query"]} if q is not None and "query" in q else {"query": {"match_all": {}}}
+    if breakdown is not None:
+        query.update({"size": 0, "track_total_hits": True, "aggs": {"breakdown": breakdown}})
+
+    if pit:
+        with PointInTime(conn, type) as p:
+            if breakdown is None:
+                return p.count(query), {}
+            j = p.search(query)
+    else:
+        resp = raw.search(conn, type=type, query=query) if breakdown is not None else raw.count(conn, type, query)
+        if resp.status_code != 200:
+            raise Exception("count failed; {0} - {1}".format(resp.status_code, resp.text))
+        j = resp.json()
+        if breakdown is None:
+            return j["count"], {}
+
+    total = j.get("hits", {}).get("total", 0)
+    total = total.get("value", 0) if isinstance(total, dict) else total
+    buckets = j.get("aggregations", {}).get("breakdown", {}).get("buckets", [])
+    if isinstance(buckets, dict):
+        return total, dict((k, b.get("doc_count", 0)) for k, b in buckets.items())
+    return total, dict((b.get("key_as_string", b.get("key")), b.get("doc_count", 0)) for b in buckets)
+
+
+class IndexCounts(object):
+    """
+    The counts from compare_index_counts.  counts maps each type to a list of its count in each index (in the order
+    of the connections, and None where the count failed, with the reason in errors), and buckets maps each type to
+    the per-index counts of each bucket in the breakdown.
+    """
+    def __init__(self, conns, types):
+        self.indexes = [c.index for c in conns]
+        self.types = list(types)
+        self.counts = dict((t, [None] * len(conns)) for t in types)
+        self.buckets = dict((t, {}) for t in types)
+        self.errors = {}
+
+    def equal_for(self, type):
+        counts = self.counts[type]
+        return None not in counts and len(set(counts)) == 1 and len(self.bucket_differences(type)) == 0
+
+    @property
+    def equal(self):
+        return all(self.equal_for(t) for t in self.types)
+
+    def __bool__(self):
+        return self.equal
+
+    def differences(self):
+        """ The counts for each type which aren't equal across the indexes """
+        return dict((t, self.counts[t]) for t in self.types if not self.equal_for(t))
+
+    def bucket_differences(self, type):
+        """ The per-index counts of each bucket of the type's breakdown which aren't equal across the indexes """
+        return dict((k, v) for k, v in self.buckets[type].items() if len(set(v)) > 1)
+
+    def summary(self):
+        return {
+            "indexes": self.indexes,
+            "equal": self.equal,
+            "counts": self.counts,
+            "differences": dict((t, self.bucket_differences(t)) for t in self.types if len(self.buckets[t]) > 0),
+            "errors": dict(("{0}/{1}".format(t, self.indexes[i]), e) for (t, i), e in self.errors.items())
+        }
+
+    def __repr__(self):
+        return "IndexCounts({0})".format(self.summary())
+
+
+# The ways in which a record in a target index can differ from the source
+DIFF_MISSING = "missing"
+DIFF_EXTRA = "extra"
+DIFF_CHANGED = "changed"
 
-        equal_counts.append(reduce(lambda x, y: x == y, counts))
 
-    return reduce(lambda x, y: x and y, equal_counts)
+def diff(conns, type, q=None, compare_field="last_updated", id_field="id.exact", page_size=1000, prefetch=2):
+    """
+    Find the records which differ between a source index and one or more targets, e.g. after a reindex.
+
+    Each index is read in order of id, all at the same time, fetching only the field to compare, and the streams
+    are merged as they arrive, so memory use doesn't grow with the size of the indexes.  The differences are yielded
+    as (kind, id, target) tuples, where target is the position in conns of the index which differs from conns[0],
+    and kind is one of
+
+    * DIFF_MISSING: the record is in the source but not the target
+    * DIFF_EXTRA: the record is in the target but not the source
+    * DIFF_CHANGED: the record is in both, but the compare_field value (or hash) differs
+
+    The ids of missing and changed records can be handed to copy_ids to bring the target up to date.
+
+    :param conns: the source connection, followed by the target connections
+    :param compare_field: a (dotted) field which changes whenever the record does, such as last_updated (which
+        DAO.save stamps) or a stored hash of the content.  With None, whole records are fetched to be hashed here,
+        which costs a great deal more to read
+    :param id_field: a keyword field holding the record's id, the same in every index, to order and match records
+        on; by default the exact sub-field which mappings.EXACT gives the id.  Avoid _id, which can only be sorted
+        on with fielddata, and not at all by default from ES 8.  Records without the field are left out
+    :param prefetch: the number of pages to read ahead from each index
+    """
+    streams = [_diff_stream(c, type, q, compare_field, id_field, page_size, prefetch) for c in conns]
+    try:
+        heads = [next(s, None) for s in streams]
+        while any(h is not None for h in heads):
+            key = min(h[0] for h in heads if h is not None)
+            values = []
+            for i, h in enumerate(heads):
+                if h is not None and h[0] == key:
+                    id = h[1]
+                    values.append(h[2])
+                    heads[i] = next(streams[i], None)
+                else:
+                    values.append(_ABSENT)
+
+            source = values[0]
+            for target, value in enumerate(values[1:], 1):
+                if value is _ABSENT and source is not _ABSENT:
+                    yield DIFF_MISSING, id, target
+                elif source is _ABSENT and value is not _ABSENT:
+                    yield DIFF_EXTRA, id, target
+                elif value != source:
+                    yield DIFF_CHANGED, id, target
+    finally:
+        for s in streams:
+            s.close()
+
+
+_ABSENT = object()
+
+
+def _diff_stream(conn, type, q, compare_field, id_field, page_size, prefetch):
+    """ Yield (sort key, _id, value) for each record in the index, in order of the id field """
+    q = q.copy() if q is not None else {"query": {"match_all": {}}}
+    q["sort"] = [{id_field: {"order": "asc"}}]
+    if compare_field is not None:
+        q["_source"] = [compare_field]
+        get = _field_getter(compare_field)
+    else:
+        get = _content_hash
+
+    def fetch(query):
+        return _search_json(conn, type, query)
+
+    iterator = SearchAfterIterator(fetch, q, page_size=page_size, tiebreaker=id_field)
+    pages = _prefetched(iterator.pages, prefetch)
+    try:
+        for hits in pages:
+            for hit in hits:
+                if hit["sort"][0] is None:
+                    # records without the id field sort after all the rest, and can't be matched up between indexes
+                    raw.logger.warning("records in {0} without {1} are left out of the diff".format(
+                        raw.index_names(conn, type), id_field))
+                    return
+                yield hit["sort"][0], hit.get("_id"), get(hit.get("_source", {}))
+    finally:
+        pages.close()
+
+
+def _field_getter(field):
+    path = field.split(".")
+
+    def get(record):
+        for seg in path:
+            if not isinstance(record, dict) or seg not in record:
+                return None
+            record = record[seg]
+        return record
+
+    return get
+
+
+def _content_hash(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def copy_ids(source_conn, source_type, target_conn, target_type, ids, batch_size=1000, **kwargs):
+    """
+    Copy just the records with the given ids, e.g. those diff found to be missing or changed.  The ids may be any
+    iterable (such as a generator over diff's output), and are taken batch_size at a time.
+
+    :param kwargs: any other arguments to copy
+    :return: a raw.BulkResult covering every record copied
+    """
+    result = raw.BulkResult()
+    copied = 0
+    ids = iter(ids)
+    while True:
+        batch = list(itertools.islice(ids, batch_size))
+        if len(batch) == 0:
+            break
+        batch_result = copy(source_conn, source_type, target_conn, target_type, batch_size=batch_size,
+                            q=models.QueryBuilder.ids(batch), **kwargs)
+        result.merge(batch_result, offset=copied)
+        copied += batch_result.total
+    return result
 
 
 class JSONListWriter(object):
@@ -0,0 +1,393 @@
+"""
+An in-memory stand-in for an ES cluster, for unit tests which need to go through raw's whole request path.
+
+FakeConnection is a raw.Connection whose session sends every request to a FakeES through a requests adapter,
+rather than over the network.  The FakeES keeps each index's records in insertion order, and understands enough
+of search (match_all, ids and term queries, sort, search_after, slice, _source filtering), scroll, point in time,
+_bulk, _mget, _count, _delete_by_query and the document endpoints for esprit's own use of them.
+
+Failures are injected by setting FakeES.fail to a function of (method, host, path, body) which returns None to
+let the request through, a (status, body) tuple to answer with instead, or raises (e.g. requests.ConnectionError)
+to fail the request outright.
+"""
+import gzip, hashlib, itertools, json, urllib.parse
+import requests
+from requests.adapters import BaseAdapter
+from esprit import raw
+
+
+class FakeES(object):
+    def __init__(self, version="7.17.0", cluster_uuid="fake-cluster", hosts=None):
+        self.version = version
+        self.cluster_uuid = cluster_uuid
+        self.hosts = hosts if hosts is not None else ["http://localhost:9200"]
+        self.indexes = {}
+        self.requests = []
+        # the (method, url, timeout) each request was sent with
+        self.timeouts = []
+        self.fail = None
+        # a function of (action, id, record) which returns a status to fail that bulk item with, or None
+        self.reject = None
+        self.scrolls = {}
+        self.pits = {}
+        self._ids = itertools.count()
+
+    ##################################################
+    # test helpers
+
+    def add(self, index, records, idkey="id"):
+        docs = self.indexes.setdefault(index, {})
+        for r in records:
+            docs[r[idkey]] = r
+
+    def docs(self, index):
+        return self.indexes.get(index, {})
+
+    def calls(self, method=None, endpoint=None):
+        """ The requests made, optionally only those with the method and whose path contains the endpoint """
+        return [r for r in self.requests
+                if (method is None or r[0] == method) and (endpoint is None or endpoint in r[2])]
+
+    ##################################################
+    # request handling
+
+    def handle(self, method, url, body):
+        parsed = urllib.parse.urlparse(url)
+        host = parsed.scheme + "://" + parsed.netloc
+        path = parsed.path
+        params = dict((k, v[0]) for k, v in urllib.parse.parse_qs(parsed.query).items())
+        if method == "GET" and "source" in params:
+            body = json.loads(params.pop("source"))
+        self.requests.append((method, host, path, params, body))
+
+        if self.fail is not None:
+            failure = self.fail(method, host, path, body)
+            if failure is not None:
+                return failure
+
+        parts = [p for p in path.split("/") if p]
+        if len(parts) == 0:
+            return 200, {"cluster_uuid": self.cluster_uuid, "version": {"number": self.version}}
+        if parts[0] == "_nodes":
+            return 200, {"nodes": dict((str(i), {"http": {"publish_address": h.split("://")[1]}})
+                                       for i, h in enumerate(self.hosts))}
+        if parts[0] == "_mget":
+            return self._mget(body)
+        if parts[0] == "_pit":
+            self.pits.pop(body["id"], None)
+            return 200, {"succeeded": True}
+        if parts[:2] == ["_search", "scroll"]:
+            return self._scroll(method, params, body)
+        if parts[0] == "_search":
+            return self._pit_search(body)
+        if parts[0] == "_bulk":
+            return self._bulk(None, body, params)
+        if parts[0] == "_reindex":
+            # the copy itself isn't done, only the task which would do it is started and at once complete
+            return 200, {"task": "reindex-task"}
+        if parts[0] == "_tasks":
+            return 200, {"completed": True, "task": {"status": {}}, "response": {"created": 0, "failures": []}}
+
+        index = parts[0]
+        endpoint = parts[1:]
+        if len(endpoint) > 0 and not endpoint[0].startswith("_"):
+            # a type in the path; records of each type are kept as an index of their own
+            index = index + "/" + endpoint[0]
+            endpoint = endpoint[1:]
+        endpoint = endpoint[0] if len(endpoint) > 0 else ""
+
+        if endpoint == "_search":
+            if "scroll" in params:
+                return self._open_scroll(index, body)
+            return self._search(index, body)
+        if endpoint == "_count":
+            return 200, {"count": len(self._matching(index, body))}
+        if endpoint == "_bulk":
+            return self._bulk(index, body, params)
+        if endpoint == "_pit":
+            pit_id = "pit" + str(next(self._ids))
+            # a point in time covers the whole index, whatever types its records were written under
+            names = [n for n in self.indexes if n == index or n.startswith(index + "/")]
+            self.pits[pit_id] = (index, [dict(d) for d in self._all(",".join(names))])
+            return 200, {"id": pit_id}
+        if endpoint == "_delete_by_query":
+            matching = self._matching(index, body)
+            for hit in matching:
+                del self.indexes[hit["_index"]][hit["_id"]]
+            return 200, {"deleted": len(matching)}
+        if endpoint == "_refresh":
+            return 200, {}
+        if endpoint == "_doc":
+            return self._doc(method, index, parts[-1] if parts[-1] != "_doc" else None, body)
+        return 404, {"error": "no handler for " + path}
+
+    def _doc(self, method, index, id, body):
+        docs = self.indexes.setdefault(index, {})
+        if method == "GET":
+            if id not in docs:
+                return 404, {"_id": id, "found": False}
+            return 200, {"_id": id, "found": True, "_source": docs[id]}
+        if method == "DELETE":
+            if docs.pop(id, None) is None:
+                return 404, {"result": "not_found"}
+            return 200, {"result": "deleted"}
+        if id is None or id == "None":
+            id = "auto" + str(next(self._ids))
+        docs[id] = body
+        return 201, {"_id": id, "result": "created"}
+
+    ##################################################
+    # search
+
+    def _all(self, index):
+        docs = []
+        for name in index.split(","):
+            for id, source in self.indexes.get(name, {}).items():
+                docs.append({"_index": name, "_id": id, "_source": source})
+        return docs
+
+    def _matching(self, index, body, docs=None):
+        docs = docs if docs is not None else self._all(index)
+        query = (body or {}).get("query", {"match_all": {}})
+        return [dict(d) for d in docs if _matches(query, d)]
+
+    def _sorted(self, hits, body):
+        sort = body.get("sort")
+        if sort is None:
+            return hits
+        keys = []
+        for s in sort if isinstance(sort, list) else [sort]:
+            field = list(s.keys())[0] if isinstance(s, dict) else s
+            if field == "_id" and int(self.version.split(".")[0]) >= 8:
+                raise _Rejected(400, {"error": {"type": "illegal_argument_exception",
+                                                "reason": "Fielddata access on the _id field is disallowed"}})
+            if field == "_uid" and int(self.version.split(".")[0]) >= 7:
+                raise _Rejected(400, {"error": {"type": "query_shard_exception",
+                                                "reason": "No mapping found for [_uid] in order to sort on"}})
+            keys.append(field)
+        for h in hits:
+            h["sort"] = [_sort_value(h, k) for k in keys]
+        hits = sorted(hits, key=lambda h: _missing_last(h["sort"]))
+        after = body.get("search_after")
+        if after is not None:
+            hits = [h for h in hits if _missing_last(h["sort"]) > _missing_last(after)]
+        return hits
+
+    def _hits(self, hits, body):
+        if "slice" in body:
+            sl = body["slice"]
+            hits = [h for h in hits if _slice_of(h["_id"], sl["max"]) == sl["id"]]
+        hits = self._sorted(hits, body)
+        start = body.get("from", 0)
+        size = body.get("size", 10)
+        page = []
+        for h in hits[start:start + size]:
+            source = h["_source"]
+            if "_source" in body and body["_source"] is not True:
+                includes = body["_source"] if isinstance(body["_source"], list) else []
+                source = dict((k, v) for k, v in source.items() if k in includes)
+            hit = {"_index": h["_index"], "_id": h["_id"], "_source": source}
+            if "sort" in h:
+                hit["sort"] = h["sort"]
+            page.append(hit)
+        return {"hits": {"total": {"value": len(hits)}, "hits": page}}
+
+    def _search(self, index, body):
+        body = body or {}
+        try:
+            return 200, self._hits(self._matching(index, body), body)
+        except _Rejected as e:
+            return e.status, e.body
+
+    def _pit_search(self, body):
+        pit_id = body["pit"]["id"]
+        if pit_id not in self.pits:
+            return 404, {"error": {"type": "search_context_missing_exception"}}
+        index, docs = self.pits[pit_id]
+        hits = self._matching(index, body, docs)
+        for position, h in enumerate(hits):
+            h["_shard_doc"] = position
+        try:
+            j = self._hits(hits, body)
+        except _Rejected as e:
+            return e.status, e.body
+        j["pit_id"] = pit_id
+        return 200, j
+
+    def _open_scroll(self, index, body):
+        body = dict(body or {})
+        size = body.pop("size", 10)
+        body["size"] = 1000000
+        hits = self._hits(self._matching(index, body), body)["hits"]["hits"]
+        scroll_id = "scroll" + str(next(self._ids))
+        self.scrolls[scroll_id] = {"hits": hits, "position": 0, "size": size}
+        return 200, self._scroll_page(scroll_id)
+
+    def _scroll_page(self, scroll_id):
+        s = self.scrolls[scroll_id]
+        page = s["hits"][s["position"]:s["position"] + s["size"]]
+        s["position"] += s["size"]
+        return {"_scroll_id": scroll_id, "hits": {"total": {"value": len(s["hits"])}, "hits": page}}
+
+    def _scroll(self, method, params, body):
+        if method == "DELETE":
+            for scroll_id in body.get("scroll_id", []):
+                self.scrolls.pop(scroll_id, None)
+            return 200, {"succeeded": True}
+        scroll_id = params.get("scroll_id") or body.get("scroll_id")
+        if scroll_id not in self.scrolls:
+            return 404, {"error": {"type": "search_context_missing_exception"}}
+        return 200, self._scroll_page(scroll_id)
+
+    ##################################################
+    # reads and writes by id
+
+    def _mget(self, body):
+        out = []
+        for d in body["docs"]:
+            index = d["_index"] + ("/" + d["_type"] if d.get("_type") else "")
+            source = self.indexes.get(index, {}).get(d["_id"])
+            doc = dict(d, found=source is not None)
+            doc.pop("_source", None)
+            if source is not None and d.get("_source", True) is not False:
+                doc["_source"] = source
+            out.append(doc)
+        return 200, {"docs": out}
+
+    def _bulk(self, index, body, params):
+        lines = [json.loads(l) for l in body.decode("utf-8").split("\n") if l.strip()]
+        items = []
+        errors = False
+        i = 0
+        while i < len(lines):
+            action = list(lines[i].keys())[0]
+            meta = lines[i][action]
+            target = meta.get("_index", index)
+            if meta.get("_type"):
+                target = target + "/" + meta["_type"]
+            id = meta.get("_id")
+            source = None
+            if action != "delete":
+                i += 1
+                source = lines[i]
+            i += 1
+
+            status = self.reject(action, id, source) if self.reject is not None else None
+            if status is not None:
+                errors = True
+                items.append({action: {"_id": id, "status": status, "error": {"type": "rejected"}}})
+                continue
+            docs = self.indexes.setdefault(target, {})
+            if action == "delete":
+                found = docs.pop(id, None) is not None
+                items.append({action: {"_id": id, "status": 200 if found else 404}})
+                continue
+            if id is None:
+                id = "auto" + str(next(self._ids))
+            docs[id] = source
+            items.append({action: {"_id": id, "status": 201}})
+        return 200, {"errors": errors, "items": items}
+
+
+class _Rejected(Exception):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+
+def _matches(query, doc):
+    if "match_all" in query:
+        return True
+    if "ids" in query:
+        return doc["_id"] in query["ids"]["values"]
+    if "term" in query:
+        field, value = list(query["term"].items())[0]
+        value = value.get("value") if isinstance(value, dict) else value
+        return _field(doc["_source"], field) == value
+    if "bool" in query:
+        must = query["bool"].get("must", [])
+        must = must if isinstance(must, list) else [must]
+        return all(_matches(q, doc) for q in must)
+    raise ValueError("the fake can't run query {0}".format(query))
+
+
+def _field(source, field):
+    for seg in field.split("."):
+        if not isinstance(source, dict) or seg not in source:
+            return None
+        source = source[seg]
+    return source
+
+
+def _sort_value(hit, field):
+    if field in ["_id", "_shard_doc"]:
+        return hit[field]
+    if field == "_uid":
+        return hit["_index"] + "#" + hit["_id"]
+    # keyword sub-fields sort on the value itself
+    if field.endswith(".exact"):
+        field = field[:-len(".exact")]
+    return _field(hit["_source"], field)
+
+
+def _missing_last(values):
+    # records without a value for a sort field come after all those with one, as with ES's default "missing": "_last"
+    return [(v is None, v if v is not None else "") for v in values]
+
+
+def _slice_of(id, slices):
+    return int(hashlib.md5(str(id).encode("utf-8")).hexdigest(), 16) % slices
+
+
+def _read_body(body):
+    if body is None:
+        return b""
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    if isinstance(body, bytes):
+        return body
+    if hasattr(body, "read"):
+        data = body.read()
+        return data.encode("utf-8") if isinstance(data, str) else data
+    return b"".join(c.encode("utf-8") if isinstance(c, str) else c for c in body)
+
+
+class FakeAdapter(BaseAdapter):
+    def __init__(self, es):
+        super(FakeAdapter, self).__init__()
+        self.es = es
+
+    def send(self, request, **kwargs):
+        self.es.timeouts.append((request.method, request.url, kwargs.get("timeout")))
+        data = _read_body(request.body)
+        if request.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        body = data
+        if not request.url.split("?")[0].endswith("_bulk"):
+            body = json.loads(data.decode("utf-8")) if data else None
+        status, reply = self.es.handle(request.method, request.url, body)
+
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = json.dumps(reply).encode("utf-8")
+        resp.headers["Content-Type"] = "application/json"
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+class FakeConnection(raw.Connection):
+    """ A raw.Connection whose requests all go to the given FakeES """
+    def __init__(self, es, index="test", host=None, **kwargs):
+        self.es = es
+        super(FakeConnection, self).__init__(host if host is not None else es.hosts, index, **kwargs)
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = FakeAdapter(self.es)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
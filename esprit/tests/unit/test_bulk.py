@@ -0,0 +1,242 @@
+from unittest import TestCase
+import array, gzip, io, json, os, tempfile, threading
+import requests
+from esprit import raw, tasks, util
+from esprit.tests.unit.fake import FakeES, FakeConnection
+
+
+class TestBulk(TestCase):
+    def test_01_to_bulk(self):
+        records = [{"id": "1", "a": "x"}, {"id": "2", "a": "y"}]
+        data = raw.to_bulk(records, index="idx")
+        lines = data.split("\n")
+        assert len(lines) == 5
+        assert lines[4] == ""
+        assert json.loads(lines[0]) == {"index": {"_id": "1", "_index": "idx"}}
+        assert json.loads(lines[1]) == records[0]
+        assert json.loads(lines[2]) == {"index": {"_id": "2", "_index": "idx"}}
+
+    def test_02_nested_idkey(self):
+        data = raw.to_bulk_single_rec({"admin": {"ref": "abc"}}, idkey="admin.ref")
+        assert json.loads(data.split("\n")[0]) == {"index": {"_id": "abc"}}
+
+        with self.assertRaises(raw.BulkException):
+            raw.to_bulk([{"id": "1"}, {"other": "2"}])
+
+    def test_03_streamed_body(self):
+        records = [{"id": str(i), "value": "x" * 100} for i in range(1000)]
+        body = raw.BulkBody(records, chunk_size=4096)
+        chunks = list(body)
+        assert len(chunks) > 1
+        for c in chunks[:-1]:
+            assert len(c) >= 4096
+        assert b"".join(chunks).decode("utf-8") == raw.to_bulk(records)
+
+        # the body can be streamed more than once
+        assert b"".join(body) == b"".join(chunks)
+
+    def test_04_streamed_delete_body(self):
+        ids = ["a", "b", "c"]
+        body = raw.BulkDeleteBody(ids)
+        assert b"".join(body).decode("utf-8") == raw.to_bulk_del(ids)
+        assert raw.to_bulk_del(ids).split("\n")[1] == json.dumps({"delete": {"_id": "b"}})
+
+    def test_05_bulk_result(self):
+        class Resp(object):
+            def __init__(self, status_code, body):
+                self.status_code = status_code
+                self.body = body
+                self.text = json.dumps(body)
+
+            def json(self):
+                return self.body
+
+        sent = []
+        responses = [
+            Resp(200, {"errors": True, "items": [
+                {"index": {"_id": "1", "status": 201}},
+                {"index": {"_id": "2", "status": 429, "error": {"type": "es_rejected_execution_exception"}}},
+                {"index": {"_id": "3", "status": 400, "error": {"type": "mapper_parsing_exception"}}}
+            ]}),
+            Resp(200, {"errors": False, "items": [{"index": {"_id": "2", "status": 201}}]})
+        ]
+
+        def post(url, conn, data=None, **kwargs):
+            sent.append(data)
+            return responses[len(sent) - 1]
+
+        original = raw._do_post
+        raw._do_post = post
+        try:
+            result = raw._send_bulk(None, "http://localhost:9200/_bulk", ["a", "b", "c"], list, backoff=0,
+                                    keep_successes=True)
+        finally:
+            raw._do_post = original
+
+        assert sent == [["a", "b", "c"], ["b"]]
+        assert not result.ok
+        assert result.failed_positions == [2]
+        assert sorted([x["position"] for x in result.successes]) == [0, 1]
+        assert result.summary() == {"succeeded": 2, "failed": 1, "requests": 2, "retries": 1,
+                                    "errors": {"mapper_parsing_exception": 1}}
+        assert result.status_code == 200
+
+        # merged results only count successes, unless asked to keep them
+        merged = raw.BulkResult().merge(result, offset=10).merge(result, offset=20)
+        assert merged.succeeded == 4 and merged.successes == []
+        assert merged.failed_positions == [12, 22]
+        kept = raw.BulkResult(keep_successes=True).merge(result, offset=10)
+        assert sorted([x["position"] for x in kept.successes]) == [10, 11]
+
+    def test_06_batcher(self):
+        records = [{"id": str(i), "value": "x" * 936} for i in range(100)]
+
+        batcher = raw.Batcher(max_records=30)
+        assert [len(b) for b in batcher.batches(records)] == [30, 30, 30, 10]
+
+        # each record is around 1000 bytes once the action line is allowed for
+        batcher = raw.Batcher(max_records=30, max_bytes=10500)
+        assert [len(b) for b in batcher.batches(records)] == [10] * 10
+
+        # a batch is sent as the JSON it was measured by, including when only some of it is retried
+        batch = next(raw.Batcher(max_records=3).batches([{"id": "1"}, {"id": "2"}, {"id": "3"}]))
+        batch[1]["changed"] = True
+        lines = b"".join(raw.BulkBody(batch.select([1, 2]))).decode("utf-8").split("\n")
+        assert [json.loads(l) for l in lines[1:4:2]] == [{"id": "2"}, {"id": "3"}]
+
+    def test_07_adaptive_batcher(self):
+        batcher = raw.AdaptiveBatcher(initial_bytes=1000, min_bytes=500, max_bytes=10000, increase_bytes=100,
+                                      target_latency=1.0)
+
+        # slow start doubles the target on each fast batch
+        batcher.observe(0.1, nbytes=1000)
+        assert batcher.target_bytes == 2000
+        batcher.observe(0.1, nbytes=2000)
+        assert batcher.target_bytes == 4000
+
+        # a slow batch halves it, after which it grows additively
+        batcher.observe(1.5, nbytes=4000)
+        assert batcher.target_bytes == 2000
+        batcher.observe(0.1, nbytes=2000)
+        assert batcher.target_bytes == 2100
+
+        # rejections also halve it, but never below the minimum
+        batcher.observe(0.1, rejected=5, total=10, nbytes=2100)
+        assert batcher.target_bytes == 1050
+        batcher.observe(0.1, rejected=5, total=10, nbytes=1050)
+        assert batcher.target_bytes == 525
+        batcher.observe(0.1, rejected=5, total=10, nbytes=525)
+        assert batcher.target_bytes == 500
+
+        # a batch which didn't fill the target doesn't grow it
+        batcher.observe(0.1, nbytes=10)
+        assert batcher.target_bytes == 500
+
+        # batches reported by several threads at once are each counted
+        batcher = raw.AdaptiveBatcher(initial_bytes=1000, min_bytes=500, max_bytes=100000, increase_bytes=1)
+        batcher.threshold = 1000
+        threads = [threading.Thread(target=lambda: [batcher.observe(0.1, nbytes=100000) for _ in range(250)])
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert batcher.target_bytes == 2000
+
+    def test_08_bulk_file_index(self):
+        data = raw.to_bulk([{"id": "1", "a": "x"}]) + "\n" + raw.to_bulk_del(["2"]) + raw.to_bulk([{"id": "3"}]).rstrip("\n")
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            index = tasks.BulkFileIndex.for_file(path, save=True)
+            assert len(index) == 3
+            assert tasks.BulkFileIndex.load(path).offsets == index.offsets
+
+            # only the action lines are copied out of the file as it is scanned, never the source lines
+            class Sliced(bytes):
+                taken = []
+
+                def __getitem__(self, key):
+                    if isinstance(key, slice):
+                        Sliced.taken.append(bytes.__getitem__(self, key))
+                    return bytes.__getitem__(self, key)
+
+            offsets = array.array("Q")
+            tasks.BulkFileIndex._scan(Sliced(data.encode("utf-8")), len(data), offsets)
+            assert offsets == index.offsets
+            assert [list(json.loads(line)) for line in Sliced.taken] == [["index"], ["delete"], ["index"]]
+
+            # each chunk is whole records, and oversized records get a chunk of their own
+            assert list(index.chunks(1)) == [(0, 1), (1, 2), (2, 3)]
+            assert list(index.chunks(len(data))) == [(0, 3)]
+            assert list(index.chunks(len(data), start=1, limit=1)) == [(1, 2)]
+
+            with index.mapped() as mm:
+                body = tasks._MappedRange(mm, *index.byte_range(1, 3)).read()
+            lines = body.decode("utf-8").split("\n")
+            assert json.loads(lines[0]) == {"delete": {"_id": "2"}}
+            assert json.loads(lines[2]) == {"id": "3"}
+            assert lines[3] == ""
+        finally:
+            os.remove(path)
+            os.remove(path + tasks.BulkFileIndex.SUFFIX)
+
+    def test_09_compressed(self):
+        body = b"".join(raw.GzipBody(raw.BulkBody([{"id": str(i)} for i in range(10)])))
+        assert gzip.decompress(body).decode("utf-8") == raw.to_bulk([{"id": str(i)} for i in range(10)])
+
+        # a stream of bulk data is chunked on record boundaries, with deletes taking a single line
+        data = raw.to_bulk([{"id": str(i)} for i in range(10)]) + raw.to_bulk_del(["x"])
+        chunks = list(tasks._stream_chunks(io.BytesIO(data.encode("utf-8")), raw.Batcher(), 60, start=2))
+        assert chunks[0][0] == 2
+        assert b"".join(c for _, c in chunks) == data.encode("utf-8").split(b"\n", 4)[4]
+        assert all(c.count(b"\n") <= 4 for _, c in chunks)
+
+        # compressed bulk files are decompressed as they are loaded, in several chunks
+        compressions = [util.GZIP] + ([util.ZSTD] if util.zstandard is not None else [])
+        data = raw.to_bulk([{"id": str(i), "value": "x" * 50} for i in range(20)]) + raw.to_bulk_del(["3"])
+        for compression in compressions:
+            path = tempfile.mktemp(suffix=util.COMPRESSION_EXTENSIONS[compression])
+            try:
+                with util.open_file(path, "wb") as f:
+                    f.write(data.encode("utf-8"))
+
+                es = FakeES()
+                tasks.bulk_load(FakeConnection(es), None, path, max_content_length=1000)
+                assert set(es.docs("test").keys()) == set(str(i) for i in range(20) if i != 3)
+                assert es.docs("test")["7"] == {"id": "7", "value": "x" * 50}
+                assert len(es.calls("POST", "_bulk")) > 1
+
+                # resuming part way through sends only the records from there, up to the limit
+                es = FakeES()
+                tasks.bulk_load(FakeConnection(es), None, path, start=15, limit=3)
+                assert sorted(es.docs("test").keys()) == ["15", "16", "17"]
+            finally:
+                os.remove(path)
+
+    def test_10_replay_on_failover(self):
+        es = FakeES(hosts=["http://node1:9200", "http://node2:9200"])
+        conn = FakeConnection(es)
+
+        def node1_down(method, host, path, body):
+            if host == "http://node1:9200":
+                raise requests.ConnectionError("node1 is down")
+            return None
+        es.fail = node1_down
+
+        # a body over a list can be sent again to the other node, in full
+        records = [{"id": str(i)} for i in range(5)]
+        for _ in range(2):
+            resp = raw.raw_bulk(conn, raw.BulkBody(records), idempotent=True)
+            assert resp.status_code == 200
+        assert len(es.docs("test")) == 5
+
+        # but one over a generator may already have been used up, so it is not sent again
+        for node in conn.nodes.nodes:
+            conn.nodes.mark_live(node)
+        conn.nodes._next = 1
+        with self.assertRaises(requests.ConnectionError):
+            raw.raw_bulk(conn, raw.BulkBody(r for r in [{"id": "x"}]), idempotent=True)
+        assert raw.GzipBody(raw.BulkBody(records)).replayable
+        assert not raw.GzipBody(raw.BulkBody(iter(records))).replayable
@@ -0,0 +1,134 @@
+from unittest import TestCase, mock
+import os
+import requests, urllib3
+from esprit import raw
+from esprit.tests.unit.fake import FakeES, FakeConnection
+
+
+def _down(*hosts, refused=False):
+    """ A FakeES.fail for nodes which can't be reached: either refusing the connection, or dropping it mid-request """
+    def fail(method, host, path, body):
+        if host in hosts:
+            if refused:
+                reason = urllib3.exceptions.NewConnectionError(None, "connection refused")
+                raise requests.ConnectionError(urllib3.exceptions.MaxRetryError(None, host + path, reason))
+            raise requests.ConnectionError("connection dropped")
+        return None
+    return fail
+
+
+def _first_node_next(conn):
+    """ Bring every node back to life, and make the first the next to be selected """
+    for node in conn.nodes.nodes:
+        conn.nodes.mark_live(node)
+    conn.nodes._next = len(conn.nodes.nodes) - 1
+
+
+class TestConnection(TestCase):
+    def test_01_failover(self):
+        es = FakeES(hosts=["http://node1:9200", "http://node2:9200"])
+        es.add("test", [{"id": "1"}])
+        conn = FakeConnection(es)
+        es.fail = _down("http://node1:9200")
+
+        # requests which can be applied twice are sent again to another node
+        _first_node_next(conn)
+        assert raw.search(conn).status_code == 200
+        assert [c[1] for c in es.calls("POST", "_search")] == ["http://node1:9200", "http://node2:9200"]
+
+        _first_node_next(conn)
+        assert raw.store(conn, None, {"id": "2"}, id="2").status_code in [200, 201]
+
+        _first_node_next(conn)
+        assert raw.bulk(conn, [{"id": "3"}]).ok
+        assert sorted(es.docs("test").keys()) == ["1", "2", "3"]
+
+        # but those which may have been applied already are not
+        _first_node_next(conn)
+        with self.assertRaises(requests.ConnectionError):
+            raw.store(conn, None, {"title": "no id"})
+        assert es.calls("POST", "_doc")[-1][1] == "http://node1:9200"
+
+        es.fail = None
+        scroll_id = raw.unpack_scroll(raw.initialise_scroll(conn, query={"query": {"match_all": {}}, "size": 1}))[1]
+        es.fail = _down("http://node1:9200")
+        _first_node_next(conn)
+        with self.assertRaises(requests.ConnectionError):
+            raw.scroll_next(conn, scroll_id)
+        assert es.calls("GET", "_search/scroll")[-1][1] == "http://node1:9200"
+
+        _first_node_next(conn)
+        with self.assertRaises(requests.ConnectionError):
+            raw.bulk(conn, [{"id": "4"}], bulk_type="create")
+        assert es.calls("POST", "_bulk")[-1][1] == "http://node1:9200"
+
+        # unless the node refused the connection, so never saw the request
+        es.fail = _down("http://node1:9200", refused=True)
+        _first_node_next(conn)
+        assert raw.bulk(conn, [{"id": "4"}], bulk_type="create").ok
+        assert es.calls("POST", "_bulk")[-1][1] == "http://node2:9200"
+
+        # and when every node is down, the request is given up on after the connection's max_retries
+        es.fail = _down("http://node1:9200", "http://node2:9200")
+        _first_node_next(conn)
+        before = len(es.calls("GET"))
+        with self.assertRaises(requests.ConnectionError):
+            raw.get(conn, None, "1")
+        assert len(es.calls("GET")) - before == conn.max_retries + 1
+
+    def test_02_sniff(self):
+        es = FakeES(hosts=["http://node1:9200", "http://node2:9200", "http://node3:9200"])
+        es.add("test", [{"id": "1"}])
+
+        # the connection is made to one seed host, and discovers the rest of the cluster from it
+        conn = FakeConnection(es, host="http://seed:9200", sniff_on_start=True)
+        assert conn.hosts == es.hosts
+
+        # after which requests are spread across the cluster's nodes, and fail over between them
+        for _ in range(3):
+            raw.get(conn, None, "1")
+        assert sorted(c[1] for c in es.calls("GET", "_doc")) == es.hosts
+
+        es.fail = _down("http://node2:9200")
+        for _ in range(3):
+            assert raw.get(conn, None, "1").status_code == 200
+        assert not conn.nodes.nodes[1].alive
+
+        # a sniff which can't reach the cluster keeps the nodes it has
+        es.fail = _down(*es.hosts)
+        conn.sniff()
+        assert conn.hosts == es.hosts
+
+    def test_03_session(self):
+        es = FakeES()
+        es.add("test", [{"id": "1"}])
+        conn = FakeConnection(es)
+        made = []
+        make_session = conn._make_session
+        conn._make_session = lambda: made.append(make_session()) or made[-1]
+
+        # every request goes through the one pooled session
+        session = conn.session
+        for _ in range(3):
+            assert raw.get(conn, None, "1").status_code == 200
+        raw.search(conn)
+        assert conn.session is session and len(made) == 1
+
+        # until the connection finds itself in a forked process, which gets a session of its own
+        with mock.patch("os.getpid", return_value=os.getpid() + 1):
+            assert raw.get(conn, None, "1").status_code == 200
+            assert conn.session is not session and len(made) == 2
+            forked = conn.session
+            raw.get(conn, None, "1")
+            assert conn.session is forked and len(made) == 2
+
+    def test_04_timeouts(self):
+        es = FakeES()
+        es.add("test", [{"id": "1"}])
+        conn = FakeConnection(es, timeout=5, timeouts={"search": 30, "get": (1, 2)})
+
+        # each request is sent with the timeout for its operation, then for its method, then the default
+        raw.search(conn)
+        raw.get(conn, None, "1")
+        raw.store(conn, None, {"id": "2"}, id="2")
+        assert [t[2] for t in es.timeouts] == [30, (1, 2), 5]
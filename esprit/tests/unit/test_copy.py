@@ -0,0 +1,219 @@
+from unittest import TestCase
+import json, os, shutil, tempfile
+import requests
+from esprit import tasks, util
+from esprit.tests.unit.fake import FakeES, FakeConnection
+
+
+def _records(n):
+    return [{"id": "{0:04d}".format(i), "n": i} for i in range(n)]
+
+
+def _crash_on_bulk(es, n):
+    """ A FakeES.fail which raises on the nth _bulk request, as if the process died before sending it """
+    seen = []
+
+    def fail(method, host, path, body):
+        if path.endswith("_bulk"):
+            seen.append(path)
+            if len(seen) == n:
+                es.requests.pop()
+                raise RuntimeError("crashed")
+        return None
+    return fail
+
+
+def _crash_at(n):
+    """ A dump transform which raises at the record numbered n, as if the process died there """
+    def transform(record):
+        if record["n"] == n:
+            raise RuntimeError("crashed")
+        return record
+    return transform
+
+
+def _bulk_ids(es):
+    """ The id of every record indexed by the _bulk requests made, as often as it was sent """
+    ids = []
+    for call in es.calls("POST", "_bulk"):
+        lines = [json.loads(l) for l in call[4].decode("utf-8").split("\n") if l.strip()]
+        ids += [l["index"]["_id"] for l in lines if "index" in l]
+    return ids
+
+
+def _dumped_ids(files):
+    """ The ids of the records in a set of dumped bulk files, sorted, as often as each was written """
+    ids = []
+    for f in files:
+        with util.open_file(f, "rt") as lines:
+            ids += [json.loads(l)["id"] for l in lines if "index" not in json.loads(l)]
+    return sorted(ids)
+
+
+class TestCopy(TestCase):
+    def test_01_server_reindex_cluster(self):
+        es = FakeES(hosts=["http://node1:9200"])
+        source = FakeConnection(es, "source")
+        # the same cluster, reached through another of its nodes
+        target = FakeConnection(es, "target", host="http://10.0.0.2:9200")
+
+        tasks.server_reindex(source, None, target, None)
+        body = es.calls("POST", "_reindex")[-1][4]
+        assert "remote" not in body["source"]
+
+        # another cluster is reindexed from remotely, passing on basic auth
+        other = FakeES(cluster_uuid="other-cluster", hosts=["http://node1:9200"])
+        remote = FakeConnection(other, "target", auth=("user", "pass"))
+        tasks.server_reindex(remote, None, target, None)
+        body = es.calls("POST", "_reindex")[-1][4]
+        assert body["source"]["remote"]["username"] == "user"
+        assert body["source"]["remote"]["password"] == "pass"
+
+        # but other kinds of auth can't be passed on
+        remote.auth = requests.auth.HTTPDigestAuth("user", "pass")
+        with self.assertRaises(tasks.ReindexRemoteException):
+            tasks.server_reindex(remote, None, target, None)
+
+    def test_02_pipeline(self):
+        es = FakeES()
+        es.add("source", _records(95))
+        source = FakeConnection(es, "source")
+        target = FakeConnection(es, "target")
+
+        # failures are reported at the position of their record in the source, whichever writer sent it
+        es.reject = lambda action, id, record: 400 if record["n"] in [5, 42, 93] else None
+        result = tasks.CopyPipeline(source, None, target, None, batch_size=10, writers=4).run()
+        assert sorted(result.failed_positions) == [5, 42, 93]
+        assert result.succeeded == 92
+        assert len(es.docs("target")) == 92
+
+        # the limit caps the number of records copied
+        es.reject = None
+        target = FakeConnection(es, "limited")
+        tasks.CopyPipeline(source, None, target, None, limit=25, batch_size=10, writers=2).run()
+        assert len(es.docs("limited")) == 25
+
+    def test_03_pipeline_transform(self):
+        es = FakeES()
+        es.add("source", _records(50))
+        source = FakeConnection(es, "source")
+        target = FakeConnection(es, "target")
+
+        # records the transform returns None for are dropped, even where that leaves a batch empty
+        def evens(record):
+            if record["n"] % 2 == 1 or 20 <= record["n"] < 30:
+                return None
+            record["even"] = True
+            return record
+
+        result = tasks.CopyPipeline(source, None, target, None, batch_size=10, writers=3, transform=evens).run()
+        assert result.succeeded == 20
+        assert sorted(r["n"] for r in es.docs("target").values()) == [n for n in range(0, 50, 2) if not 20 <= n < 30]
+        assert all(r["even"] for r in es.docs("target").values())
+
+    def test_04_pipeline_writer_error(self):
+        es = FakeES()
+        es.add("source", _records(50))
+        source = FakeConnection(es, "source")
+        target = FakeConnection(es, "target")
+
+        # an error in a writer stops the copy and is raised from run()
+        def fail(method, host, path, body):
+            if "_bulk" in path and len(es.calls("POST", "_bulk")) > 2:
+                raise ValueError("writer failed")
+            return None
+
+        es.fail = fail
+        with self.assertRaises(ValueError):
+            tasks.CopyPipeline(source, None, target, None, batch_size=5, writers=2, queue_batches=1).run()
+        assert len(es.docs("target")) < 50
+
+    def test_05_copy_resume(self):
+        es = FakeES()
+        es.add("source", _records(95))
+        source = FakeConnection(es, "source")
+        target = FakeConnection(es, "target")
+        path = tempfile.mktemp(suffix=".checkpoint")
+        try:
+            # a copy which dies part way through leaves its checkpoint behind
+            es.fail = _crash_on_bulk(es, 4)
+            with self.assertRaises(RuntimeError):
+                tasks.copy(source, None, target, None, batch_size=10, tiebreaker="id.exact",
+                           checkpoint=tasks.Checkpoint(path, interval=0))
+            assert os.path.exists(path)
+            assert len(es.docs("target")) == 30
+
+            # and running it again carries on from there, sending each record exactly once
+            es.fail = None
+            result = tasks.copy(source, None, target, None, batch_size=10, tiebreaker="id.exact",
+                                checkpoint=tasks.Checkpoint(path, interval=0))
+            assert result.succeeded == 65
+            assert not os.path.exists(path)
+            assert sorted(_bulk_ids(es)) == [r["id"] for r in _records(95)]
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_06_dump_resume(self):
+        es = FakeES()
+        es.add("test", _records(60))
+        conn = FakeConnection(es)
+        tmp = tempfile.mkdtemp()
+        try:
+            # an unsliced dump is truncated back to its last checkpoint, even part way through a compressed file
+            kwargs = {"page_size": 10, "out_batch_sizes": 25, "compression": util.GZIP, "tiebreaker": "id.exact"}
+            template = os.path.join(tmp, "dump")
+            with self.assertRaises(RuntimeError):
+                tasks.dump(conn, None, out_template=template, transform=_crash_at(37),
+                           checkpoint=tasks.Checkpoint(template + ".checkpoint", interval=0), **kwargs)
+            files = tasks.dump(conn, None, out_template=template,
+                               checkpoint=tasks.Checkpoint(template + ".checkpoint", interval=0), **kwargs)
+            assert len(files) == 3
+            assert _dumped_ids(files) == [r["id"] for r in _records(60)]
+
+            # a sliced dump keeps the files of the slices which finished, and writes the others again
+            template = os.path.join(tmp, "sliced")
+            kwargs = {"page_size": 5, "out_batch_sizes": 10, "slices": 3}
+            with self.assertRaises(RuntimeError):
+                tasks.dump(conn, None, out_template=template, transform=_crash_at(37),
+                           checkpoint=tasks.Checkpoint(template + ".checkpoint", interval=0), **kwargs)
+            state = tasks.Checkpoint(template + ".checkpoint").state
+            assert 0 < len(state["slices"]) < 3
+            files = tasks.dump(conn, None, out_template=template,
+                               checkpoint=tasks.Checkpoint(template + ".checkpoint", interval=0), **kwargs)
+            assert _dumped_ids(files) == [r["id"] for r in _records(60)]
+            assert not os.path.exists(template + ".checkpoint")
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_07_sliced_dump(self):
+        es = FakeES()
+        es.add("test", _records(95))
+        conn = FakeConnection(es)
+        tmp = tempfile.mkdtemp()
+        try:
+            # each slice rolls over its own series of files, handing each to the callback once it's complete
+            template = os.path.join(tmp, "dump")
+            completed = []
+            files = tasks.dump(conn, None, out_template=template, out_batch_sizes=10, slices=3, page_size=7,
+                               compression=util.GZIP, out_rollover_callback=completed.append)
+            assert sorted(completed) == sorted(files)
+            assert all(os.path.basename(f).startswith("dump.s") and f.endswith(".gz") for f in files)
+            assert _dumped_ids(files) == [r["id"] for r in _records(95)]
+
+            with open(template + ".manifest.json") as f:
+                manifest = json.load(f)
+            assert manifest["slices"] == 3 and manifest["records"] == 95
+            for slice_id in range(3):
+                entries = [e for e in manifest["files"] if e["slice"] == slice_id]
+                assert [e["file"] for e in entries] == [template + ".s{0}.{1}.gz".format(slice_id, n)
+                                                        for n in range(1, len(entries) + 1)]
+                assert all(e["records"] == 10 for e in entries[:-1]) and 0 < entries[-1]["records"] <= 10
+                assert all(e["complete"] and e["bytes"] == os.path.getsize(e["file"]) for e in entries)
+
+            # the limit is shared between the slices
+            template = os.path.join(tmp, "limited")
+            files = tasks.dump(conn, None, out_template=template, out_batch_sizes=10, slices=3, page_size=7, limit=25)
+            assert len(_dumped_ids(files)) == 25 and len(set(_dumped_ids(files))) == 25
+        finally:
+            shutil.rmtree(tmp)
@@ -0,0 +1,232 @@
+from unittest import TestCase
+import re, threading, time
+from esprit import dao, raw, util
+from esprit.tests.unit.fake import FakeES, FakeConnection
+
+
+def _domain_object(conn, types="thing", version="7.10.0"):
+    read_types = types if isinstance(types, list) else [types]
+
+    class Thing(dao.DomainObject):
+        __type__ = read_types[0]
+        __conn__ = conn
+        __es_version__ = version
+
+        @classmethod
+        def dynamic_read_types(cls):
+            return read_types
+
+    return Thing
+
+
+class TestDAO(TestCase):
+    def test_01_actions_concurrency(self):
+        es = FakeES()
+        es.add("test/thing", [{"id": str(i), "k": i} for i in range(40)])
+        conn = FakeConnection(es)
+        Thing = _domain_object(conn)
+
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def slow_delete_by_query(method, host, path, body):
+            if path.endswith("_delete_by_query"):
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                time.sleep(0.01)
+                with lock:
+                    in_flight[0] -= 1
+            return None
+        es.fail = slow_delete_by_query
+
+        queue = [{"remove": {"index": "thing", "query": {"query": {"term": {"k": i}}}}} for i in range(30)]
+        report = Thing().actions(conn, queue, concurrency=3)
+        assert sum([r["deleted"] for r in report]) == 30
+        assert len(es.docs("test/thing")) == 10
+        assert 1 < in_flight[1] <= 3
+
+        # stores ahead of a remove by query are made visible to search first, so that it sees them
+        es.fail = None
+        queue = [{"store": {"index": "thing", "record": {"id": "new", "k": 99}}},
+                 {"remove": {"index": "thing", "query": {"query": {"term": {"k": 99}}}}},
+                 {"store": {"index": "thing", "record": {"id": "last", "k": 99}}}]
+        report = Thing().actions(conn, queue)
+        assert report[1]["deleted"] == 1
+        assert [c[3].get("refresh") for c in es.calls("POST", "_bulk")] == ["wait_for", None]
+
+    def test_02_unit_of_work_reads_and_flushes(self):
+        es = FakeES()
+        es.add("test/thing", [{"id": "old", "v": 0}])
+        conn = FakeConnection(es)
+        Thing = _domain_object(conn, ["thing", "other"])
+        uow = Thing.unit_of_work()
+
+        # pending writes are seen through the unit of work, without asking the index
+        uow.save(Thing({"id": "a", "v": 1}))
+        uow.save(Thing({"id": "a", "v": 2}))
+        uow.save(Thing({"id": "b", "v": 1}), type="other")
+        uow.delete(Thing({"id": "old"}))
+        assert Thing.pull("a", uow=uow).data["v"] == 2
+        assert Thing.pull("old", uow=uow) is None
+        assert len(es.calls(endpoint="_mget")) == 0
+        assert Thing.pull("a") is None
+        assert Thing.pull("old").data["v"] == 0
+
+        # the flush sends one _bulk per type, with only the last write to each id
+        result = uow.commit()
+        assert result.ok and len(uow) == 0
+        assert len(es.calls("POST", "_bulk")) == 2
+        assert es.docs("test/thing")["a"]["v"] == 2
+        assert "old" not in es.docs("test/thing")
+        assert "b" in es.docs("test/other")
+        assert uow.result.succeeded == 4
+
+        # removals by query go to the endpoint for the class's version
+        uow.store("thing", {"id": "c", "v": 3})
+        uow.remove("thing", query={"query": {"term": {"v": 3}}})
+        uow.commit()
+        assert len(es.calls("POST", "_delete_by_query")) == 1
+        # once the writes before it have been made visible to search
+        assert es.calls("POST", "_bulk")[-1][3].get("refresh") == "wait_for"
+        assert "c" not in es.docs("test/thing")
+
+    def test_03_unit_of_work_triggers(self):
+        es = FakeES()
+        conn = FakeConnection(es)
+        Thing = _domain_object(conn)
+
+        uow = Thing.unit_of_work(max_ops=3)
+        uow.save(Thing({"id": "a"}))
+        uow.save(Thing({"id": "b"}))
+        assert len(es.docs("test/thing")) == 0
+        uow.save(Thing({"id": "c"}))
+        assert len(es.docs("test/thing")) == 3 and len(uow) == 0
+
+        # max_age is checked when the pending writes are next read, as well as written
+        uow = Thing.unit_of_work(max_age=0.05)
+        uow.save(Thing({"id": "d"}))
+        assert Thing.pull("d", uow=uow) is not None
+        assert "d" not in es.docs("test/thing")
+        time.sleep(0.06)
+        assert Thing.pull("d", uow=uow) is not None
+        assert "d" in es.docs("test/thing") and len(uow) == 0
+
+    def test_04_save_all(self):
+        es = FakeES()
+        conn = FakeConnection(es)
+        Thing = _domain_object(conn)
+
+        # some items are refused outright, and one is rejected once as the cluster is busy, then accepted
+        busy = []
+
+        def reject(action, id, record):
+            if record["k"] in [3, 17, 24]:
+                return 400
+            if record["k"] == 12 and len(busy) == 0:
+                busy.append(id)
+                return 429
+            return None
+        es.reject = reject
+
+        def things():
+            for i in range(25):
+                yield Thing({"id": "{0:04d}".format(i), "k": i})
+
+        result = Thing.save_all(things(), batcher=raw.Batcher(max_records=10), blocking=True, max_retries=1)
+        assert result.succeeded == 22 and busy == ["0012"]
+        assert sorted(result.failed_positions) == [3, 17, 24]
+
+        # each failure carries the object it was for, whichever batch it was in
+        for failure in result.failures:
+            assert failure["object"].data["k"] == failure["position"]
+            assert failure["object"].id == failure["_id"]
+        assert len(es.docs("test/thing")) == 22
+        assert all(c[3] == {"refresh": "wait_for"} for c in es.calls("POST", "_bulk"))
+        assert all("created_date" in r for r in es.docs("test/thing").values())
+
+    def test_05_pull_many(self):
+        es = FakeES()
+        es.add("test/thing", [{"id": str(i), "type": "thing"} for i in range(0, 10, 2)])
+        es.add("test/other", [{"id": str(i), "type": "other"} for i in range(0, 10, 3)])
+        conn = FakeConnection(es)
+        Thing = _domain_object(conn, ["thing", "other"])
+
+        # the objects come back in the order of the ids, with None for those not found, and each from the first
+        # type which has it
+        ids = ["9", "1", "0", "3", "missing", "4", "9"]
+        things = Thing.pull_many(ids, chunk_size=3)
+        assert [t.data if t is not None else None for t in things] == [
+            {"id": "9", "type": "other"}, None, {"id": "0", "type": "thing"}, {"id": "3", "type": "other"}, None,
+            {"id": "4", "type": "thing"}, {"id": "9", "type": "other"}]
+
+        # with one _mget request for each chunk of ids, looking in every type at once
+        assert len(es.calls("POST", "_mget")) == 3
+        assert len(es.calls("GET")) == 0
+
+        assert Thing.pull_many(["6", "nope"], wrap=False) == [{"id": "6", "type": "thing"}, None]
+        assert Thing.pull_many([]) == []
+
+    def test_06_locate(self):
+        es = FakeES()
+        es.add("test/thing", [{"id": "a", "type": "thing"}, {"id": "both", "type": "thing"}])
+        es.add("test/other", [{"id": "b", "type": "other"}, {"id": "both", "type": "other"}])
+        conn = FakeConnection(es)
+        Thing = _domain_object(conn, ["thing", "other"])
+
+        # pull looks in all the types with a single _mget, and takes the record from the first which has it
+        assert Thing.pull("b").data == {"id": "b", "type": "other"}
+        assert Thing.pull("both").data == {"id": "both", "type": "thing"}
+        assert Thing.pull("missing") is None
+        assert len(es.calls("POST", "_mget")) == 3 and len(es.calls("GET")) == 0
+
+        # delete finds which types hold the record in the same way, and only deletes it from those
+        Thing({"id": "b"}).delete()
+        assert [c[2] for c in es.calls("DELETE")] == ["/test/other/_doc/b"]
+        # without fetching the record itself
+        assert all(d["_source"] is False for d in es.calls("POST", "_mget")[-1][4]["docs"])
+        Thing({"id": "both"}).delete()
+        assert sorted(c[2] for c in es.calls("DELETE")[1:]) == ["/test/other/_doc/both", "/test/thing/_doc/both"]
+        Thing({"id": "missing"}).delete()
+        assert len(es.calls("DELETE")) == 3 and len(es.calls("POST", "_mget")) == 6
+        assert list(es.docs("test/thing").keys()) == ["a"] and len(es.docs("test/other")) == 0
+
+        # with only one type, there is nothing to look for and the delete is made straight away
+        Single = _domain_object(conn, "thing")
+        Single({"id": "a"}).delete()
+        assert len(es.calls("POST", "_mget")) == 6 and len(es.docs("test/thing")) == 0
+
+    def test_07_iterate(self):
+        records = [{"id": "{0:04d}".format(i), "k": "a" if i % 3 == 0 else "b"} for i in range(9)]
+        for version in ["1.7.5", "7.10.2", "7.17.0"]:
+            es = FakeES(version=version)
+            es.add("test/thing", records)
+            conn = FakeConnection(es)
+            Thing = _domain_object(conn, version=version)
+
+            # every class can iterate, whether it reads from a point in time or sorts on its version's id field
+            assert [t.id for t in Thing.iterall(page_size=2)] == [r["id"] for r in records]
+
+            # and the query arguments are applied the same way on either route
+            things = Thing.iterate({"query": {"match_all": {}}}, page_size=2, terms={"k": "a"})
+            assert [t.id for t in things] == ["0000", "0003", "0006"]
+            assert len(es.pits) == 0
+
+    def test_08_blocking_save(self):
+        es = FakeES()
+        conn = FakeConnection(es)
+        Thing = _domain_object(conn)
+
+        # a blocking save has the index make the record searchable before it responds, rather than polling for it
+        thing = Thing({"id": "a"})
+        thing.save(blocking=True)
+        assert es.calls("PUT", "_doc")[-1][3] == {"refresh": "wait_for"}
+        assert len(es.calls(endpoint="_search")) == 0
+
+        # and saves in quick succession are stamped apart, without waiting for the clock to move on
+        first = thing.last_updated
+        time.sleep(0.002)
+        thing.save(blocking=True)
+        assert thing.last_updated > first
+        assert len(es.calls("PUT", "_doc")) == 2 and len(es.calls(endpoint="_search")) == 0
+        assert re.match(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z$", util.now())
@@ -0,0 +1,318 @@
+from unittest import TestCase
+import gc, io, json, time
+import requests
+from esprit import tasks
+from esprit.tests.unit.fake import FakeES, FakeConnection
+
+
+def _records(n):
+    return [{"id": "{0:04d}".format(i), "n": i} for i in range(n)]
+
+
+def _fail_search(numbers, status=503):
+    """ A FakeES.fail which fails the searches with the given (1-based) numbers """
+    seen = []
+
+    def fail(method, host, path, body):
+        if path.endswith("_search"):
+            seen.append(path)
+            if len(seen) in numbers:
+                return status, {"error": {"type": "unavailable"}}
+        return None
+    return fail
+
+
+class TestSearch(TestCase):
+    def setUp(self):
+        self.search_backoff = tasks.SEARCH_BACKOFF
+        tasks.SEARCH_BACKOFF = 0
+
+    def tearDown(self):
+        tasks.SEARCH_BACKOFF = self.search_backoff
+
+    def test_01_failed_search_raises(self):
+        es = FakeES()
+        es.add("test", _records(25))
+        conn = FakeConnection(es)
+
+        # a search which keeps failing is an error, not the end of the results
+        es.fail = _fail_search(range(2, 100))
+        with self.assertRaises(tasks.SearchException):
+            list(tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10, tiebreaker="id"))
+
+        # but one which fails only briefly is retried, and nothing is lost
+        es.fail = _fail_search([2])
+        records = list(tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10, tiebreaker="id"))
+        assert [r["n"] for r in records] == list(range(25))
+
+        # errors reported in a successful response are not taken for an empty page either
+        es.fail = _fail_search([2], status=200)
+        with self.assertRaises(tasks.SearchException):
+            list(tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10, tiebreaker="id"))
+
+    def test_02_diff(self):
+        es = FakeES(version="8.11.0")
+        source = [{"id": "{0:04d}".format(i), "last_updated": "2020", "body": "x" * 100} for i in range(30)]
+        target = [dict(r) for r in source if r["id"] not in ["0003", "0020"]]
+        target[5]["last_updated"] = "2021"
+        target.append({"id": "0100", "last_updated": "2020"})
+        es.add("source", source)
+        es.add("target", target)
+
+        differences = list(tasks.diff([FakeConnection(es, "source"), FakeConnection(es, "target")], None,
+                                      page_size=7))
+        assert differences == [(tasks.DIFF_MISSING, "0003", 1), (tasks.DIFF_CHANGED, "0006", 1),
+                               (tasks.DIFF_MISSING, "0020", 1), (tasks.DIFF_EXTRA, "0100", 1)]
+
+        # it sorts on the keyword id field, never _id, and reads only the field it compares
+        searches = [r[4] for r in es.calls("POST", "_search")]
+        assert all(s["sort"] == [{"id.exact": {"order": "asc"}}] for s in searches)
+        assert all(s["_source"] == ["last_updated"] for s in searches)
+
+        # records without the id field can't be matched up, so are left out rather than breaking the merge
+        es.add("source", [{"id": None, "n": "x1"}, {"n": "x2"}], idkey="n")
+        es.add("target", [{"n": "x3"}], idkey="n")
+        assert list(tasks.diff([FakeConnection(es, "source"), FakeConnection(es, "target")], None,
+                               page_size=7)) == differences
+
+    def test_03_tiebreaker(self):
+        es = FakeES(version="8.11.0")
+        es.add("test", _records(25))
+        conn = FakeConnection(es)
+
+        # without a tiebreaker, a recent cluster is read from a point in time, sorted on _shard_doc
+        records = tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10)
+        assert [r["n"] for r in records] == list(range(25))
+        assert len(es.calls("POST", "_pit")) == 1 and len(es.pits) == 0
+        sorts = [r[4]["sort"] for r in es.calls("POST", "_search")]
+        assert len(sorts) == 3 and all(s == [{"_shard_doc": {"order": "asc"}}] for s in sorts)
+
+        # the point in time is closed if the iteration stops early, too
+        records = tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10)
+        next(records)
+        records.close()
+        assert len(es.pits) == 0
+
+        # and isn't opened at all until the first record is asked for, so an iterator left unread holds nothing open
+        records = tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10)
+        assert len(es.calls("POST", "_pit")) == 2 and len(es.pits) == 0
+        next(records)
+        assert len(es.calls("POST", "_pit")) == 3
+        records.close()
+
+        # the cluster's version is only asked for once
+        assert len([c for c in es.calls("GET") if c[2] == "/"]) == 1 and conn.es_version == "8.11.0"
+
+        # an older cluster sorts on the id instead, by whichever field its version can
+        for version, field in [("7.10.2", "_id"), ("6.8.0", "_uid")]:
+            es.version = version
+            conn = FakeConnection(es)
+            before = len(es.calls("POST", "_search"))
+            records = tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10)
+            assert [r["n"] for r in records] == list(range(25))
+            sorts = [r[4]["sort"] for r in es.calls("POST", "_search")[before:]]
+            assert len(sorts) == 3 and all(s == [{field: {"order": "asc"}}] for s in sorts)
+
+        # as does copying from one, which has no way to ask for anything else
+        target = FakeConnection(es, "target")
+        tasks.copy(conn, None, target, None, batch_size=10)
+        assert len(es.docs("target")) == 25
+
+        # the version can be given rather than asked for, and a tiebreaker overrides the default
+        es.version = "7.10.2"
+        conn = FakeConnection(es, es_version="7.10.2")
+        before = len(es.calls("POST", "_search"))
+        records = tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10, tiebreaker="id.exact")
+        assert [r["n"] for r in records] == list(range(25))
+        assert not any("_id" in json.dumps(r[4].get("sort")) for r in es.calls("POST", "_search")[before:])
+        assert len([c for c in es.calls("GET") if c[2] == "/"]) == 3
+
+    def test_04_parallel_scroll(self):
+        es = FakeES()
+        es.add("test", _records(95))
+        conn = FakeConnection(es)
+
+        # the slices' records are merged into one stream, each record exactly once
+        records = list(tasks.parallel_scroll(conn, None, slices=3, page_size=10))
+        assert sorted(r["n"] for r in records) == list(range(95))
+        assert len(set(c[4]["slice"]["id"] for c in es.calls("POST", "_search") if "slice" in (c[4] or {}))) == 3
+        assert len(es.scrolls) == 0 and conn.open_scrolls == 0
+
+        # and the limit applies across all of them
+        records = list(tasks.parallel_scroll(conn, None, slices=3, page_size=10, limit=40))
+        assert len(records) == 40 and len(set(r["id"] for r in records)) == 40
+        assert len(es.scrolls) == 0
+
+        # with a callback, each slice's records are handed over separately, sharing the limit between them
+        def collect(slice_id, slice_records):
+            return [r["n"] for r in slice_records]
+
+        slices = tasks.parallel_scroll(conn, None, slices=3, page_size=10, callback=collect)
+        assert len(slices) == 3 and all(len(s) > 0 for s in slices)
+        assert sorted(n for s in slices for n in s) == list(range(95))
+
+        slices = tasks.parallel_scroll(conn, None, slices=3, page_size=10, limit=25, callback=collect)
+        assert sum(len(s) for s in slices) == 25
+        assert len(set(n for s in slices for n in s)) == 25
+        assert len(es.scrolls) == 0
+
+    def test_05_prefetch(self):
+        es = FakeES()
+        es.add("test", _records(95))
+        conn = FakeConnection(es)
+
+        # pages fetched ahead come out in order, just as without prefetching
+        records = tasks.scroll(conn, None, page_size=10, prefetch=2)
+        assert [r["n"] for r in records] == list(range(95))
+        assert len(es.scrolls) == 0
+
+        # the next pages are fetched while the caller is still on the first
+        with tasks.scroll(conn, None, page_size=10, prefetch=2) as records:
+            assert next(records)["n"] == 0
+            deadline = time.time() + 5
+            while len(es.calls("GET", "_search/scroll")) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            assert len(es.calls("GET", "_search/scroll")) >= 2
+
+        # and closing it part way through releases the scroll, however far ahead it had got
+        assert len(es.scrolls) == 0 and conn.open_scrolls == 0
+
+        # an error fetching ahead is raised when the caller reaches it, after the pages before it
+        before = len(es.calls("GET", "_search/scroll"))
+
+        def expire(method, host, path, body):
+            if path.endswith("_search/scroll") and len(es.calls("GET", "_search/scroll")) - before > 2:
+                return 404, {"error": {"type": "search_context_missing_exception"}}
+            return None
+
+        es.fail = expire
+        seen = []
+        with self.assertRaises(tasks.ScrollTimeoutException):
+            for r in tasks.scroll(conn, None, page_size=10, prefetch=2):
+                seen.append(r["n"])
+        assert seen == list(range(30))
+
+        # search_after paging can be prefetched too
+        es.fail = None
+        records = tasks.iterate(conn, None, {"query": {"match_all": {}}}, page_size=10, prefetch=2, tiebreaker="id")
+        assert [r["n"] for r in records] == list(range(95))
+
+    def test_06_clear_scroll(self):
+        es = FakeES()
+        es.add("test", _records(95))
+        conn = FakeConnection(es)
+
+        def cleared():
+            return [c[4]["scroll_id"] for c in es.calls("DELETE", "_search/scroll")]
+
+        # a caller which stops early and closes the scroll releases its context straight away
+        records = tasks.scroll(conn, None, page_size=10)
+        for r in records:
+            if r["n"] == 15:
+                break
+        records.close()
+        assert len(es.scrolls) == 0 and len(cleared()) == 1
+
+        # as does one which just drops it, or leaves a with block on an error
+        records = tasks.scroll(conn, None, page_size=10)
+        next(records)
+        del records
+        gc.collect()
+        assert len(es.scrolls) == 0 and len(cleared()) == 2
+
+        with self.assertRaises(KeyError):
+            with tasks.scroll(conn, None, page_size=10) as records:
+                next(records)
+                raise KeyError("caller failed")
+        assert len(es.scrolls) == 0 and len(cleared()) == 3
+
+        # or reaches its limit before the end of the results
+        assert len(list(tasks.scroll(conn, None, page_size=10, limit=25))) == 25
+        assert len(es.scrolls) == 0 and len(cleared()) == 4
+
+        # failing to clear the scroll doesn't hide the caller's own error
+        es.fail = lambda method, host, path, body: (500, {"error": "down"}) if method == "DELETE" else None
+        with self.assertRaises(KeyError):
+            with tasks.scroll(conn, None, page_size=10) as records:
+                next(records)
+                raise KeyError("caller failed")
+        assert len(cleared()) == 5
+
+    def test_07_point_in_time(self):
+        es = FakeES()
+        es.add("test", _records(95))
+        conn = FakeConnection(es)
+
+        with tasks.PointInTime(conn, keep_alive="5m") as pit:
+            assert len(es.pits) == 1
+
+            # it reads the index as it was when opened, however it's read
+            es.add("test", [{"id": "later", "n": 95}])
+            assert pit.count() == 95
+            assert [r["n"] for r in pit.iterate(page_size=10)] == list(range(95))
+            assert sorted(r["n"] for r in pit.parallel_iterate(slices=3, page_size=10)) == list(range(95))
+            assert all(c[4]["pit"]["keep_alive"] == "5m" for c in es.calls("POST", "_search"))
+
+            # and a read given the point in time leaves it open for the caller to close
+            out = io.StringIO()
+            tasks.dump(conn, None, out=out, pit=pit, es_bulk_format=False)
+            assert len(out.getvalue().splitlines()) == 95
+            assert len(es.pits) == 1
+
+        # leaving the with block closes it
+        assert len(es.pits) == 0 and pit.id is None
+        with self.assertRaises(tasks.PointInTimeException):
+            pit.search({"query": {"match_all": {}}})
+
+        # whereas one opened for a read is closed by it
+        out = io.StringIO()
+        tasks.dump(conn, None, out=out, pit=True, es_bulk_format=False)
+        assert len(out.getvalue().splitlines()) == 96
+        assert len(es.calls("POST", "_pit")) == 2 and len(es.pits) == 0
+
+        # a point in time which can't be opened is an error, but one which can't be closed is only logged
+        es.fail = lambda method, host, path, body: (500, {"error": "down"}) if path.endswith("_pit") else None
+        with self.assertRaises(tasks.PointInTimeException):
+            tasks.PointInTime(conn).open()
+        es.fail = None
+        pit = tasks.PointInTime(conn).open()
+
+        def down(method, host, path, body):
+            raise requests.ConnectionError("down")
+
+        es.fail = down
+        pit.close()
+        assert pit.id is None
+
+    def test_08_compare_index_counts(self):
+        es = FakeES()
+        for index in ["a", "b"]:
+            es.add(index + "/thing", _records(20))
+            es.add(index + "/other", _records(5))
+        es.add("b/other", [{"id": "extra", "n": 5}])
+        conns = [FakeConnection(es, "a"), FakeConnection(es, "b")]
+
+        counts = tasks.compare_index_counts(conns, ["thing", "other"])
+        assert not counts
+        assert counts.counts == {"thing": [20, 20], "other": [5, 6]}
+        assert counts.differences() == {"other": [5, 6]}
+        assert counts.errors == {}
+
+        # a count which fails is reported against its type and index, rather than taken for a difference of 0
+        es.fail = lambda method, host, path, body: (500, {"error": "down"}) if path == "/b/thing/_count" else None
+        counts = tasks.compare_index_counts(conns, ["thing", "other"], concurrency=2)
+        assert counts.counts["thing"] == [20, None]
+        assert list(counts.errors.keys()) == [("thing", 1)] and "500" in counts.errors[("thing", 1)]
+        assert list(counts.summary()["errors"].keys()) == ["thing/b"]
+        assert not counts.equal_for("thing")
+
+        # as is one whose point in time can't be opened
+        es = FakeES()
+        es.add("a", _records(20))
+        es.add("b", _records(21))
+        conns = [FakeConnection(es, "a"), FakeConnection(es, "b"), FakeConnection(es, "c")]
+        es.fail = lambda method, host, path, body: (500, {"error": "down"}) if path == "/c/_pit" else None
+        counts = tasks.compare_index_counts(conns, [None], pit=True)
+        assert counts.counts == {None: [20, 21, None]}
+        assert "Unable to open point in time" in counts.errors[(None, 2)]
+        assert len(es.pits) == 0
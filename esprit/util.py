@@ -1,5 +1,54 @@
 from datetime import datetime
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 def now():
-    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    # to the millisecond, so that saves in quick succession get distinct timestamps
+    n = datetime.utcnow()
+    return n.strftime("%Y-%m-%dT%H:%M:%S") + ".{0:03d}Z".format(n.microsecond // 1000)
+
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+COMPRESSION_EXTENSIONS = {GZIP: ".gz", ZSTD: ".zst"}
+
+
+def compression_for(path):
+    """ The compression implied by the file's extension, or None if it isn't a compressed file """
+    for compression, ext in COMPRESSION_EXTENSIONS.items():
+        if path.endswith(ext):
+            return compression
+    return None
+
+
+def compressed_name(path, compression):
+    """ The file name with the extension for the compression added, if it doesn't already have it """
+    if compression is None or compression_for(path) == compression:
+        return path
+    return path + COMPRESSION_EXTENSIONS[compression]
+
+
+def open_file(path, mode="rb", compression=None, level=6):
+    """
+    Open a file which may be compressed, with gzip or (if the zstandard package is installed) zstd.
+
+    :param mode: as for open(); give "b" or "t" explicitly, as compressed files default to binary
+    :param compression: GZIP or ZSTD, or None to go by the file's extension
+    :param level: the compression level to write with
+    """
+    compression = compression if compression is not None else compression_for(path)
+    if compression is None:
+        return open(path, mode)
+    if compression == GZIP:
+        return gzip.open(path, mode, compresslevel=level)
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package: pip install zstandard")
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=level) if "r" not in mode else None)
+    raise ValueError("unknown compression '{0}'".format(compression))
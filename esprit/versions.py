@@ -21,3 +21,35 @@ def source_include(v):
     if v.startswith("5"):
         return False
     return True
+
+
+def refresh_wait_for(v):
+    # the index API's refresh=wait_for arrived in 5.0
+    return int(v.split(".")[0]) >= 5
+
+
+def refresh_on_write(v):
+    # before 5.0 the index API could only force a refresh, which it could from 1.0
+    return not v.startswith("0")
+
+
+def delete_by_query_api(v):
+    # delete by query moved from DELETE _query to POST _delete_by_query in 5.0
+    return int(v.split(".")[0]) >= 5
+
+
+def shard_doc_sort(v):
+    # a point in time can be sorted on _shard_doc, which is unique and needs no fielddata, from 7.12
+    major, minor = [int(x) for x in v.split("-")[0].split(".")[:2]]
+    return major > 7 or (major == 7 and minor >= 12)
+
+
+def id_sort_field(v):
+    # records can be sorted by id through _uid before 7.0, and on _id itself from then until 8.0 turns off the
+    # fielddata that needs; after that there is no id field to sort on by default
+    major = int(v.split(".")[0])
+    if major < 7:
+        return "_uid"
+    if major < 8:
+        return "_id"
+    return None
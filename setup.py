@@ -7,6 +7,9 @@ setup(
     install_requires=[
         "requests",
     ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
     url='http://cottagelabs.com/',
     author='Cottage Labs',
     author_email='us@cottagelabs.com',